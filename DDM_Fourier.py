@@ -1,13 +1,13 @@
+import os
 import numpy as np
 from ImageStack import ImageStack
 from typing import List
-from joblib import Parallel, delayed
-import matplotlib.pyplot as plt
-from matplotlib.colors import LogNorm
-from scipy.optimize import leastsq
-from matplotlib.widgets import SpanSelector
-from scipy.signal import find_peaks
-from scipy.signal import butter, filtfilt
+from plot_queue import decimate_image, figure_pixels, default_queue, show_figure
+from telemetry import Telemetry
+from ddm_kernels import subtract_into, fft2_inplace, accumulate_power, radial_bin_index, radial_sum
+
+# joblib, matplotlib and scipy are imported inside the functions that use them,
+# so importing this module (e.g. in a batch worker or to load a saved ISF) stays cheap
 
 kB = 1.38e-23  # Boltzmann constant (J/K)
 T = 298         # Temperature (K)
@@ -25,27 +25,221 @@ class RadialAverager(object):
         self.dists[:,0] = 0
         #discretize distances into bins
         self.bins = np.arange(max(shape)/2+1)/float(max(shape))
+        #bin of each pixel, so every average is a single pass over the spectrum
+        self.bin_index = radial_bin_index(self.dists, self.bins)
         #number of pixels at each distance
-        self.hd = np.histogram(self.dists, self.bins)[0]
+        self.hd = np.bincount(self.bin_index.ravel(), minlength=self.bins.size)[:self.bins.size-1]
     
     def __call__(self, im):
-        """Perform and return the radial average of the specrum 'im'"""
-        assert im.shape == self.dists.shape
-        hw = np.histogram(self.dists, self.bins, weights=im)[0]
+        """Perform and return the radial average of the specrum 'im' (or of each spectrum of a stack of them)"""
+        assert im.shape[-2:] == self.dists.shape
+        if im.ndim > 2:
+            return np.array([self(channel) for channel in im])
+        hw = radial_sum(im, self.bin_index, self.bins.size-1)
         return hw/self.hd
-    
+
+class SectorAverager(RadialAverager):
+    """
+    Average of a 2D array centred on (0,0), like the result of fft2d, over the radial bins of
+    RadialAverager split into angular sectors. The power spectrum of a real image is symmetric
+    under q -> -q, so the sectors span [0, pi): sector k is centred on the angle k*pi/n_sectors
+    from the x (column) axis, so sector 0 is along x and, for an even count, sector n_sectors/2 along y.
+    """
+    def __init__(self, shape, n_sectors: int=4):
+        super().__init__(shape)
+        self.n_sectors = n_sectors
+        self.n_radii = self.bins.size-1
+        #angle of every frequency in [0, pi), shifted by half a sector so the sectors are centred
+        qy = np.fft.fftfreq(shape[0])[:,None]
+        qx = np.fft.fftfreq(shape[1])[None,:]
+        angles = np.mod(np.arctan2(qy, qx) + np.pi/(2*n_sectors), np.pi)
+        sector = np.minimum((angles / (np.pi/n_sectors)).astype(np.intp), n_sectors-1)
+        #sector angles (radians) of the columns of the result
+        self.angles = np.arange(n_sectors) * np.pi/n_sectors
+        #combined (radius, sector) bin of each pixel, pixels outside the radial bins stay outside
+        n_bins = self.n_radii*n_sectors
+        self.sector_index = np.where(self.bin_index < self.n_radii, self.bin_index*n_sectors + sector, n_bins)
+        #number of pixels in each (radius, sector) bin, some small radii have empty sectors
+        self.sector_counts = np.bincount(self.sector_index.ravel(), minlength=n_bins+1)[:n_bins].reshape(self.n_radii, n_sectors)
+
+    def averages(self, im):
+        """
+        Radial average (q) and sector average (q x sectors) of the spectrum 'im', from one pass
+        over it. A stack of spectra gives a stack of each.
+        """
+        assert im.shape[-2:] == self.dists.shape
+        if im.ndim > 2:
+            radial, sectors = zip(*[self.averages(channel) for channel in im])
+            return np.array(radial), np.array(sectors)
+        sums = radial_sum(im, self.sector_index, self.n_radii*self.n_sectors).reshape(self.n_radii, self.n_sectors)
+        #every pixel of a radial bin is in one of its sectors, so the radial average is the sum over sectors
+        radial = sums.sum(axis=1)/self.hd
+        with np.errstate(invalid='ignore', divide='ignore'):
+            sectors = np.where(self.sector_counts > 0, sums/self.sector_counts, np.nan)
+        return radial, sectors
+
+    def __call__(self, im):
+        """Perform and return the sector average (q x sectors) of the spectrum 'im'"""
+        return self.averages(im)[1]
+
+def q_values(shape, pixel_size: float) -> np.ndarray:
+    """
+    Wave vectors (μm⁻¹) of the radial bins of RadialAverager(shape). The bins are 1/max(shape)
+    wide in spatial frequency, so bin k is at q = 2π k / (max(shape) * pixel_size).
+
+    Args:
+        shape: image shape (height, width), leading axes are ignored
+        pixel_size: pixel size (μm/pixel)
+    """
+    size = max(shape[-2:])
+    n_bins = np.arange(size/2+1).size - 1
+    return 2*np.pi/(size*pixel_size) * np.arange(n_bins)
+
+def fit_isf(ISF, dts, tmax=-1, beta_guess: float=1.) -> np.ndarray:
+    """
+    Fits ISF(q, t) = A(q) * (1 - exp(-t^beta / tau(q))) + B(q) independently at every q.
+    Returns an array of shape len(qs) x 3 holding [A(q), B(q), tau(q)].
+
+    Args:
+        ISF: 2D ISF data array shape len(times) x len(qs)
+        dts: lag times (s) matching the first axis of ISF
+        tmax: maximum number of time points to use for the fitting
+        beta_guess: stretching exponent of the exponential
+    """
+    from scipy.optimize import leastsq
+
+    # Logarithmic form of the ISF function
+    # take max value between evaluated log and 1e-10 to avoid 0 error in log
+    # p_0 = A(q), p_1 = B(q), p_2 = tau(q)
+    LogISF = lambda p, dts: np.log(np.maximum(p[0] * (1 - np.exp(-dts**beta_guess / p[2])) + p[1], 1e-10))
+
+    # Initialize parameter array
+    # intialise A(q) = peak-to-peak range of ISF
+    #           B(q) = min value of ISF
+    #           tau  = 1
+    params = np.zeros((ISF.shape[-1], 3))
+    for iq, ddm in enumerate(ISF[:tmax].T):
+        params[iq] = leastsq(
+            lambda p, dts, logd: LogISF(p, dts) - logd,
+            [np.ptp(ISF), ddm.min(), 1],
+            args=(dts[:tmax], np.log(ddm))
+        )[0]
+    return params
+
+def fit_diffusion(qs, taus):
+    """
+    Fits tau(q) over the given q range for the exponent alpha and the diffusivity D.
+    Returns (alpha, D, diameter) with D in μm²/s and the diameter in µm.
+
+    Args:
+        qs: spatial frequencies (μm⁻¹) of the selected range
+        taus: characteristic times (s) fitted at those q values
+    """
+    from scipy.optimize import leastsq
+
+    # perform least squares fits for α and D
+    fit_params = leastsq(
+        lambda p, q, td: p[0] - p[1] * np.log(np.abs(q)) - np.log(np.abs(td)),
+        [30, 2], # initial parameter guesses for log(D) and alpha
+        args=(qs, taus)
+    )[0]
+    alpha = fit_params[1]
+
+    D = np.exp(-leastsq(
+        lambda p, q, td: p[0] - 2 * np.log(q) - np.log(td),
+        [13],
+        args=(qs, taus)
+    )[0][0])
+
+    # calculate diameter in µm
+    predicted_a = kB * T / (3 * np.pi * mu * D) * 1e12 * 1e6
+    return alpha, D, predicted_a
+
+def fit_q_range(qs, taus, q_min: float=None, q_max: float=None) -> tuple:
+    """
+    fit_diffusion over q_min <= q <= q_max, skipping q = 0 and any failed tau fit.
+    Returns (alpha, D, diameter, q_min, q_max), raises ValueError if fewer than two
+    valid tau(q) values are in the range.
+
+    Args:
+        qs: spatial frequencies (μm⁻¹)
+        taus: characteristic times (s) fitted at every q (the last column of fit_isf)
+        q_min: lowest q of the fit (defaults to the first non-zero q)
+        q_max: highest q of the fit (defaults to the last q)
+    """
+    q_min = q_min if q_min is not None else qs[1]
+    q_max = q_max if q_max is not None else qs[-1]
+    mask = (qs >= q_min) & (qs <= q_max) & (qs > 0) & np.isfinite(taus) & (taus > 0)
+    if mask.sum() < 2:
+        raise ValueError('Fewer than two valid tau(q) values in the selected q range.')
+    return (*fit_diffusion(qs[mask], taus[mask]), q_min, q_max)
+
+def log_spaced(frame_count: int, pointsPerDecade: int=15) -> np.ndarray:
+    """Log spaced integers (lags in frames) from 1 up to frame_count, excluded."""
+    nbdecades = np.log10(frame_count)
+    return np.unique(np.logspace(
+        start=0, stop=nbdecades,
+        num=int(nbdecades * pointsPerDecade),
+        base=10, endpoint=False
+        ).astype(int))
+
 class DDM_Fourier:
-    def __init__(self, filepath: str, pixel_size: float, particle_size: float, renormalise=False):
-        # create the stack attribute
-        self.stack = ImageStack(filepath)
-        # create the numpy array preloaded stack attribute
-        self.frames = self.stack.pre_load_stack(renormalise=renormalise)
+    def __init__(self, filepath: str, pixel_size: float, particle_size: float, renormalise=False,
+                 telemetry: Telemetry=None, n_decoders: int=1, background: bool=False, channels=None):
+        # stage timers, counters and memory of this run (see report())
+        self.telemetry = telemetry if telemetry is not None else Telemetry()
+        # colour channels analysed together from one decode (frames x channels x height x width),
+        # every ISF then has a leading channel axis
+        self.channels = channels
+
+        with self.telemetry.track():
+            # create the stack attribute
+            self.stack = ImageStack(filepath, channel=list(channels) if channels is not None else None)
+            # create the numpy array preloaded stack attribute, decoding segments in parallel if asked
+            # renormalise corrects illumination flicker, background subtracts the temporal median
+            if n_decoders == 1:
+                self.frames = self.stack.pre_load_stack(renormalise=renormalise, telemetry=self.telemetry,
+                                                        background=background)
+            else:
+                self.frames = self.stack.parallel_load_stack(renormalise=renormalise, n_workers=n_decoders,
+                                                             background=background, telemetry=self.telemetry)
+        self.telemetry.count('frames_decoded', self.frames.shape[0])
 
         self.pixel_size = pixel_size
         self.particle_size = particle_size
         self.fps = self.stack.fps
         self.frame_count = self.stack.frame_count
 
+    @classmethod
+    def from_frames(cls, frames: np.ndarray, pixel_size: float, particle_size: float, fps: float,
+                    channels=None, telemetry: Telemetry=None):
+        """
+        A DDM_Fourier on an already loaded or memory mapped stack (frames [x channels] x height x width),
+        e.g. a stack decoded once to shared storage. Without a video, lag times are lags / fps.
+        """
+        ddm = cls.__new__(cls)
+        ddm.telemetry = telemetry if telemetry is not None else Telemetry()
+        if channels is None and frames.ndim == 4:
+            channels = list(range(frames.shape[1]))
+        ddm.channels = channels
+        ddm.stack = None
+        ddm.frames = frames
+        ddm.pixel_size = pixel_size
+        ddm.particle_size = particle_size
+        ddm.fps = fps
+        ddm.frame_count = frames.shape[0]
+        return ddm
+
+    def lag_times(self, idts) -> np.ndarray:
+        """Time (s) of the lags (frames), from the frame timestamps of the video when there is one."""
+        if self.stack is not None:
+            return self.stack.lag_times(idts)
+        return np.asarray(idts) / self.fps
+
+    def report(self) -> dict:
+        """Per-stage times, counters and peak memory of this run so far, as a dictionary."""
+        return self.telemetry.report()
+
     def spectrumDiff(self, im0, im1) -> np.ndarray:
         """
         Computes squared modulus of 2D Fourier Transform of difference between im0 and im1
@@ -55,12 +249,14 @@ class DDM_Fourier:
         """
         return np.abs(np.fft.fft2(im1-im0.astype(float)))**2
 
-    def timeAveraged(self, dframes: int, maxNCouples: int=20):
+    def timeAccumulated(self, dframes: int, maxNCouples: int=20):
         """
-        Does at most maxNCouples spectreDiff on regularly spaced couples of images. 
+        Sums at most maxNCouples spectreDiff on regularly spaced couples of images.
+        Returns (sum of the spectra, number of couples summed), which can be merged with the
+        sums of other videos before dividing (see ddm_ensemble).
         Args:
             dframes: interval between frames (integer)
-            maxNCouples: maximum number of couples to average over
+            maxNCouples: maximum number of couples to sum over
         """
         # create array of initial times (the 'im0' in spectrumDiff) of length maxNCouples AT MOST
         # evenly spaced in increments of 'increment'
@@ -68,6 +264,8 @@ class DDM_Fourier:
         initialTimes = np.arange(0, self.frames.shape[0] - dframes, increment)
 
         avgFFT = np.zeros(self.frames.shape[1:])
+        # every couple is differenced and transformed in this one buffer
+        transform = np.empty(avgFFT.shape, dtype=complex)
         failed = 0
         for t in initialTimes:
             if t + dframes > self.frame_count - 1:
@@ -81,84 +279,283 @@ class DDM_Fourier:
             if im0 is None or im1 is None:
                 failed +=1
                 continue
-            avgFFT += self.spectrumDiff(im0, im1)
-        return avgFFT / (initialTimes.size - failed)
+            # same as avgFFT += self.spectrumDiff(im0, im1) without its temporaries
+            with self.telemetry.stage('fft'):
+                fft2_inplace(subtract_into(transform, im1, im0))
+            with self.telemetry.stage('accumulate'):
+                accumulate_power(avgFFT, transform)
+        self.telemetry.count('couples', initialTimes.size - failed)
+        self.telemetry.count('ffts', initialTimes.size - failed)
+        return avgFFT, initialTimes.size - failed
+
+    def timeAveraged(self, dframes: int, maxNCouples: int=20):
+        """
+        Does at most maxNCouples spectreDiff on regularly spaced couples of images. 
+        Args:
+            dframes: interval between frames (integer)
+            maxNCouples: maximum number of couples to average over
+        """
+        total, n_couples = self.timeAccumulated(dframes, maxNCouples)
+        return total / n_couples
     
     def logSpaced(self, pointsPerDecade: int=15) -> List[int]:
         """Generate an array of log spaced integers smaller than frame_count"""
-        nbdecades = np.log10(self.frame_count)
-
-        return np.unique(np.logspace(
-            start=0, stop=nbdecades, 
-            num=int(nbdecades * pointsPerDecade), 
-            base=10, endpoint=False
-            ).astype(int))
+        return log_spaced(self.frame_count, pointsPerDecade)
     
-    def calculate_isf(self, idts: List[float], maxNCouples: int = 1000, plot_heat_map: bool=False) -> np.ndarray:
+    def calculate_isf(self, idts: List[float], maxNCouples: int = 1000, plot_heat_map: bool=False, n_jobs: int=-1,
+                      plot_dir: str=None, n_sectors: int=None) -> np.ndarray:
         """
         Perform time-averaged and radial-averaged DDM for given time intervals.
-        Returns ISF (Intermediate Scattering Function).
+        Returns ISF (Intermediate Scattering Function), also kept in self.isf (lags x q).
 
         Args:
             idts: List of integer rounded indices (within range) to specify
                 which frames to time-average between
             maxNCouples: Maximum number of pairs to perform time averaging over
+            plot_heat_map: produce a heatmap of the ISF
             n_jobs: Number of parallel jobs to run (set to -1 for all cores)
+            plot_dir: render the heatmap to a PNG in this folder in the background instead of
+                showing it (wait for it with plot_queue.wait_figures())
+            n_sectors: also average the spectra over this many angular sectors, in the same
+                pass as the radial average, into self.isf_sectors (lags x q x sectors) with the
+                sector angles (radians from the x axis) in self.sector_angles
+
+        With channels, every couple is transformed for all the channels in one batched FFT and
+        the ISFs gain a leading channel axis: self.isf is channels x lags x q.
         """
-        # create instance of radial averager callable
-        ra = RadialAverager(self.stack.shape)
-
-        print("\nStarting the parallelised ISF calculation...")
-        
-        # parallelise the time averaging
-        with Parallel(n_jobs=-1, backend='threading') as parallel:
-            time_avg_results = parallel(delayed(self.timeAveraged)(idt, maxNCouples) for idt in idts)
-
-        print("\nTime Averaged Spectral Differences completed...")
-        print("\nCalculating Radial Average for each tau time average...")
-
-        # parallelize the radial averaging
-        with Parallel(n_jobs=-1, backend='threading') as parallel:
-            isf = np.array(parallel(delayed(ra)(ta) for ta in time_avg_results))
-
+        from joblib import Parallel, delayed
+
+        with self.telemetry.track():
+            # create instance of radial averager callable
+            image_shape = self.frames.shape[-2:]
+            if n_sectors:
+                ra = SectorAverager(image_shape, n_sectors)
+                radial_average = self.telemetry.timed('radial_average', ra.averages)
+            else:
+                ra = RadialAverager(image_shape)
+                radial_average = self.telemetry.timed('radial_average', ra)
+
+            print("\nStarting the parallelised ISF calculation...")
+
+            # parallelise the time averaging
+            with Parallel(n_jobs=n_jobs, backend='threading') as parallel:
+                time_avg_results = parallel(delayed(self.timeAveraged)(idt, maxNCouples) for idt in idts)
+
+            print("\nTime Averaged Spectral Differences completed...")
+            print("\nCalculating Radial Average for each tau time average...")
+
+            # parallelize the radial averaging
+            with Parallel(n_jobs=n_jobs, backend='threading') as parallel:
+                averages = parallel(delayed(radial_average)(ta) for ta in time_avg_results)
+            self.telemetry.count('lags', len(idts))
+
+        if n_sectors:
+            isf = np.array([radial for radial, sectors in averages])
+            self.isf_sectors = np.array([sectors for radial, sectors in averages])
+            self.sector_angles = ra.angles
+        else:
+            isf = np.array(averages)
+        if self.channels is not None:
+            # lags x channels x ... -> channels x lags x ...
+            isf = np.moveaxis(isf, 1, 0)
+            if n_sectors:
+                self.isf_sectors = np.moveaxis(self.isf_sectors, 1, 0)
         self.isf = isf
 
-        qs = 2*np.pi/(2*isf.shape[-1]*self.pixel_size) * np.arange(isf.shape[-1])
+        qs = q_values(self.frames.shape, self.pixel_size)
         self.qs = qs
 
-        dts = idts / self.fps
+        # real lag times from the frame timestamps
+        dts = self.lag_times(idts)
         self.dts = dts
 
         # if plotting feature is enabled, a heatmap will be produced
         if plot_heat_map:
-
-            plt.figure(figsize=(5,5))
-            ISF_transposed = np.transpose(isf)
-            plt.imshow(ISF_transposed, cmap='viridis', aspect='auto', extent=[dts[0], dts[-1], qs[-1], qs[0]], norm=LogNorm())
-            plt.colorbar(label='I(q,$\\tau$),[a.u.]')
-            plt.title('Image Structure Function I(q,$\\tau$)')
-            plt.xlabel('Lag time ($\\tau$) [s]')
-            plt.ylabel('Spatial Frequency (q) [$\\mu m ^{-1}$]')
-            plt.savefig(f'{self.particle_size}μm_{self.fps}fps_ISFHeatmap.png')
-            plt.show()
+            # one heatmap per channel
+            channel_isfs = zip(self.channels, isf) if self.channels is not None else [(None, isf)]
+            for channel, channel_isf in channel_isfs:
+                suffix = f'_ch{channel}' if channel is not None else ''
+                spec = {
+                    'path': os.path.join(plot_dir or '', f'{self.particle_size}μm_{self.fps}fps_ISFHeatmap{suffix}.png'),
+                    'figsize': (5, 5),
+                    'colorbar': {'label': 'I(q,$\\tau$),[a.u.]'},
+                    'title': 'Image Structure Function I(q,$\\tau$)',
+                    'xlabel': 'Lag time ($\\tau$) [s]',
+                    'ylabel': 'Spatial Frequency (q) [$\\mu m ^{-1}$]',
+                }
+                # no more pixels than the figure can show
+                ISF_transposed = decimate_image(np.transpose(channel_isf), figure_pixels(spec))
+                spec['calls'] = [('imshow', (ISF_transposed,), {'cmap': 'viridis', 'aspect': 'auto',
+                                  'extent': [dts[0], dts[-1], qs[-1], qs[0]], 'norm': 'log'})]
+
+                if plot_dir is not None:
+                    default_queue().submit(spec)
+                else:
+                    show_figure(spec)
+        return isf
     
+    def accumulate_isf(self, idts: List[float], maxNCouples: int=1000, n_jobs: int=-1):
+        """
+        The mergeable state of calculate_isf: the radial average of the summed spectra and the
+        number of couples summed, for every lag. ISF = sums / counts[:, None], and the sums and
+        counts of several videos of the same geometry add up to their ensemble ISF.
+        Returns (sums (lags x q, or channels x lags x q), counts (lags)).
+
+        Args:
+            idts: lags (frames) to sum the couples of
+            maxNCouples: maximum number of couples summed per lag
+            n_jobs: number of threads summing the lags (-1 for all cores)
+        """
+        from joblib import Parallel, delayed
+
+        with self.telemetry.track():
+            ra = RadialAverager(self.frames.shape[-2:])
+            radial_average = self.telemetry.timed('radial_average', ra)
+
+            def lag_sums(idt):
+                # the radial average is linear, so averaging the sums keeps them mergeable, and
+                # reducing every lag as soon as it is summed keeps one spectrum per thread in memory
+                total, n_couples = self.timeAccumulated(idt, maxNCouples)
+                return radial_average(total), n_couples
+
+            with Parallel(n_jobs=n_jobs, backend='threading') as parallel:
+                accumulated = parallel(delayed(lag_sums)(idt) for idt in idts)
+            sums = np.array([radial for radial, n_couples in accumulated])
+            counts = np.array([n_couples for radial, n_couples in accumulated])
+            self.telemetry.count('lags', len(idts))
+
+        if self.channels is not None:
+            sums = np.moveaxis(sums, 1, 0)
+        return sums, counts
+
+    def time_resolved_isf(self, idts: List[float], window: int, stride: int, couple_step: int=1) -> np.ndarray:
+        """
+        ISFs over sliding windows of the video, for D(t) of samples that age or gel.
+        Returns an array of shape windows x lags x q (channels x windows x lags x q with channels),
+        also kept in self.isf_windows with the first frame and mid time (s) of every window in
+        self.window_starts and self.window_times.
+
+        The FFT is linear, so a couple's spectrum is the difference of its frames' spectra: every
+        frame is transformed once and kept while a window holds it. Every couple's radially
+        averaged |difference|² is computed once too, added to the running sum of its lag when
+        it enters the window and subtracted when it leaves, so overlapping windows share both.
+        A window holds every couple (t, t + lag) inside it with t on a grid of couple_step frames.
+
+        Args:
+            idts: lags (frames), those not shorter than the window are dropped
+            window: window length (frames)
+            stride: step between the starts of consecutive windows (frames)
+            couple_step: spacing of the couple start frames (1 uses every couple)
+        """
+        n_frames = self.frames.shape[0]
+        if not 0 < window <= n_frames:
+            raise ValueError(f'window must be between 1 and the {n_frames} frames of the video')
+        idts = np.asarray([idt for idt in idts if 0 < idt < window], dtype=int)
+        starts = np.arange(0, n_frames - window + 1, stride)
+
+        ra = RadialAverager(self.frames.shape[-2:])
+        spectra = {}
+        difference = np.empty(self.frames.shape[1:], dtype=complex)
+        power = np.empty(self.frames.shape[1:])
+
+        def spectrum(t):
+            if t not in spectra:
+                with self.telemetry.stage('fft'):
+                    transform = np.empty(self.frames.shape[1:], dtype=complex)
+                    transform[...] = self.frames[t]
+                    spectra[t] = fft2_inplace(transform)
+                self.telemetry.count('ffts')
+            return spectra[t]
+
+        def contribution(t, idt):
+            np.subtract(spectrum(t + idt), spectrum(t), out=difference)
+            with self.telemetry.stage('accumulate'):
+                power.fill(0)
+                accumulate_power(power, difference)
+            self.telemetry.count('couples')
+            return ra(power)
+
+        # running sums of the couples in the window, and the contributions needed to remove them
+        q_shape = (*self.frames.shape[1:-2], ra.bins.size-1)
+        sums = [np.zeros(q_shape) for idt in idts]
+        counts = np.zeros(len(idts), dtype=int)
+        inside = [{} for idt in idts]
+        next_start = np.zeros(len(idts), dtype=int)
+        isf_windows = []
+
+        with self.telemetry.track():
+            for start in starts:
+                stop = start + window
+                for i, idt in enumerate(idts):
+                    # couples that started before the window leave it
+                    for t in [t for t in inside[i] if t < start]:
+                        sums[i] = sums[i] - inside[i].pop(t)
+                        counts[i] -= 1
+                    # couples that now end inside the window enter it
+                    while next_start[i] + idt < stop:
+                        t = next_start[i]
+                        next_start[i] += couple_step
+                        if t >= start:
+                            inside[i][t] = contribution(t, idt)
+                            sums[i] = sums[i] + inside[i][t]
+                            counts[i] += 1
+                isf_windows.append([total / count if count else np.full(q_shape, np.nan)
+                                    for total, count in zip(sums, counts)])
+
+                # spectra of frames before the next window are not needed any more
+                next_window = start + stride
+                for t in [t for t in spectra if t < next_window]:
+                    del spectra[t]
+            self.telemetry.count('windows', len(starts))
+
+        isf_windows = np.array(isf_windows)
+        if self.channels is not None:
+            isf_windows = np.moveaxis(isf_windows, 2, 0)
+        self.isf_windows = isf_windows
+        self.window_idts = idts
+        self.window_starts = starts
+        index = self.stack.index if self.stack is not None else None
+        timestamps = index.timestamps if index is not None else np.arange(n_frames) / self.fps
+        self.window_times = (timestamps[starts] + timestamps[starts + window - 1]) / 2
+        self.qs = q_values(self.frames.shape, self.pixel_size)
+        self.window_dts = self.lag_times(idts)
+        return isf_windows
+
+    def fit_time_resolved(self, q_min: float=None, q_max: float=None, tmax=-1, channel: int=None) -> dict:
+        """
+        Fits the ISF of every window of time_resolved_isf for alpha(t), D(t) and the diameter(t).
+        Windows whose fit fails are NaN. Returns a dictionary of arrays (one value per window)
+        with the window mid times under 'time'.
+
+        Args:
+            q_min: lowest q (μm⁻¹) of the diffusion fit (defaults to the first non-zero q)
+            q_max: highest q (μm⁻¹) of the diffusion fit (defaults to the last q)
+            tmax: maximum number of time points used in the ISF fit
+            channel: position of the channel to fit in 'channels' (with channels)
+        """
+        isf_windows = self.isf_windows[channel] if self.channels is not None else self.isf_windows
+
+        result = {'time': self.window_times, 'alpha': np.full(len(isf_windows), np.nan)}
+        result['D'] = result['alpha'].copy()
+        result['diameter'] = result['alpha'].copy()
+        with self.telemetry.stage('fit'):
+            for w, isf in enumerate(isf_windows):
+                params = fit_isf(isf, self.window_dts, tmax=tmax)
+                try:
+                    alpha, D, diameter, *q_range = fit_q_range(self.qs, params[:, 2], q_min, q_max)
+                except ValueError:
+                    # fewer than two valid tau(q) values, the window stays NaN
+                    continue
+                result['alpha'][w], result['D'][w], result['diameter'][w] = alpha, D, diameter
+        return result
+
     def BrownianCorrelation(self, ISF, tmax=-1, beta_guess:float=1.):
-        # Logarithmic form of the ISF function
-        # take max value between evaluated log and 1e-10 to avoid 0 error in log
-        # p_0 = A(q), p_1 = B(q), p_2 = tau(q)
-        LogISF = lambda p, dts: np.log(np.maximum(p[0] * (1 - np.exp(-dts**beta_guess / p[2])) + p[1], 1e-10))
-
-        # Initialize parameter array
-        # intialise A(q) = peak-to-peak range of ISF
-        #           B(q) = min value of ISF
-        #           tau  = 1
-        params = np.zeros((ISF.shape[-1], 3))
-        for iq, ddm in enumerate(ISF[:tmax].T):
-            params[iq] = leastsq(
-                lambda p, dts, logd: LogISF(p, dts) - logd,
-                [np.ptp(ISF), ddm.min(), 1],
-                args=(self.dts[:tmax], np.log(ddm))
-            )[0]
+        import matplotlib.pyplot as plt
+        from matplotlib.widgets import SpanSelector
+
+        # fit A(q), B(q) and tau(q) for every q
+        with self.telemetry.stage('fit'):
+            params = fit_isf(ISF, self.dts, tmax=tmax, beta_guess=beta_guess)
 
         # initialize selection range
         iqmin, iqmax = 0, self.qs.size - 1
@@ -184,21 +581,7 @@ class DDM_Fourier:
             print(f"Selected range: {self.qs[iqmin]:.2f} to {self.qs[iqmax]:.2f}")
 
             # perform least squares fits for α and D
-            fit_params = leastsq(
-                lambda p, q, td: p[0] - p[1] * np.log(np.abs(q)) - np.log(np.abs(td)),
-                [30, 2], # initial parameter guesses for log(D) and alpha
-                args=(self.qs[iqmin:iqmax], params[iqmin:iqmax, 2])
-            )[0]
-            alpha = fit_params[1]
-
-            D = np.exp(-leastsq(
-                lambda p, q, td: p[0] - 2 * np.log(q) - np.log(td),
-                [13],
-                args=(self.qs[iqmin:iqmax], params[iqmin:iqmax, 2])
-            )[0][0])
-
-            # calculate diameter in µm
-            predicted_a = kB * T / (3 * np.pi * mu * D) * 1e12 * 1e6
+            alpha, D, predicted_a = fit_diffusion(self.qs[iqmin:iqmax], params[iqmin:iqmax, 2])
 
             alpha_text.set_text(rf"$\alpha = {alpha:.2f}$")
             diameter_text.set_text(rf"Diameter = {predicted_a:.2f} µm")
@@ -218,6 +601,8 @@ class DDM_Fourier:
             γ(q, t) ~ exp[-<x(t)^2>q^2]
         We expect that plotting γ(t) on logarithmic y-axis will NOT be linear.
         """
+        import matplotlib.pyplot as plt
+
         B_q = ISF[0, :]
         A_q = ISF[-1, :] - B_q
         ISF_normalized = (ISF - B_q) / A_q
@@ -241,6 +626,10 @@ class DDM_Fourier:
         Identifies peaks above a threshold value and calculates <v_terminal> for each peak, 
         then averages the velocities and prints the result.
         """
+        import matplotlib.pyplot as plt
+        from scipy.signal import find_peaks
+        from signal_conditioning import bandstop_filter
+
         B_q = ISF[0, :]
         A_q = ISF[-1, :] - B_q
         ISF_normalized = (ISF - B_q) / A_q
@@ -258,27 +647,14 @@ class DDM_Fourier:
         plt.grid(True)
         plt.show()
         
-        # band-stop filter design (40-50 Hz for mains noise)
-        def band_stop_filter(dts, low_cutoff, high_cutoff, fs):
-            # design a band-stop filter using butterworth
-            nyquist = 0.5 * fs
-            low = low_cutoff / nyquist
-            high = high_cutoff / nyquist
-            b, a = butter(4, [low, high], btype='bandstop')
-            return b, a
-
         # Filter out the noise in the frequency domain (40-50 Hz)
         fs = 1 / (self.dts[1] - self.dts[0])  # Sampling frequency
         low_cutoff = 47.5  # Lower bound of the mains noise frequency band (40 Hz)
         high_cutoff = 48.5  # Upper bound of the mains noise frequency band (50 Hz)
 
-        # Apply the filter to the time domain signal (exp_cos_component)
-        b, a = band_stop_filter(self.dts, low_cutoff, high_cutoff, fs)
-
-        # Filter the signal using filtfilt (applies the filter forwards and backwards to avoid phase distortion)
-        exp_cos_component_filtered = np.copy(exp_cos_component)
-        for i in range(exp_cos_component.shape[1]):
-            exp_cos_component_filtered[:, i] = filtfilt(b, a, exp_cos_component[:, i])
+        # Filter every q column of the time domain signal (exp_cos_component) in one call, forwards
+        # and backwards to avoid phase distortion, with a 4th order butterworth band-stop filter
+        exp_cos_component_filtered = bandstop_filter(exp_cos_component, fs, (low_cutoff, high_cutoff), order=4, axis=0)
 
         # Plot the filtered signal
         plt.figure(figsize=(8, 6))
@@ -339,6 +715,10 @@ class DDM_Fourier:
             top: top limit to set for filtering taus
             tmax: maximum number of time points to use for the fitting
         """
+        import matplotlib.pyplot as plt
+        from scipy.optimize import leastsq
+        from matplotlib.widgets import SpanSelector
+
         # initialise fit parameter array
         # dims: len(qs) x 5 (each column stores a parameter through all q)
         params = np.zeros((ISF.shape[-1], 5))  # [A1, A2, tau1, tau2, B]
@@ -1,15 +1,53 @@
 import os
-import cv2
 import numpy as np
-from tqdm import tqdm
+from contextlib import nullcontext
+from frame_index import FrameIndex
+from preprocessing import preprocess
+
+
+def _cv2():
+    """
+    Imports OpenCV on first use, so modules which only need the stack class (e.g. to load
+    a cached result) do not pay for it. The log levels must be set before the import.
+    """
+    os.environ.setdefault('OPENCV_LOG_LEVEL', 'FATAL')
+    os.environ.setdefault('OPENCV_FFMPEG_LOGLEVEL', "-8")
+    import cv2
+    return cv2
+
+
+def _decode_segment(filename: str, channel, out_path: str, start: int, stop: int) -> np.ndarray:
+    """
+    Decodes frames [start, stop) of a stack into the shared '.npy' memmap out_path and returns
+    their mean intensities. Runs in a worker process with its own capture: one seek to the
+    start of the segment, then sequential reads.
+    """
+    stack = ImageStack(filename, channel)
+    out = np.load(out_path, mmap_mode='r+')
+
+    means = np.empty((stop - start, *stack.shape[:-2]))
+    for i in range(start, stop):
+        frame = stack[i]
+        out[i] = frame
+        means[i - start] = np.mean(frame, axis=(-2, -1))
+    out.flush()
+    stack.video.release()
+    return means
 
-# Set environment variables for OpenCV
-os.environ['OPENCV_LOG_LEVEL'] = 'FATAL'
-os.environ['OPENCV_FFMPEG_LOGLEVEL'] = "-8"
 
 class ImageStack:
-    def __init__(self, filename: str, channel=None):
+    def __init__(self, filename: str, channel=None, index: bool=True):
+        """
+        Args:
+            filename: path to the video
+            channel: colour channel to keep (the mean of the channels if None), or a sequence
+                of channels to keep them all from one decode as channels x height x width frames
+            index: take the frame count, positions and timestamps from a frame index
+                (built in one pass on first use and saved as '<video>.idx.npz'), instead of
+                trusting the frame count and fps the container claims
+        """
         self.filename = filename
+        cv2 = _cv2()
 
         # load the video file in a cv2 object
         self.video = cv2.VideoCapture(filename)
@@ -17,17 +55,27 @@ class ImageStack:
         if not self.video.isOpened():
             raise ValueError('File path likely incorrect, failed to open.')
 
-        property_id = int(cv2.CAP_PROP_FRAME_COUNT)
-
-        # get the number of frames
-        self.frame_count = int(self.video.get(property_id))
-        # get the fps
-        self.fps = self.video.get(cv2.CAP_PROP_FPS)
+        if index:
+            self.index = FrameIndex.for_video(filename)
+            if self.index.dropped.size:
+                print(f"Warning: {self.index.dropped[:, 1].sum()} dropped frame(s) in {filename}")
+            if self.index.undecodable.size:
+                print(f"Warning: {self.index.undecodable.size} of the {self.index.container_frame_count} frames "
+                      f"of {filename} could not be decoded (from position {self.index.undecodable[0]})")
+            # get the number of decodable frames and the measured fps
+            self.frame_count = len(self.index)
+            self.fps = self.index.fps
+        else:
+            self.index = None
+            self.frame_count = int(self.video.get(cv2.CAP_PROP_FRAME_COUNT))
+            self.fps = self.video.get(cv2.CAP_PROP_FPS)
         # store the specified colour channel (if any)
         self.channel = channel
 
+        # position the capture will decode next, reading it needs no seek
+        self._next = None
+
         # read first frame to determine the shape (keep original shape)
-        self.video.set(cv2.CAP_PROP_POS_FRAMES, 0)
         self.shape = self[0].shape
 
     def __len__(self):
@@ -35,43 +83,141 @@ class ImageStack:
             
     def __getitem__(self, t):
         """Fetches frame at specified index (can handle non-integer index)"""
+        t = int(t)
         # handle negative indices
         if t < 0:
-            t= len(self) + t - 1
-        
+            t = len(self) + t
+
         # check index is in range
-        assert t < self.frame_count
-        self.video.set(cv2.CAP_PROP_POS_FRAMES, t - 1)
+        if not 0 <= t < self.frame_count:
+            raise IndexError(f'Frame {t} out of range for {self.frame_count} frames.')
+
+        # reading the frames in order continues from the current position, anything else seeks
+        position = int(self.index.positions[t]) if self.index is not None else t
+        if position != self._next:
+            self.video.set(_cv2().CAP_PROP_POS_FRAMES, position)
         success, image = self.video.read()
+        if not success:
+            self._next = None
+            raise IOError(f'Failed to read frame {t} of {self.filename}')
+        self._next = position + 1
+
+        return self._to_frame(image)
 
+    @property
+    def multichannel(self) -> bool:
+        """True if the frames keep several channels (channels x height x width)."""
+        return isinstance(self.channel, (list, tuple, np.ndarray))
+
+    def _to_frame(self, image):
+        """Converts a decoded BGR image to a stack frame (the selected channel(s) or the channel mean)."""
+        if self.multichannel:
+            # channels first, so every channel is a contiguous image
+            return np.moveaxis(image[..., list(self.channel)], -1, 0)
         if self.channel is not None:
             return image[...,self.channel]
-        if image is not None:
-            return image.mean(axis=2).astype(int)
-        self.shape = self[0].shape
+        return image.mean(axis=2).astype(int)
+
+    def lag_times(self, lags) -> np.ndarray:
+        """
+        Time (s) between frames 'lags' frames apart, from the frame timestamps when indexed
+        (averaged over the video, so dropped frames are accounted for), else lags / fps.
+        """
+        if self.index is not None:
+            return self.index.lag_times(lags)
+        return np.asarray(lags) / self.fps
     
-    def pre_load_stack(self, renormalise=False):
-        """Load all frames into a numpy array which is pickleable."""
+    def pre_load_stack(self, renormalise=False, telemetry=None, background: bool=False):
+        """
+        Load all frames into a numpy array which is pickleable.
+
+        Args:
+            renormalise: divide every frame by its mean intensity (flicker correction)
+            telemetry: optional Telemetry timing the decode, renormalise and background stages
+            background: subtract the temporal median of every pixel
+        """
+        from tqdm import tqdm
+
+        stage = telemetry.stage if telemetry is not None else (lambda name: nullcontext())
+
         # load the first frame to determine whether it is RGB or grayscale
         first_frame = self[0]
 
-        # handle grayscale or RGB frames (2 or 3 dimensions)
+        # handle grayscale or multi-channel frames (2 or 3 dimensions)
         if len(first_frame.shape) == 2:  # Grayscale
             frames = np.zeros((self.frame_count, *first_frame.shape), dtype=np.float32)
-        elif len(first_frame.shape) == 3:  # RGB
+        elif len(first_frame.shape) == 3:  # channels x height x width
             frames = np.zeros((self.frame_count, *first_frame.shape), dtype=np.float32)
         else:
             raise ValueError(f"Unsupported frame shape: {first_frame.shape}")
 
-        # load all frames into the pre-constructed array
+        # load all frames into the pre-constructed array, with their mean intensities (per channel)
+        # collected while each frame is at hand for the flicker correction
+        means = np.empty(frames.shape[:-2])
         for i in tqdm(range(self.frame_count), desc="Pre-loading frames", unit="frame"):
-            if renormalise:
-                frames[i] = self[i] / (np.mean(self[i]))
-            else:
-                frames[i] = self[i]
-            
-        return frames
-    
+            with stage('decode'):
+                frame = self[i]
+            frames[i] = frame
+            means[i] = np.mean(frame, axis=(-2, -1))
+
+        return preprocess(frames, renormalise, background, means=means, telemetry=telemetry)
+
+    def parallel_load_stack(self, renormalise=False, n_workers: int=None, out: str=None, background: bool=False,
+                            telemetry=None):
+        """
+        Loads all frames like pre_load_stack, decoding contiguous segments of the frame range
+        in parallel worker processes. Each worker opens its own capture, seeks once to the
+        start of its segment and decodes sequentially into a shared memmap, so the frames,
+        their order and the index mapping are identical to pre_load_stack.
+
+        Args:
+            renormalise: divide every frame by its mean intensity (flicker correction)
+            n_workers: number of worker processes and segments (defaults to the cpu count)
+            out: '.npy' path to keep the stack in as a memmap (returned memory mapped),
+                by default a temporary file which is read back into memory and removed
+            background: subtract the temporal median of every pixel
+            telemetry: optional Telemetry timing the decode, renormalise and background stages
+        """
+        import tempfile
+        from concurrent.futures import ProcessPoolExecutor, as_completed
+        from tqdm import tqdm
+
+        n_workers = max(1, min(n_workers or os.cpu_count() or 1, self.frame_count))
+        first_frame = self[0]
+        if len(first_frame.shape) not in (2, 3):
+            raise ValueError(f"Unsupported frame shape: {first_frame.shape}")
+
+        temporary = out is None
+        if temporary:
+            handle, out = tempfile.mkstemp(suffix='.npy')
+            os.close(handle)
+        frames = np.lib.format.open_memmap(out, mode='w+', dtype=np.float32,
+                                           shape=(self.frame_count, *first_frame.shape))
+        del frames
+
+        bounds = np.linspace(0, self.frame_count, n_workers + 1).astype(int)
+        means = np.empty((self.frame_count, *first_frame.shape[:-2]))
+        stage = telemetry.stage if telemetry is not None else (lambda name: nullcontext())
+        try:
+            with stage('decode'), ProcessPoolExecutor(max_workers=n_workers) as executor:
+                futures = {executor.submit(_decode_segment, self.filename, self.channel, out, start, stop): start
+                           for start, stop in zip(bounds[:-1], bounds[1:]) if stop > start}
+                with tqdm(total=self.frame_count, desc="Pre-loading frames", unit="frame") as progress:
+                    for future in as_completed(futures):
+                        segment = future.result()
+                        start = futures[future]
+                        means[start:start + len(segment)] = segment
+                        progress.update(len(segment))
+
+            frames = np.load(out) if temporary else np.load(out, mmap_mode='r+')
+            preprocess(frames, renormalise, background, means=means, telemetry=telemetry)
+            if not temporary:
+                frames.flush()
+            return frames
+        finally:
+            if temporary:
+                os.remove(out)
+
     def verify_frames(self):
         """Verifies that the frames stored in preloaded_stack match those from the stack object."""
 
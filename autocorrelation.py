@@ -1,33 +1,24 @@
 import numpy as np
 import matplotlib.pyplot as plt
-from scipy.signal import butter, filtfilt
 from scipy import stats
+from dls_correlation import autocorrelation
+from dls_prn import load_prn
+from signal_conditioning import notch_filter
 
 # Load Data
 filename = 'DLS_files/0.75micro_100dil/30deg.prn'  # Change to your file's path if necessary
-data = np.loadtxt(filename, delimiter='\t', skiprows=3)  # Skips first 3 rows
+data = load_prn(filename)  # Skips first 3 rows, cached as .npy after the first run
 t = data[:, 0]  # Time
 voltage = data[:, 1]  # Voltage
 
 fs = 1000 / (t[1] - t[0])  # Sampling frequency
 f0 = 100  # Frequency to remove (50 Hz)
 
-# Create the bandstop filter
-b, a = butter(2, [f0 - 1, f0 + 1], btype='bandstop', fs=fs)
+# Apply a zero-phase bandstop filter (f0 ± 1 Hz) to the voltage signal
+voltage_filtered = notch_filter(voltage, fs, f0)
 
-# Apply the bandstop filter to the voltage signal
-voltage_filtered = filtfilt(b, a, voltage)
-
-# Get the number of samples (N)
-N = len(voltage_filtered)
-
-# Calculate Autocorrelation function (ACF)
-ac = np.zeros(N-1)  # Prepare the array for autocorrelation
-m = np.mean(voltage_filtered)  # Mean of the data
-
-# Compute the autocorrelation
-for j in range(1, N):
-    ac[j-1] = np.mean((voltage_filtered[0:N-j] - m) * (voltage_filtered[j:N] - m))
+# Calculate Autocorrelation function (ACF) up to the largest lag plotted below
+ac = autocorrelation(voltage_filtered, max_lag=500)
 
 # Exponential decay fitting using a linear fit on log(ACF)
 rangemax = 30  # Limit of data to use for fitting
@@ -0,0 +1,295 @@
+"""
+Benchmarks of the DDM and DLS hot paths on synthetic inputs.
+
+Every case runs in its own interpreter, so the peak RSS reported is that of the case alone.
+Wall time is the best of 'repeat' runs, throughput is the work done per second of it.
+One more run is traced with tracemalloc for the peak memory NumPy allocates during a run.
+Results can be saved as a baseline and later runs compared against it:
+
+    python benchmarks/bench.py --quick                 # small grid
+    python benchmarks/bench.py --save-baseline         # run and store benchmarks/baseline.json
+    python benchmarks/bench.py -k time_averaged        # only the matching cases, compared to the baseline
+"""
+import os
+import sys
+import json
+import time
+import argparse
+import platform
+import tracemalloc
+import resource
+import itertools
+import subprocess
+import tempfile
+import numpy as np
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+BASELINE = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'baseline.json')
+DATA_DIR = os.path.join(tempfile.gettempdir(), 'e2b_dcf_bench')
+
+
+# synthetic inputs (see synthetic.py), cached on disk between cases
+
+def synthetic_video(n_frames: int, size: int, fps: float=30.) -> str:
+    """Path of a lossless greyscale AVI of Brownian particles, written on first use."""
+    from synthetic import write_video
+
+    path = os.path.join(DATA_DIR, f'brownian_{n_frames}x{size}.avi')
+    if not os.path.exists(path):
+        os.makedirs(DATA_DIR, exist_ok=True)
+        write_video(path + '.tmp.avi', n_frames, fps=fps, shape=(size, size), seed=0)
+        os.replace(path + '.tmp.avi', path)
+    return path
+
+
+def synthetic_prn_dir(n_samples: int) -> str:
+    """Folder of synthetic .prn traces at two angles, written on first use."""
+    from synthetic import write_dls_folder
+
+    folder = os.path.join(DATA_DIR, f'dls_{n_samples}')
+    if not os.path.isdir(folder):
+        write_dls_folder(folder + '.tmp', diameter=0.5, n_samples=n_samples)
+        os.replace(folder + '.tmp', folder)
+    return folder
+
+
+# benchmark cases: each takes its parameters, does its setup and returns (run, work, unit)
+# where run() is the timed callable, optionally followed by a dictionary of extra fields
+# recorded with the result
+
+def case_time_averaged(size: int, n_frames: int, couples: int, points_per_decade: int=10):
+    from DDM_Fourier import DDM_Fourier
+    ddm = DDM_Fourier(synthetic_video(n_frames, size), pixel_size=0.1, particle_size=1.)
+    idts = ddm.logSpaced(points_per_decade)
+    # the initial times timeAveraged takes for every lag
+    frame_count = ddm.frames.shape[0]
+    n_couples = sum(np.arange(0, frame_count - idt, max((frame_count - idt) / couples, 1)).size for idt in idts)
+    return ((lambda: [ddm.timeAveraged(idt, couples) for idt in idts]), n_couples, 'couples/s',
+            {'n_lags': len(idts), 'n_couples': n_couples})
+
+
+def case_radial_average(size: int, n_arrays: int=20):
+    from DDM_Fourier import RadialAverager
+    arrays = np.random.default_rng(0).random((n_arrays, size, size))
+    ra = RadialAverager(arrays.shape[1:])
+    return (lambda: [ra(a) for a in arrays]), n_arrays, 'spectra/s'
+
+
+def case_couple_kernels(size: int, couples: int, kernels: str):
+    """
+    Accumulation of |FFT|² of frame differences and its radial average, as in
+    DDM_Fourier.timeAveraged, with the previous NumPy expressions ('reference') or the kernels
+    of ddm_kernels ('numpy' or 'numba'). Compare the allocation peaks as well as the times.
+    """
+    import ddm_kernels
+    from synthetic import brownian_stack
+    from DDM_Fourier import RadialAverager
+
+    ddm_kernels.USE_NUMBA = kernels == 'numba'
+    if kernels == 'numba' and not ddm_kernels.have_numba():
+        raise RuntimeError('numba is not installed')
+    frames = next(brownian_stack(couples + 1, shape=(size, size), chunk_frames=couples + 1))
+    ra = RadialAverager(frames.shape[1:])
+
+    def reference():
+        acc = np.zeros(frames.shape[1:])
+        for im0, im1 in zip(frames[:-1], frames[1:]):
+            acc += np.abs(np.fft.fft2(im1 - im0.astype(float)))**2
+        return np.histogram(ra.dists, ra.bins, weights=acc)[0] / ra.hd
+
+    def fused():
+        acc = np.zeros(frames.shape[1:])
+        transform = np.empty(frames.shape[1:], dtype=complex)
+        for im0, im1 in zip(frames[:-1], frames[1:]):
+            ddm_kernels.accumulate_power(acc, ddm_kernels.fft2_inplace(ddm_kernels.subtract_into(transform, im1, im0)))
+        return ra(acc)
+
+    run = reference if kernels == 'reference' else fused
+    # compile (or load the compiled kernels) outside the timed runs
+    run()
+    return run, couples, 'couples/s'
+
+
+def case_calculate_isf(size: int, n_frames: int, couples: int, points_per_decade: int=10):
+    from DDM_Fourier import DDM_Fourier
+    ddm = DDM_Fourier(synthetic_video(n_frames, size), pixel_size=0.1, particle_size=1.)
+    idts = ddm.logSpaced(points_per_decade)
+    return (lambda: ddm.calculate_isf(idts, couples, n_jobs=1)), n_frames, 'frames/s', {'n_lags': len(idts)}
+
+
+def case_dls_acf(n_samples: int, max_lag: int=500):
+    from dls_correlation import autocorrelation
+    from signal_conditioning import notch_filter
+    from synthetic import dls_trace
+    t, trace = dls_trace(n_samples, tau=20., fs=100_000.)
+    return (lambda: autocorrelation(notch_filter(trace, 100_000., 100.), max_lag=max_lag)), n_samples, 'samples/s'
+
+
+def case_dls_autocorrelation(n_samples: int):
+    import matplotlib
+    matplotlib.use('Agg')
+    from dls_automator import DLS
+    folder = synthetic_prn_dir(n_samples)
+    os.chdir(tempfile.mkdtemp())
+    dls = DLS(folder)
+    n_files = len(dls.prn_files())
+
+    # the first run parses the text and writes the .npy sidecars, the best time is the cached path
+    def run():
+        dls.tau_vals = []
+        dls.AutoCorrelation(plot=False)
+    return run, n_samples * n_files, 'samples/s'
+
+
+CASES = {
+    'time_averaged': case_time_averaged,
+    'radial_average': case_radial_average,
+    'couple_kernels': case_couple_kernels,
+    'calculate_isf': case_calculate_isf,
+    'dls_acf': case_dls_acf,
+    'dls_autocorrelation': case_dls_autocorrelation,
+}
+
+# parameter grids, every combination is one benchmark
+GRID = {
+    'time_averaged': {'size': [128, 256, 512], 'n_frames': [200], 'couples': [10, 50], 'points_per_decade': [5, 20]},
+    'radial_average': {'size': [256, 512, 1024]},
+    'couple_kernels': {'size': [256, 512, 1024], 'couples': [20], 'kernels': ['reference', 'numpy', 'numba']},
+    'calculate_isf': {'size': [128, 256], 'n_frames': [200, 500], 'couples': [10, 50], 'points_per_decade': [10, 30]},
+    'dls_acf': {'n_samples': [1_000_000, 4_000_000]},
+    'dls_autocorrelation': {'n_samples': [200_000, 1_000_000]},
+}
+
+QUICK_GRID = {
+    'time_averaged': {'size': [128], 'n_frames': [100], 'couples': [10], 'points_per_decade': [5, 20]},
+    'radial_average': {'size': [256]},
+    'couple_kernels': {'size': [256], 'couples': [10], 'kernels': ['reference', 'numpy', 'numba']},
+    'calculate_isf': {'size': [128], 'n_frames': [100], 'couples': [10], 'points_per_decade': [5, 20]},
+    'dls_acf': {'n_samples': [200_000]},
+    'dls_autocorrelation': {'n_samples': [100_000]},
+}
+
+
+def case_id(name: str, params: dict) -> str:
+    return name + '[' + ','.join(f'{key}={value}' for key, value in params.items()) + ']'
+
+
+def expand(grid: dict, pattern: str=None):
+    """Yields (name, params) for every combination of the grid whose id contains pattern."""
+    for name, axes in grid.items():
+        for values in itertools.product(*axes.values()):
+            params = dict(zip(axes, values))
+            if pattern is None or pattern in case_id(name, params):
+                yield name, params
+
+
+def peak_rss() -> int:
+    """Peak resident set size of this process in bytes."""
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return rss if sys.platform == 'darwin' else rss * 1024
+
+
+def run_case(name: str, params: dict, repeat: int) -> dict:
+    """Sets up and times one case in this process."""
+    run, work, unit, *extra = CASES[name](**params)
+    times = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        run()
+        times.append(time.perf_counter() - start)
+    wall = min(times)
+
+    tracemalloc.start()
+    run()
+    traced_peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    return dict({'wall': wall, 'mean': float(np.mean(times)), 'peak_rss': peak_rss(), 'traced_peak': traced_peak,
+                 'throughput': work / wall, 'unit': unit}, **(extra[0] if extra else {}))
+
+
+def run_in_subprocess(name: str, params: dict, repeat: int) -> dict:
+    command = [sys.executable, os.path.abspath(__file__), '--case', name, '--params', json.dumps(params),
+               '--repeat', str(repeat)]
+    output = subprocess.run(command, cwd=ROOT, capture_output=True, text=True)
+    if output.returncode != 0:
+        return {'error': output.stderr.strip().splitlines()[-1] if output.stderr.strip() else 'failed'}
+    return json.loads(output.stdout.strip().splitlines()[-1])
+
+
+def compare(results: dict, baseline: dict, threshold: float) -> list:
+    """Ids of the cases whose wall time grew by more than 'threshold' (a ratio) over the baseline."""
+    slower = []
+    for key, result in results.items():
+        reference = baseline.get('results', {}).get(key)
+        if reference and 'wall' in result and 'wall' in reference:
+            result['ratio'] = result['wall'] / reference['wall']
+            if result['ratio'] > threshold:
+                slower.append(key)
+    return slower
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmarks of the DDM and DLS hot paths.')
+    parser.add_argument('-k', dest='pattern', default=None, help='only run cases whose id contains this')
+    parser.add_argument('--quick', action='store_true', help='run the small grid')
+    parser.add_argument('--repeat', type=int, default=3, help='runs per case (the best is kept)')
+    parser.add_argument('--baseline', default=BASELINE, help='baseline file to compare against or save to')
+    parser.add_argument('--save-baseline', action='store_true', help='store these results as the baseline')
+    parser.add_argument('--threshold', type=float, default=1.2, help='wall time ratio reported as a regression')
+    parser.add_argument('--json', default=None, help='file to save the results to')
+    parser.add_argument('--case', default=None, help=argparse.SUPPRESS)
+    parser.add_argument('--params', default='{}', help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    # worker mode: run a single case and print its result
+    if args.case:
+        print(json.dumps(run_case(args.case, json.loads(args.params), args.repeat)))
+        return
+
+    baseline = {}
+    if os.path.exists(args.baseline) and not args.save_baseline:
+        with open(args.baseline) as file:
+            baseline = json.load(file)
+
+    results = {}
+    print(f"{'case':<72} {'wall (s)':>9} {'peak RSS (MB)':>14} {'traced peak (MB)':>16} {'throughput':>22} {'vs base':>8}")
+    for name, params in expand(QUICK_GRID if args.quick else GRID, args.pattern):
+        key = case_id(name, params)
+        result = results[key] = run_in_subprocess(name, params, args.repeat)
+        result['params'] = params
+        if 'error' in result:
+            print(f"{key:<72} failed: {result['error']}")
+            continue
+        compare({key: result}, baseline, args.threshold)
+        ratio = f"{result['ratio']:.2f}x" if 'ratio' in result else '-'
+        traced = f"{result['traced_peak'] / 1e6:16.1f}" if 'traced_peak' in result else f"{'-':>16}"
+        print(f"{key:<72} {result['wall']:9.3f} {result['peak_rss'] / 1e6:14.1f} {traced} "
+              f"{result['throughput']:12.4g} {result['unit']:<9} {ratio:>8}")
+
+    record = {
+        'created': time.strftime('%Y-%m-%dT%H:%M:%S'),
+        'machine': {'python': platform.python_version(), 'numpy': np.__version__,
+                    'platform': platform.platform(), 'cpus': os.cpu_count()},
+        'results': results,
+    }
+    if args.json:
+        with open(args.json, 'w') as file:
+            json.dump(record, file, indent=2)
+    if args.save_baseline:
+        with open(args.baseline, 'w') as file:
+            json.dump(record, file, indent=2)
+        print(f"Baseline saved to '{args.baseline}'")
+        return
+
+    slower = compare(results, baseline, args.threshold)
+    if slower:
+        print(f"\n{len(slower)} case(s) slower than the baseline by more than {args.threshold:.2f}x:")
+        for key in slower:
+            print(f"  {key}: {results[key]['ratio']:.2f}x")
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,77 @@
+"""
+Import time of the analysis modules, each measured in a fresh interpreter.
+
+Also lists which heavy dependencies an import pulls in, since those should only be
+loaded on first use. Run from anywhere:
+    python benchmarks/import_time.py [--repeat 5] [--json import_times.json] [--strict]
+"""
+import os
+import sys
+import json
+import argparse
+import subprocess
+import numpy as np
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+MODULES = ['ImageStack', 'DDM_Fourier', 'ddm_batch', 'dls_automator', 'dls_stream',
+           'results_store', 'plot_queue']
+
+# dependencies that take a noticeable time to import and are not needed just to import the modules
+HEAVY = ['cv2', 'tqdm', 'joblib', 'matplotlib', 'matplotlib.pyplot', 'scipy.optimize', 'scipy.signal',
+         'scipy.stats', 'scipy.fft', 'pandas']
+
+PROBE = """
+import sys, time, json
+start = time.perf_counter()
+import {module}
+elapsed = time.perf_counter() - start
+print(json.dumps({{'time': elapsed, 'loaded': [name for name in {heavy!r} if name in sys.modules]}}))
+"""
+
+
+def time_import(module: str, repeat: int=5) -> dict:
+    """
+    Imports module in 'repeat' fresh interpreters (numpy is imported first, every module needs it).
+    Returns the best and median import time in seconds and the heavy modules it loaded.
+    """
+    code = 'import numpy\n' + PROBE.format(module=module, heavy=HEAVY)
+    times, loaded = [], []
+    for _ in range(repeat):
+        output = subprocess.run([sys.executable, '-c', code], cwd=ROOT, capture_output=True, text=True)
+        if output.returncode != 0:
+            return {'module': module, 'error': output.stderr.strip().splitlines()[-1]}
+        result = json.loads(output.stdout.strip().splitlines()[-1])
+        times.append(result['time'])
+        loaded = result['loaded']
+    return {'module': module, 'best': min(times), 'median': float(np.median(times)), 'loaded': loaded}
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Import time of the analysis modules.')
+    parser.add_argument('modules', nargs='*', default=MODULES)
+    parser.add_argument('--repeat', type=int, default=5)
+    parser.add_argument('--json', default=None, help='file to save the results to')
+    parser.add_argument('--strict', action='store_true', help='fail if an import loads a heavy dependency')
+    args = parser.parse_args()
+
+    results = [time_import(module, args.repeat) for module in args.modules]
+
+    print(f"{'module':<20} {'best (ms)':>10} {'median (ms)':>12}  heavy imports")
+    for result in results:
+        if 'error' in result:
+            print(f"{result['module']:<20} failed: {result['error']}")
+            continue
+        print(f"{result['module']:<20} {result['best'] * 1e3:10.1f} {result['median'] * 1e3:12.1f}  "
+              f"{', '.join(result['loaded']) or '-'}")
+
+    if args.json:
+        with open(args.json, 'w') as file:
+            json.dump(results, file, indent=2)
+
+    if args.strict and any(result.get('loaded') or 'error' in result for result in results):
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
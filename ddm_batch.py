@@ -0,0 +1,257 @@
+import os
+import csv
+import time
+import argparse
+import traceback
+import numpy as np
+from concurrent.futures import ProcessPoolExecutor, wait, FIRST_COMPLETED
+from concurrent.futures.process import BrokenProcessPool
+from results_store import ResultsStore, open_store, now
+from ddm_kernels import set_threads
+
+VIDEO_EXTENSIONS = ('.avi', '.mp4', '.mov', '.mkv', '.tif', '.tiff')
+
+SUMMARY_FIELDS = ['video', 'pixel_size', 'particle_size', 'status', 'attempts',
+                  'alpha', 'D', 'diameter', 'q_min', 'q_max', 'elapsed', 'result', 'telemetry', 'error']
+
+
+def load_jobs(source: str, pixel_size: float=None, particle_size: float=None):
+    """
+    Build the list of video jobs from a directory or a CSV manifest.
+
+    A manifest has the columns path, pixel_size, particle_size and optionally q_min, q_max.
+    Relative paths are resolved against the folder containing the manifest.
+    For a directory, every video inside it uses the given pixel_size and particle_size.
+
+    Args:
+        source: directory of videos or path to a CSV manifest
+        pixel_size: default pixel size (μm/pixel) for directories and empty manifest cells
+        particle_size: default particle size (μm) for directories and empty manifest cells
+    """
+    jobs = []
+    if os.path.isdir(source):
+        if pixel_size is None or particle_size is None:
+            raise ValueError('pixel_size and particle_size are required when processing a directory.')
+        for entry in sorted(os.scandir(source), key=lambda e: e.name):
+            if entry.is_file() and entry.name.lower().endswith(VIDEO_EXTENSIONS):
+                jobs.append({'path': entry.path, 'pixel_size': pixel_size, 'particle_size': particle_size,
+                             'q_min': None, 'q_max': None})
+        return jobs
+
+    base = os.path.dirname(os.path.abspath(source))
+    with open(source, newline='') as file:
+        for row in csv.DictReader(file):
+            row = {k.strip(): (v.strip() if v is not None else '') for k, v in row.items()}
+            path = row['path']
+            if not os.path.isabs(path):
+                path = os.path.join(base, path)
+            jobs.append({
+                'path': path,
+                'pixel_size': float(row['pixel_size']) if row.get('pixel_size') else pixel_size,
+                'particle_size': float(row['particle_size']) if row.get('particle_size') else particle_size,
+                'q_min': float(row['q_min']) if row.get('q_min') else None,
+                'q_max': float(row['q_max']) if row.get('q_max') else None,
+            })
+    for job in jobs:
+        if job['pixel_size'] is None or job['particle_size'] is None:
+            raise ValueError(f"Missing pixel_size or particle_size for {job['path']}")
+    return jobs
+
+
+def estimate_job_memory(path: str, pointsPerDecade: int=60) -> int:
+    """
+    Estimate the peak memory (bytes) of processing one video, from its frame dimensions and count.
+    Counts the float32 preloaded stack plus the float64 time averaged spectrum kept for every lag.
+    The frame count is that of the frame index (built and cached here if needed), which the
+    analysis decodes, rather than the container's claim.
+    """
+    from ImageStack import _cv2
+    from frame_index import FrameIndex
+
+    cv2 = _cv2()
+    video = cv2.VideoCapture(path)
+    if not video.isOpened():
+        raise ValueError(f'Failed to open {path}')
+    width = int(video.get(cv2.CAP_PROP_FRAME_WIDTH))
+    height = int(video.get(cv2.CAP_PROP_FRAME_HEIGHT))
+    video.release()
+    frame_count = len(FrameIndex.for_video(path))
+
+    frame_bytes = width * height
+    n_lags = int(np.log10(max(frame_count, 1)) * pointsPerDecade)
+    return frame_count * frame_bytes * 4 + n_lags * frame_bytes * 8
+
+
+def available_memory() -> int:
+    """Physical memory of the machine in bytes (0 if unknown)."""
+    try:
+        return os.sysconf('SC_PAGE_SIZE') * os.sysconf('SC_PHYS_PAGES')
+    except (ValueError, OSError, AttributeError):
+        return 0
+
+
+def process_video(job: dict, out_dir: str, pointsPerDecade: int=60, maxNCouples: int=30, tmax=-1, n_jobs: int=1):
+    """
+    Decode one video, compute its ISF, fit it and save the results to '<out_dir>/<video>.npz',
+    and the per-stage timings and memory of the run to '<out_dir>/<video>.telemetry.json'.
+    Runs inside a worker process, returns a dictionary of scalar results for the summary.
+    """
+    from DDM_Fourier import DDM_Fourier, fit_isf, fit_q_range
+
+    start = time.perf_counter()
+    ddm = DDM_Fourier(filepath=job['path'], pixel_size=job['pixel_size'], particle_size=job['particle_size'])
+
+    idts = ddm.logSpaced(pointsPerDecade)
+    ddm.calculate_isf(idts, maxNCouples, plot_heat_map=False, n_jobs=n_jobs)
+    with ddm.telemetry.stage('fit'):
+        params = fit_isf(ddm.isf, ddm.dts, tmax=tmax)
+        alpha, D, diameter, q_min, q_max = fit_q_range(ddm.qs, params[:, 2], job['q_min'], job['q_max'])
+
+    name = os.path.splitext(os.path.basename(job['path']))[0]
+    result_path = os.path.join(out_dir, f'{name}.npz')
+    np.savez(result_path, isf=ddm.isf, qs=ddm.qs, dts=ddm.dts, idts=idts, params=params,
+             q_range=np.array([q_min, q_max]), alpha=alpha, D=D, diameter=diameter)
+    telemetry_path = ddm.telemetry.save(os.path.join(out_dir, f'{name}.telemetry.json'))
+
+    return {'alpha': alpha, 'D': D, 'diameter': diameter, 'q_min': q_min, 'q_max': q_max,
+            'elapsed': time.perf_counter() - start, 'result': result_path, 'telemetry': telemetry_path}
+
+
+def run_batch(jobs: list, out_dir: str, max_workers: int=None, memory_limit: int=None, retries: int=1,
+              pointsPerDecade: int=60, maxNCouples: int=30, tmax=-1, threads_per_job: int=1, store=None):
+    """
+    Process a list of video jobs across a process pool and write 'summary.csv' to out_dir.
+
+    Jobs are only admitted while the sum of their estimated memory fits memory_limit,
+    so a few large videos do not run side by side and exhaust the node. A job which
+    does not fit on its own still runs, but alone. Failed jobs are retried up to
+    'retries' times and are then recorded in the summary as failed.
+
+    Args:
+        jobs: list of job dictionaries (see load_jobs)
+        out_dir: folder for per-video results and the summary table
+        max_workers: number of worker processes (defaults to the cpu count)
+        memory_limit: admission limit in bytes (defaults to 70% of physical memory)
+        retries: number of extra attempts for a failed video
+        pointsPerDecade: number of lag times per decade
+        maxNCouples: maximum number of couples averaged per lag time
+        tmax: maximum number of time points used in the ISF fit
+        threads_per_job: joblib threads used by calculate_isf inside each worker, and the cap on the
+            threads of its Numba kernels
+        store: results store (or path to one) that finished videos are appended to
+    """
+    os.makedirs(out_dir, exist_ok=True)
+    max_workers = max_workers or os.cpu_count() or 1
+    if memory_limit is None:
+        memory_limit = int(0.7 * available_memory()) or None
+
+    records = []
+    pending = []
+    for job in jobs:
+        record = {'video': job['path'], 'pixel_size': job['pixel_size'], 'particle_size': job['particle_size'],
+                  'status': 'pending', 'attempts': 0}
+        try:
+            job['memory'] = estimate_job_memory(job['path'], pointsPerDecade)
+            pending.append((job, record))
+        except Exception as error:
+            record.update(status='failed', error=str(error))
+        records.append(record)
+
+    # a store opened here from a path is closed at the end, one passed in is left open
+    opened_store = store is not None and not isinstance(store, ResultsStore)
+    if store is not None:
+        store = open_store(store)
+    run_timestamp = now()
+
+    def start_pool():
+        # workers cap their Numba kernels at threads_per_job, so together they do not oversubscribe the cores
+        return ProcessPoolExecutor(max_workers=max_workers, initializer=set_threads, initargs=(threads_per_job,))
+
+    running = {}
+    in_use = 0
+    executor = start_pool()
+    try:
+        while pending or running:
+            # admit jobs in order while they fit the memory budget
+            while pending and len(running) < max_workers:
+                job, record = pending[0]
+                fits = memory_limit is None or in_use + job['memory'] <= memory_limit
+                if not fits and running:
+                    break
+                pending.pop(0)
+                record['attempts'] += 1
+                print(f"Starting {job['path']} (attempt {record['attempts']}, ~{job['memory'] / 1e9:.2f} GB)")
+                future = executor.submit(process_video, job, out_dir, pointsPerDecade, maxNCouples, tmax, threads_per_job)
+                running[future] = (job, record)
+                in_use += job['memory']
+
+            done, _ = wait(running, return_when=FIRST_COMPLETED)
+            broken = False
+            for future in done:
+                job, record = running.pop(future)
+                in_use -= job['memory']
+                try:
+                    record.update(future.result(), status='done', error='')
+                    print(f"Finished {job['path']}: diameter = {record['diameter']:.3f} µm")
+                    if store is not None:
+                        store.append(os.path.splitext(os.path.basename(job['path']))[0], 'ddm', run_timestamp,
+                                     q_min=record['q_min'], q_max=record['q_max'], diameter=record['diameter'],
+                                     alpha=record['alpha'], D=record['D'], source=job['path'],
+                                     particle_size=job['particle_size'], pixel_size=job['pixel_size'])
+                except Exception as error:
+                    broken = broken or isinstance(error, BrokenProcessPool)
+                    message = ''.join(traceback.format_exception_only(type(error), error)).strip()
+                    if record['attempts'] <= retries:
+                        print(f"Retrying {job['path']}: {message}")
+                        pending.append((job, record))
+                    else:
+                        print(f"Skipping {job['path']}: {message}")
+                        record.update(status='failed', error=message)
+
+            # a crashed worker (e.g. killed for memory) breaks the whole pool, so start a new one
+            if broken:
+                for future, (job, record) in running.items():
+                    in_use -= job['memory']
+                    pending.append((job, record))
+                running = {}
+                executor.shutdown(wait=False, cancel_futures=True)
+                executor = start_pool()
+    finally:
+        executor.shutdown(wait=True, cancel_futures=True)
+        if opened_store:
+            store.close()
+
+    summary_filename = os.path.join(out_dir, 'summary.csv')
+    with open(summary_filename, mode='w', newline='') as file:
+        writer = csv.DictWriter(file, fieldnames=SUMMARY_FIELDS, restval='')
+        writer.writeheader()
+        writer.writerows(records)
+    print(f"Summary of {len(records)} videos has been saved to '{summary_filename}'")
+
+    return records
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Batch DDM analysis of a directory or manifest of videos.')
+    parser.add_argument('source', help='directory of videos or CSV manifest (path, pixel_size, particle_size[, q_min, q_max])')
+    parser.add_argument('--out', default='ddm_results', help='output folder')
+    parser.add_argument('--pixel-size', type=float, default=None, help='pixel size in μm (directory mode)')
+    parser.add_argument('--particle-size', type=float, default=None, help='particle size in μm (directory mode)')
+    parser.add_argument('--workers', type=int, default=None, help='number of worker processes')
+    parser.add_argument('--memory-limit', type=float, default=None, help='memory admission limit in GB')
+    parser.add_argument('--retries', type=int, default=1, help='extra attempts for failed videos')
+    parser.add_argument('--points-per-decade', type=int, default=60)
+    parser.add_argument('--max-couples', type=int, default=30)
+    parser.add_argument('--threads-per-job', type=int, default=1)
+    parser.add_argument('--store', default=None, help='results store (SQLite file) to append the results to')
+    args = parser.parse_args()
+
+    jobs = load_jobs(args.source, args.pixel_size, args.particle_size)
+    memory_limit = int(args.memory_limit * 1e9) if args.memory_limit else None
+    run_batch(jobs, args.out, max_workers=args.workers, memory_limit=memory_limit, retries=args.retries,
+              pointsPerDecade=args.points_per_decade, maxNCouples=args.max_couples,
+              threads_per_job=args.threads_per_job, store=args.store)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,485 @@
+import os
+import time
+import queue
+import socket
+import argparse
+import traceback
+import numpy as np
+from multiprocessing import Process
+from multiprocessing.managers import BaseManager
+from ddm_ensemble import merge_accumulators
+from ddm_kernels import set_threads
+
+# Distributed ISF computation. A DDM job is split into tasks (one per video, image tile and
+# shard of the lags) queued on a broker, a multiprocessing manager serving a task queue and a
+# result queue over TCP. Workers on any host connect to it, pull tasks, read the frames from
+# shared storage (a video, or better a '.npy' stack decoded once with prepare_sources and
+# memory mapped by every worker) and send back the per-lag radial sums and couple counts of
+# their task, which the coordinator merges as in ddm_ensemble.
+#
+#   python ddm_distributed.py run a.avi b.avi --pixel-size 0.1 --particle-size 1 --port 50000 --lag-shards 8
+#   python ddm_distributed.py worker coordinator-host:50000        # on every worker host
+#
+# The broker and the workers share an authentication key, from --authkey or DDM_AUTHKEY.
+# run_local does all of it on one machine, with the broker and the workers as local processes.
+
+_tasks = queue.Queue()
+_results = queue.Queue()
+
+
+def _get_tasks():
+    return _tasks
+
+
+def _get_results():
+    return _results
+
+
+class BrokerManager(BaseManager):
+    """Manager serving the task and result queues (the broker side)."""
+
+
+BrokerManager.register('tasks', callable=_get_tasks)
+BrokerManager.register('results', callable=_get_results)
+
+
+class WorkerManager(BaseManager):
+    """Client of a BrokerManager (the worker and remote coordinator side)."""
+
+
+WorkerManager.register('tasks')
+WorkerManager.register('results')
+
+
+def default_authkey() -> bytes:
+    key = os.environ.get('DDM_AUTHKEY')
+    return key.encode() if key else os.urandom(16)
+
+
+class Broker:
+    """Task broker in a background server process, listening on address."""
+    def __init__(self, address=('127.0.0.1', 0), authkey: bytes=None):
+        """
+        Args:
+            address: (host, port) to listen on, port 0 picks a free port (see self.address)
+            authkey: key workers must present (defaults to DDM_AUTHKEY, or a random key)
+        """
+        self.authkey = authkey or default_authkey()
+        self.manager = BrokerManager(address=tuple(address), authkey=self.authkey)
+        self.manager.start()
+        self.address = self.manager.address
+        self.tasks = self.manager.tasks()
+        self.results = self.manager.results()
+
+    def submit(self, tasks: list):
+        for task in tasks:
+            self.tasks.put(task)
+
+    def collect(self, n: int, timeout: float=None) -> list:
+        """Waits for n results, raises TimeoutError if no result arrives for 'timeout' seconds."""
+        results = []
+        while len(results) < n:
+            try:
+                results.append(self.results.get(timeout=timeout))
+            except queue.Empty:
+                raise TimeoutError(f'{n - len(results)} of {n} tasks unfinished after waiting {timeout} s for a result')
+        return results
+
+    def stop_workers(self, n: int):
+        """Queues one stop message per worker."""
+        for _ in range(n):
+            self.tasks.put(None)
+
+    def shutdown(self):
+        self.manager.shutdown()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.shutdown()
+
+
+# tasks
+
+def tile_shape(shape, grid) -> tuple:
+    """
+    (height, width) of the tiles of a (rows, columns) grid over an image. Every tile has the
+    same shape, so their ISFs share one q grid: the last rows and columns of an image the grid
+    does not divide are left out.
+    """
+    height, width = shape[0] // grid[0], shape[1] // grid[1]
+    if grid[0] < 1 or grid[1] < 1 or height < 2 or width < 2:
+        raise ValueError(f'A {grid[0]}x{grid[1]} tile grid does not fit {shape[0]}x{shape[1]} frames')
+    return height, width
+
+
+def tiles(shape, grid) -> list:
+    """(row start, row stop, column start, column stop) of the tiles of a (rows, columns) grid over an image."""
+    height, width = tile_shape(shape, grid)
+    return [(r * height, (r + 1) * height, c * width, (c + 1) * width)
+            for r in range(grid[0]) for c in range(grid[1])]
+
+
+def make_tasks(sources: list, idts, maxNCouples: int=1000, lag_shards: int=1, tile_grid=None, image_shape=None,
+               options: dict=None) -> list:
+    """
+    One task per source (video shard), tile (tile shard) and group of lags (lag shard).
+    The lags are dealt round robin, so every shard has short and long lags alike.
+
+    Args:
+        sources: videos or '.npy' stacks with the same frame shape
+        idts: lags (frames)
+        maxNCouples: maximum number of couples per lag
+        lag_shards: number of groups the lags are split into
+        tile_grid: (rows, columns) of tiles the images are split into, None for whole images
+        image_shape: (height, width) of the frames, needed with tile_grid
+        options: decoding options for video sources (renormalise, background, channels)
+    """
+    idts = np.asarray(idts)
+    lag_shards = max(1, min(lag_shards, idts.size))
+    tile_list = tiles(image_shape, tile_grid) if tile_grid else [None]
+    tasks = []
+    for source in sources:
+        for tile in tile_list:
+            for shard in range(lag_shards):
+                tasks.append({'id': len(tasks), 'source': source, 'tile': tile, 'idts': idts[shard::lag_shards],
+                              'maxNCouples': maxNCouples, 'options': options or {}})
+    return tasks
+
+
+_loaded = {}
+
+
+def load_frames(source: str, options: dict) -> np.ndarray:
+    """
+    Frames of a source: a '.npy' stack is memory mapped, a video is decoded. The last source is
+    kept, so a worker pulling several shards of the same video decodes it once.
+    """
+    key = (source, repr(sorted(options.items())))
+    if key not in _loaded:
+        _loaded.clear()
+        if source.endswith('.npy'):
+            _loaded[key] = np.load(source, mmap_mode='r')
+        else:
+            from ImageStack import ImageStack
+            channels = options.get('channels')
+            stack = ImageStack(source, channel=list(channels) if channels is not None else None)
+            _loaded[key] = stack.pre_load_stack(options.get('renormalise', False),
+                                                background=options.get('background', False))
+            stack.video.release()
+    return _loaded[key]
+
+
+def run_task(task: dict) -> dict:
+    """Per-lag radial sums and couple counts of one task (see DDM_Fourier.accumulate_isf)."""
+    from DDM_Fourier import DDM_Fourier
+
+    frames = load_frames(task['source'], task['options'])
+    if task['tile'] is not None:
+        r0, r1, c0, c1 = task['tile']
+        frames = frames[..., r0:r1, c0:c1]
+    # pixel size, particle size and fps only matter to the fit, done by the coordinator
+    ddm = DDM_Fourier.from_frames(frames, pixel_size=1., particle_size=1., fps=1.)
+    sums, counts = ddm.accumulate_isf(task['idts'], task['maxNCouples'], n_jobs=1)
+    return {'sums': sums, 'counts': counts, 'telemetry': ddm.report()}
+
+
+def run_worker(address, authkey: bytes=None, idle_timeout: float=None, connect_timeout: float=30.,
+               threads: int=None):
+    """
+    Pulls and runs tasks from the broker at address until it sends a stop message, shuts down,
+    or sends no task for idle_timeout seconds. Returns the number of tasks run.
+
+    Args:
+        address: (host, port) of the broker
+        authkey: key of the broker (defaults to DDM_AUTHKEY)
+        idle_timeout: seconds without a task after which the worker stops, None to wait
+        connect_timeout: seconds to keep retrying the connection to the broker
+        threads: cap on the threads of the Numba kernels, for workers sharing a host (None for every core)
+    """
+    if authkey is None:
+        if not os.environ.get('DDM_AUTHKEY'):
+            raise ValueError('A worker needs the key of its broker: pass authkey or set DDM_AUTHKEY')
+        authkey = default_authkey()
+    set_threads(threads)
+    manager = WorkerManager(address=tuple(address), authkey=authkey)
+    deadline = time.monotonic() + connect_timeout
+    while True:
+        try:
+            manager.connect()
+            break
+        except ConnectionRefusedError:
+            if time.monotonic() > deadline:
+                raise
+            time.sleep(0.2)
+    tasks, results = manager.tasks(), manager.results()
+    worker = f'{socket.gethostname()}:{os.getpid()}'
+
+    n_done = 0
+    while True:
+        try:
+            task = tasks.get(timeout=idle_timeout)
+        except queue.Empty:
+            break
+        except (EOFError, ConnectionError):
+            # the coordinator finished and shut the broker down
+            break
+        if task is None:
+            break
+        start = time.perf_counter()
+        try:
+            result = dict(run_task(task), id=task['id'])
+        except Exception:
+            result = {'id': task['id'], 'error': traceback.format_exc()}
+        result.update(worker=worker, elapsed=time.perf_counter() - start)
+        results.put(result)
+        n_done += 1
+    return n_done
+
+
+# coordinator
+
+def prepare_sources(videos: list, shared_dir: str, n_decoders: int=None, renormalise: bool=False,
+                    background: bool=False, channels=None) -> list:
+    """
+    Decodes every video once to '<shared_dir>/<name>.npy', which the workers memory map instead
+    of decoding the video for every task. Returns the paths of the stacks.
+    """
+    from ImageStack import ImageStack
+
+    os.makedirs(shared_dir, exist_ok=True)
+    paths = []
+    for video in videos:
+        path = os.path.join(shared_dir, os.path.splitext(os.path.basename(video))[0] + '.npy')
+        stack = ImageStack(video, channel=list(channels) if channels is not None else None)
+        stack.parallel_load_stack(renormalise, n_workers=n_decoders, out=path, background=background)
+        stack.video.release()
+        paths.append(path)
+    return paths
+
+
+class DistributedISF:
+    """
+    ISF of one or more videos of a sample (same frame shape and frame rate) computed by
+    distributed workers, merged over videos and tiles, every lag weighted by its couple count.
+    """
+    def __init__(self, videos: list, pixel_size: float, particle_size: float, renormalise: bool=False,
+                 background: bool=False, channels=None):
+        from ddm_ensemble import DDMEnsemble
+
+        # validates the geometry and gives the lag range and lag times of the videos
+        self.ensemble = DDMEnsemble(videos, pixel_size, particle_size, renormalise, background, channels)
+        self.videos = list(videos)
+        self.pixel_size = pixel_size
+        self.particle_size = particle_size
+        self.options = {'renormalise': renormalise, 'background': background, 'channels': channels}
+
+    def run(self, broker: Broker, idts=None, maxNCouples: int=1000, lag_shards: int=1, tile_grid=None,
+            sources: list=None, pointsPerDecade: int=60, timeout: float=None) -> np.ndarray:
+        """
+        Queues the tasks on the broker, waits for the workers and merges their sums into self.isf
+        (lags x q, channels x lags x q with channels). With a tile grid, the ISF of every tile is
+        also kept in self.tile_isf (tiles x lags x q, tiles x channels x lags x q with channels).
+
+        Args:
+            broker: Broker the workers are connected to
+            idts: lags (frames), by default log spaced over the shortest video
+            maxNCouples: maximum number of couples per lag, video and tile
+            lag_shards: number of shards the lags are split into
+            tile_grid: (rows, columns) of tiles of equal shape, each analysed as its own image
+                (self.tile_shape), leaving out the remainder rows and columns of the frames
+            sources: '.npy' stacks of the videos on shared storage (see prepare_sources), by
+                default the workers decode the videos themselves
+            pointsPerDecade: number of lags per decade when idts is not given
+            timeout: seconds to wait for a result before giving up
+        """
+        from frame_index import FrameIndex
+        from DDM_Fourier import q_values
+
+        if idts is None:
+            idts = self.ensemble.logSpaced(pointsPerDecade)
+        self.idts = np.asarray(idts)
+        sources = sources or self.videos
+        image_shape = self.ensemble.shapes[0][-2:]
+        # the shape every ISF is averaged over, which sets the q grid
+        self.tile_shape = tile_shape(image_shape, tile_grid) if tile_grid else tuple(image_shape)
+        if tile_grid:
+            cropped = (image_shape[0] % tile_grid[0], image_shape[1] % tile_grid[1])
+            if any(cropped):
+                print(f"Note: {tile_grid[0]}x{tile_grid[1]} tiles of {self.tile_shape[0]}x{self.tile_shape[1]} leave out "
+                      f"the last {cropped[0]} row(s) and {cropped[1]} column(s) of the frames")
+        tasks = make_tasks(sources, self.idts, maxNCouples, lag_shards, tile_grid, image_shape,
+                           options=self.options if sources is self.videos else {})
+
+        print(f"\nQueued {len(tasks)} tasks ({len(sources)} source(s) x "
+              f"{len(tiles(image_shape, tile_grid)) if tile_grid else 1} tile(s) x {lag_shards} lag shard(s))...")
+        broker.submit(tasks)
+        results = {result['id']: result for result in broker.collect(len(tasks), timeout)}
+        errors = [result for result in results.values() if 'error' in result]
+        if errors:
+            raise RuntimeError(f"{len(errors)} task(s) failed, the first on {errors[0]['worker']}:\n{errors[0]['error']}")
+        self.workers = sorted({result['worker'] for result in results.values()})
+
+        # reassemble the lags of every (source, tile) accumulator from its shards
+        lag_position = {idt: i for i, idt in enumerate(self.idts)}
+        accumulators = {}
+        for task in tasks:
+            result = results[task['id']]
+            key = (task['source'], task['tile'])
+            if key not in accumulators:
+                accumulators[key] = {'sums': None, 'counts': np.zeros(self.idts.size, dtype=int)}
+            positions = [lag_position[idt] for idt in task['idts']]
+            sums = np.moveaxis(result['sums'], -2, 0)
+            if accumulators[key]['sums'] is None:
+                accumulators[key]['sums'] = np.zeros((self.idts.size, *sums.shape[1:]))
+            accumulators[key]['sums'][positions] = sums
+            accumulators[key]['counts'][positions] = result['counts']
+
+        # lag times from the frame timestamps of every video
+        lag_times = {source: FrameIndex.for_video(video).lag_times(self.idts)
+                     for source, video in zip(sources, self.videos)}
+        for (source, tile), accumulator in accumulators.items():
+            accumulator['dts'] = lag_times[source]
+
+        def merged(group):
+            # lags x [channels x] q, every tile has the couples of every source so keeps the same lags
+            m = merge_accumulators([dict(a, sums=a['sums'].reshape(self.idts.size, -1)) for a in group])
+            return m['isf'].reshape(-1, *group[0]['sums'].shape[1:]), m
+
+        isf, m = merged(list(accumulators.values()))
+        self.counts = m['counts']
+        self.dts = m['dts']
+        tile_keys = sorted({tile for source, tile in accumulators}, key=lambda tile: tile or ())
+        if tile_grid:
+            self.tiles = tile_keys
+            self.tile_isf = np.array([merged([a for (source, tile), a in accumulators.items() if tile == key])[0]
+                                      for key in tile_keys])
+        if not m['kept'].all():
+            print(f"Dropped lag(s) {self.idts[~m['kept']].tolist()} without a couple in any video")
+            self.idts = self.idts[m['kept']]
+        if self.options['channels'] is not None:
+            isf = np.moveaxis(isf, 1, 0)
+            if tile_grid:
+                self.tile_isf = np.moveaxis(self.tile_isf, 2, 1)
+        self.isf = isf
+        self.qs = q_values(self.tile_shape, self.pixel_size)
+        return isf
+
+    def fit(self, q_min: float=None, q_max: float=None, tmax=-1, channel: int=None) -> dict:
+        """Fits the merged ISF once (see DDMEnsemble.fit)."""
+        ensemble = self.ensemble
+        ensemble.isf, ensemble.qs, ensemble.dts, ensemble.counts = self.isf, self.qs, self.dts, self.counts
+        return ensemble.fit(q_min, q_max, tmax, channel)
+
+
+def run_local(videos: list, pixel_size: float, particle_size: float, n_workers: int=2, shared_dir: str=None,
+              timeout: float=600., **options) -> DistributedISF:
+    """
+    Runs a distributed job on this machine: a local broker and n_workers worker processes
+    connected to it over TCP like remote workers would be.
+
+    Args:
+        videos: videos of the sample
+        pixel_size: pixel size (μm/pixel)
+        particle_size: nominal particle size (μm)
+        n_workers: number of local worker processes
+        shared_dir: decode the videos once to '.npy' stacks in this folder for the workers to
+            memory map, by default every worker decodes the videos it needs
+        timeout: seconds to wait for a result before giving up
+        options: passed to DistributedISF.run (idts, maxNCouples, lag_shards, tile_grid, ...)
+            except renormalise, background and channels which go to DistributedISF
+    """
+    decoding = {key: options.pop(key) for key in ('renormalise', 'background', 'channels') if key in options}
+    job = DistributedISF(videos, pixel_size, particle_size, **decoding)
+    sources = prepare_sources(videos, shared_dir, **decoding) if shared_dir else None
+
+    with Broker() as broker:
+        # the workers share the cores of this machine
+        threads = max(1, (os.cpu_count() or 1) // n_workers)
+        workers = [Process(target=run_worker, args=(broker.address, broker.authkey),
+                           kwargs={'threads': threads}, daemon=True)
+                   for _ in range(n_workers)]
+        for worker in workers:
+            worker.start()
+        try:
+            job.run(broker, sources=sources, timeout=timeout, **options)
+        finally:
+            broker.stop_workers(n_workers)
+            for worker in workers:
+                worker.join(timeout=10)
+                if worker.is_alive():
+                    worker.terminate()
+    return job
+
+
+def parse_address(text: str):
+    host, _, port = text.rpartition(':')
+    return host or '127.0.0.1', int(port)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Distributed DDM: a coordinator with a task broker, and workers.')
+    commands = parser.add_subparsers(dest='command', required=True)
+
+    run = commands.add_parser('run', help='queue the tasks of a job and merge the results')
+    run.add_argument('videos', nargs='+')
+    run.add_argument('--pixel-size', type=float, required=True, help='pixel size in μm')
+    run.add_argument('--particle-size', type=float, required=True, help='nominal particle size in μm')
+    run.add_argument('--host', default='0.0.0.0', help='interface the broker listens on')
+    run.add_argument('--port', type=int, default=50000)
+    run.add_argument('--authkey', default=None, help='key shared with the workers (or set DDM_AUTHKEY)')
+    run.add_argument('--local-workers', type=int, default=0, help='also start this many workers here')
+    run.add_argument('--lag-shards', type=int, default=1)
+    run.add_argument('--tiles', default=None, help='tile grid as ROWSxCOLUMNS, e.g. 2x2')
+    run.add_argument('--shared-dir', default=None, help='decode the videos once to .npy stacks here (shared storage)')
+    run.add_argument('--points-per-decade', type=int, default=60)
+    run.add_argument('--max-couples', type=int, default=30)
+    run.add_argument('--timeout', type=float, default=3600., help='seconds to wait for a result')
+    run.add_argument('--out', default=None, help="'.npz' file to save the merged ISF to")
+
+    worker = commands.add_parser('worker', help='pull and run tasks from a broker')
+    worker.add_argument('address', help='HOST:PORT of the broker')
+    worker.add_argument('--authkey', default=None, help='key shared with the broker (or set DDM_AUTHKEY)')
+    worker.add_argument('--idle-timeout', type=float, default=None, help='exit after this many seconds without a task')
+    worker.add_argument('--threads', type=int, default=None,
+                        help='cap on the threads of the Numba kernels, for several workers on one host')
+    args = parser.parse_args()
+
+    authkey = args.authkey.encode() if args.authkey else None
+    if authkey is None and not os.environ.get('DDM_AUTHKEY'):
+        # a random key cannot be shared between the broker and its workers
+        parser.error('the broker and its workers need a shared key: pass --authkey or set DDM_AUTHKEY')
+    if args.command == 'worker':
+        n_done = run_worker(parse_address(args.address), authkey, args.idle_timeout, threads=args.threads)
+        print(f"Worker finished after {n_done} task(s)")
+        return
+
+    tile_grid = tuple(int(n) for n in args.tiles.lower().split('x')) if args.tiles else None
+
+    job = DistributedISF(args.videos, args.pixel_size, args.particle_size)
+    sources = prepare_sources(args.videos, args.shared_dir) if args.shared_dir else None
+    with Broker((args.host, args.port), authkey) as broker:
+        print(f"Broker listening on {broker.address[0]}:{broker.address[1]}")
+        threads = max(1, (os.cpu_count() or 1) // max(1, args.local_workers))
+        local = [Process(target=run_worker, args=(broker.address, broker.authkey),
+                         kwargs={'threads': threads}, daemon=True)
+                 for _ in range(args.local_workers)]
+        for process in local:
+            process.start()
+        job.run(broker, maxNCouples=args.max_couples, lag_shards=args.lag_shards, tile_grid=tile_grid,
+                sources=sources, pointsPerDecade=args.points_per_decade, timeout=args.timeout)
+        broker.stop_workers(len(local))
+        for process in local:
+            process.join(timeout=10)
+    print(f"Merged {len(job.idts)} lags from {len(job.workers)} worker(s)")
+
+    result = job.fit()
+    print(f"Diameter = {result['diameter']:.3f} µm, alpha = {result['alpha']:.3f}")
+    if args.out:
+        np.savez(args.out, isf=job.isf, qs=job.qs, dts=job.dts, idts=job.idts, counts=job.counts)
+        print(f"ISF saved to '{args.out}'")
+
+
+if __name__ == '__main__':
+    main()
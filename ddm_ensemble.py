@@ -0,0 +1,207 @@
+import os
+import argparse
+import numpy as np
+from concurrent.futures import ProcessPoolExecutor
+from results_store import using_store, now
+from ddm_kernels import set_threads
+
+# One ISF from replicate videos of a sample. Every video is decoded and summed in its own
+# worker process (DDM_Fourier.accumulate_isf), only the per-lag radial sums and couple counts
+# come back, and those add up: the ensemble ISF weights every lag of every video by the
+# number of couples averaged, as if the couples had all come from one long video.
+
+
+def accumulate_video(path: str, idts, maxNCouples: int=1000, n_jobs: int=1, renormalise: bool=False,
+                     background: bool=False, channels=None) -> dict:
+    """
+    Decodes one video and returns its per-lag radial sums, couple counts and lag times.
+    Runs inside a worker process.
+    """
+    from DDM_Fourier import DDM_Fourier
+
+    # the pixel and particle sizes only matter to the fit, done once for the ensemble
+    ddm = DDM_Fourier(path, pixel_size=1., particle_size=1., renormalise=renormalise, background=background,
+                      channels=channels)
+    sums, counts = ddm.accumulate_isf(idts, maxNCouples, n_jobs=n_jobs)
+    return {'sums': sums, 'counts': counts, 'dts': ddm.lag_times(idts), 'telemetry': ddm.report()}
+
+
+def merge_accumulators(accumulators: list) -> dict:
+    """
+    Merges the results of accumulate_video into one ISF, every lag weighted by its couple count.
+    Lag times are the couple-weighted means of those of every video. Lags without a couple in
+    any video (e.g. not shorter than every video) are dropped, 'kept' is the mask of the others.
+    """
+    sums = sum(a['sums'] for a in accumulators)
+    counts = sum(a['counts'] for a in accumulators)
+    kept = counts > 0
+    if not kept.any():
+        raise ValueError('None of the lags has a couple in any of the videos.')
+    # a video too short for a lag has no couple and no lag time for it
+    dts = sum(np.where(a['counts'] > 0, a['counts'] * a['dts'], 0.) for a in accumulators)
+    return {'isf': sums[kept] / counts[kept, None], 'counts': counts[kept], 'dts': dts[kept] / counts[kept],
+            'kept': kept}
+
+
+class DDMEnsemble:
+    def __init__(self, paths: list, pixel_size: float, particle_size: float, renormalise: bool=False,
+                 background: bool=False, channels=None):
+        """
+        Replicate videos of one sample analysed as a single ISF.
+        The videos must have the same frame shape and frame rate, their lengths may differ.
+
+        Args:
+            paths: video files
+            pixel_size: pixel size (μm/pixel)
+            particle_size: nominal particle size (μm)
+            renormalise: divide every frame by its mean intensity (flicker correction)
+            background: subtract the temporal median of every pixel
+            channels: colour channels analysed together (see DDM_Fourier)
+        """
+        from ImageStack import ImageStack
+
+        if not paths:
+            raise ValueError('An ensemble needs at least one video.')
+        self.paths = list(paths)
+        self.pixel_size = pixel_size
+        self.particle_size = particle_size
+        self.options = {'renormalise': renormalise, 'background': background, 'channels': channels}
+        self.channels = channels
+
+        # geometry from the frame indexes, which the workers then reuse
+        self.shapes, self.frame_counts, self.fps_values = [], [], []
+        for path in self.paths:
+            stack = ImageStack(path, channel=list(channels) if channels is not None else None)
+            self.shapes.append(stack.shape)
+            self.frame_counts.append(stack.frame_count)
+            self.fps_values.append(stack.fps)
+            stack.video.release()
+
+        for path, shape, fps in zip(self.paths, self.shapes, self.fps_values):
+            if shape != self.shapes[0]:
+                raise ValueError(f'{path} has frames of shape {shape}, not {self.shapes[0]} like {self.paths[0]}')
+            if abs(fps - self.fps_values[0]) > 1e-3 * self.fps_values[0]:
+                raise ValueError(f'{path} runs at {fps:g} fps, not {self.fps_values[0]:g} like {self.paths[0]}')
+        self.fps = self.fps_values[0]
+        self.frame_count = min(self.frame_counts)
+
+    def logSpaced(self, pointsPerDecade: int=15):
+        """Log spaced lags (frames) available in every video of the ensemble."""
+        from DDM_Fourier import log_spaced
+
+        return log_spaced(self.frame_count, pointsPerDecade)
+
+    def calculate_isf(self, idts=None, maxNCouples: int=1000, max_workers: int=None, n_jobs: int=1,
+                      pointsPerDecade: int=60) -> np.ndarray:
+        """
+        Sums the couples of every video in parallel worker processes and merges them into one ISF
+        (self.isf, lags x q), with self.qs, self.dts and the merged couple counts in self.counts.
+
+        Args:
+            idts: lags (frames), by default log spaced over the shortest video
+            maxNCouples: maximum number of couples per lag and per video
+            max_workers: number of worker processes (defaults to the cpu count, at most one per video)
+            n_jobs: joblib threads summing the lags inside each worker, and the cap on the threads of its
+                Numba kernels
+            pointsPerDecade: number of lags per decade when idts is not given
+        """
+        from DDM_Fourier import q_values
+
+        if idts is None:
+            idts = self.logSpaced(pointsPerDecade)
+        self.idts = np.asarray(idts)
+        max_workers = max(1, min(max_workers or os.cpu_count() or 1, len(self.paths)))
+
+        print(f"\nSumming the couples of {len(self.paths)} videos in {max_workers} worker process(es)...")
+        with ProcessPoolExecutor(max_workers=max_workers, initializer=set_threads, initargs=(n_jobs,)) as executor:
+            futures = [executor.submit(accumulate_video, path, self.idts, maxNCouples, n_jobs, **self.options)
+                       for path in self.paths]
+            self.accumulators = [future.result() for future in futures]
+
+        if self.channels is not None:
+            # merge channel by channel: the sums are channels x lags x q
+            merged = [merge_accumulators([dict(a, sums=a['sums'][c]) for a in self.accumulators])
+                      for c in range(len(self.channels))]
+            self.isf = np.array([m['isf'] for m in merged])
+            merged = merged[0]
+        else:
+            merged = merge_accumulators(self.accumulators)
+            self.isf = merged['isf']
+        if not merged['kept'].all():
+            print(f"Dropped lag(s) {self.idts[~merged['kept']].tolist()} without a couple in any video")
+            self.idts = self.idts[merged['kept']]
+        self.counts = merged['counts']
+        self.dts = merged['dts']
+        self.qs = q_values(self.shapes[0], self.pixel_size)
+        return self.isf
+
+    def fit(self, q_min: float=None, q_max: float=None, tmax=-1, channel: int=None) -> dict:
+        """
+        Fits the ensemble ISF once: tau(q) at every q, then alpha, D and the diameter over [q_min, q_max].
+
+        Args:
+            q_min: lowest q (μm⁻¹) of the diffusion fit (defaults to the first non-zero q)
+            q_max: highest q (μm⁻¹) of the diffusion fit (defaults to the last q)
+            tmax: maximum number of time points used in the ISF fit
+            channel: position of the channel to fit in 'channels' (for multi-channel ensembles)
+        """
+        from DDM_Fourier import fit_isf, fit_q_range
+
+        isf = self.isf[channel] if self.channels is not None else self.isf
+        params = fit_isf(isf, self.dts, tmax=tmax)
+        alpha, D, diameter, q_min, q_max = fit_q_range(self.qs, params[:, 2], q_min, q_max)
+
+        self.params = params
+        self.result = {'alpha': alpha, 'D': D, 'diameter': diameter, 'q_min': q_min, 'q_max': q_max,
+                       'n_videos': len(self.paths), 'n_couples': int(self.counts.sum())}
+        return self.result
+
+    def save(self, path: str) -> str:
+        """Saves the ensemble ISF, its axes, counts and fit to an '.npz' file."""
+        extra = {} if not hasattr(self, 'result') else dict(params=self.params, **self.result)
+        np.savez(path, isf=self.isf, qs=self.qs, dts=self.dts, idts=self.idts, counts=self.counts,
+                 videos=np.array(self.paths), **extra)
+        return path
+
+    def save_results(self, store, sample: str, source: str=None):
+        """Appends the fit to a results store (or path to one) as method 'ddm-ensemble'."""
+        with using_store(store) as store:
+            store.append(sample, 'ddm-ensemble', now(), q_min=self.result['q_min'], q_max=self.result['q_max'],
+                         diameter=self.result['diameter'], alpha=self.result['alpha'], D=self.result['D'],
+                         source=source or os.path.commonpath([os.path.abspath(p) for p in self.paths]),
+                         n_videos=len(self.paths), particle_size=self.particle_size, pixel_size=self.pixel_size)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='One DDM fit from replicate videos of a sample.')
+    parser.add_argument('videos', nargs='+', help='replicate videos with the same frame shape and frame rate')
+    parser.add_argument('--pixel-size', type=float, required=True, help='pixel size in μm')
+    parser.add_argument('--particle-size', type=float, required=True, help='nominal particle size in μm')
+    parser.add_argument('--workers', type=int, default=None, help='number of worker processes')
+    parser.add_argument('--points-per-decade', type=int, default=60)
+    parser.add_argument('--max-couples', type=int, default=30)
+    parser.add_argument('--threads-per-video', type=int, default=1)
+    parser.add_argument('--q-min', type=float, default=None)
+    parser.add_argument('--q-max', type=float, default=None)
+    parser.add_argument('--renormalise', action='store_true', help='correct illumination flicker')
+    parser.add_argument('--out', default=None, help="'.npz' file to save the ensemble ISF and fit to")
+    parser.add_argument('--store', default=None, help='results store (SQLite file) to append the fit to')
+    parser.add_argument('--sample', default=None, help='sample name in the store (defaults to the folder name)')
+    args = parser.parse_args()
+
+    ensemble = DDMEnsemble(args.videos, args.pixel_size, args.particle_size, renormalise=args.renormalise)
+    ensemble.calculate_isf(maxNCouples=args.max_couples, max_workers=args.workers, n_jobs=args.threads_per_video,
+                           pointsPerDecade=args.points_per_decade)
+    result = ensemble.fit(args.q_min, args.q_max)
+    print(f"Ensemble of {result['n_videos']} videos ({result['n_couples']} couples): "
+          f"diameter = {result['diameter']:.3f} µm, alpha = {result['alpha']:.3f}")
+
+    if args.out:
+        print(f"ISF saved to '{ensemble.save(args.out)}'")
+    if args.store:
+        folder = os.path.dirname(os.path.abspath(args.videos[0]))
+        ensemble.save_results(args.store, args.sample or os.path.basename(folder))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,227 @@
+import os
+import types
+import importlib.util
+import threading
+import numpy as np
+from functools import lru_cache
+
+# Fused kernels of the DDM inner loop: the frame difference, the |F|² accumulation and the
+# radial binning. Numba is optional. When it is installed the loops below are compiled
+# (on first use, so importing this module stays cheap), otherwise NumPy versions that
+# work on preallocated buffers are used. Set DDM_NUMBA=0 to force the NumPy versions.
+#
+# Numba's default threading layer cannot run parallel kernels launched from several threads
+# at once, and calculate_isf calls timeAveraged from a thread pool, so worker threads get
+# serial builds that release the GIL and only the main thread uses the prange builds.
+# Worker processes sharing the cores with others cap the prange builds with set_threads.
+# The TBB threading layer (Numba's first choice when installed) hangs the process on exit
+# once it has forked, as the parallel decoders do, so the workqueue layer is used unless
+# NUMBA_THREADING_LAYER says otherwise.
+USE_NUMBA = os.environ.get('DDM_NUMBA', '1') != '0'
+
+# replaced by numba.prange before the loops are compiled
+prange = range
+
+
+def _subtract_loop(out, im1, im0):
+    for i in prange(out.shape[0]):
+        for j in range(out.shape[1]):
+            out[i, j] = np.float64(im1[i, j]) - np.float64(im0[i, j])
+
+
+def _accumulate_power_loop(acc, spectrum):
+    for i in prange(acc.shape[0]):
+        for j in range(acc.shape[1]):
+            value = spectrum[i, j]
+            acc[i, j] += value.real * value.real + value.imag * value.imag
+
+
+def _radial_sum_loop(im, bin_index, n_bins):
+    # one row of partial sums per image row, so the rows can be binned in parallel
+    n_rows = im.shape[0]
+    partial = np.zeros((n_rows, n_bins + 1))
+    for i in prange(n_rows):
+        for j in range(im.shape[1]):
+            partial[i, bin_index[i, j]] += im[i, j]
+    out = np.zeros(n_bins)
+    for i in range(n_rows):
+        for b in range(n_bins):
+            out[b] += partial[i, b]
+    return out
+
+
+LOOPS = {
+    'subtract': _subtract_loop,
+    'accumulate_power': _accumulate_power_loop,
+    'radial_sum': _radial_sum_loop,
+}
+
+
+def _serial_copy(loop):
+    # Numba's disk cache tells builds apart by qualified name, not by compile options
+    copy = types.FunctionType(loop.__code__, loop.__globals__, loop.__name__ + '_serial')
+    copy.__qualname__ = loop.__qualname__ + '_serial'
+    return copy
+
+
+# compiled kernels by build (parallel or not), filled once under the lock
+_kernels = {}
+_compile_lock = threading.Lock()
+
+
+def _compiled_once(kernel):
+    """
+    The kernel with its compiling calls, the first for every new combination of argument types,
+    made under the compile lock. Later calls with types it has seen run without the lock.
+    """
+    seen = set()
+
+    def call(*args):
+        key = tuple((a.dtype.str, a.ndim, a.flags.c_contiguous, a.flags.writeable)
+                    if isinstance(a, np.ndarray) else type(a) for a in args)
+        if key in seen:
+            return kernel(*args)
+        with _compile_lock:
+            result = kernel(*args)
+            seen.add(key)
+        return result
+    return call
+
+
+def _compile(parallel: bool):
+    kernels = _kernels.get(parallel)
+    if kernels is not None:
+        return kernels
+    # threads asking for the kernels at the same time would all build them, and concurrent
+    # compilation is unsafe with the workqueue threading layer, so only the first one does
+    # (and the compiling first calls are serialised by _compiled_once)
+    with _compile_lock:
+        if parallel not in _kernels:
+            global prange
+            import numba
+            prange = numba.prange
+            if parallel:
+                if 'NUMBA_THREADING_LAYER' not in os.environ:
+                    numba.config.THREADING_LAYER = 'workqueue'
+                jit = numba.njit(parallel=True, cache=True)
+                _kernels[parallel] = {name: _compiled_once(jit(loop)) for name, loop in LOOPS.items()}
+            else:
+                jit = numba.njit(nogil=True, cache=True)
+                _kernels[parallel] = {name: _compiled_once(jit(_serial_copy(loop))) for name, loop in LOOPS.items()}
+        return _kernels[parallel]
+
+
+@lru_cache(maxsize=None)
+def have_numba() -> bool:
+    return USE_NUMBA and importlib.util.find_spec('numba') is not None
+
+
+# threads the parallel kernels of this process may use, None for Numba's default (every core)
+_n_threads = None
+
+
+def set_threads(n_threads: int=None):
+    """
+    Caps the threads of the parallel kernels in this process, e.g. as the initializer of a
+    process pool whose workers share the cores. With 1 the main thread uses the serial kernels
+    too, so no Numba thread pool is started.
+
+    Args:
+        n_threads: maximum number of threads (None or -1 for every core)
+    """
+    global _n_threads
+    _n_threads = n_threads if n_threads is not None and n_threads > 0 else None
+
+
+def numba_kernels():
+    """
+    The compiled kernels for the calling thread as a dictionary (parallel in the main thread,
+    serial elsewhere or when set_threads allows one thread), or None if Numba is not installed
+    or disabled.
+    """
+    if not have_numba():
+        return None
+    parallel = threading.current_thread() is threading.main_thread() and _n_threads != 1
+    kernels = _compile(parallel)
+    if parallel and _n_threads is not None:
+        import numba
+        n_threads = min(_n_threads, numba.config.NUMBA_NUM_THREADS)
+        if numba.get_num_threads() != n_threads:
+            numba.set_num_threads(n_threads)
+    return kernels
+
+
+def _rows(a: np.ndarray) -> np.ndarray:
+    """
+    View of a stack of images (... x height x width) as one 2D array of rows, for the compiled
+    loops. Raises rather than copying, so writes to the view always reach the array.
+    """
+    if a.ndim == 2:
+        return a
+    view = a.view()
+    view.shape = (-1, a.shape[-1])
+    return view
+
+
+def subtract_into(out: np.ndarray, im1: np.ndarray, im0: np.ndarray) -> np.ndarray:
+    """
+    out = im1 - im0 computed in float64, cast and subtracted in one pass into the reused buffer
+    out (real or complex, a complex buffer can then be transformed in place by fft2_inplace).
+    Works on single images or stacks of them (e.g. channels x height x width).
+    """
+    kernels = numba_kernels()
+    if kernels is not None:
+        kernels['subtract'](_rows(out), _rows(np.ascontiguousarray(im1)), _rows(np.ascontiguousarray(im0)))
+    else:
+        np.subtract(im1, im0, out=out, dtype=np.float64)
+    return out
+
+
+def fft2_inplace(buffer: np.ndarray) -> np.ndarray:
+    """
+    2D FFT over the last two axes of a complex128 buffer, written back into it (NumPy < 2 cannot,
+    and returns a copy). A stack of images is transformed in one batched call.
+    """
+    try:
+        return np.fft.fft2(buffer, out=buffer)
+    except TypeError:
+        buffer[...] = np.fft.fft2(buffer)
+        return buffer
+
+
+def accumulate_power(acc: np.ndarray, spectrum: np.ndarray) -> np.ndarray:
+    """
+    acc += |spectrum|² in place, without the temporaries of np.abs(spectrum)**2.
+    The NumPy version squares the real and imaginary parts in place, so spectrum is overwritten.
+    """
+    kernels = numba_kernels()
+    if kernels is not None:
+        kernels['accumulate_power'](_rows(acc), _rows(spectrum))
+        return acc
+
+    np.square(spectrum.real, out=spectrum.real)
+    np.square(spectrum.imag, out=spectrum.imag)
+    acc += spectrum.real
+    acc += spectrum.imag
+    return acc
+
+
+def radial_bin_index(dists: np.ndarray, bins: np.ndarray) -> np.ndarray:
+    """
+    Bin of every pixel for np.histogram(dists, bins), as an int array of the shape of dists.
+    Pixels outside the bins get the extra bin len(bins) - 1, which radial_sum drops.
+    """
+    n_bins = bins.size - 1
+    index = np.searchsorted(bins, dists, side='right') - 1
+    # np.histogram includes the right edge in the last bin
+    index[dists == bins[-1]] = n_bins - 1
+    index[(index < 0) | (index >= n_bins)] = n_bins
+    return np.ascontiguousarray(index, dtype=np.intp)
+
+
+def radial_sum(im: np.ndarray, bin_index: np.ndarray, n_bins: int) -> np.ndarray:
+    """Sum of im over each radial bin in a single pass (equivalent to np.histogram with weights)."""
+    kernels = numba_kernels()
+    if kernels is not None:
+        return kernels['radial_sum'](np.ascontiguousarray(im, dtype=np.float64), bin_index, n_bins)
+    return np.bincount(bin_index.ravel(), weights=im.ravel(), minlength=n_bins + 1)[:n_bins]
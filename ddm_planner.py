@@ -0,0 +1,367 @@
+import os
+import time
+import argparse
+import tempfile
+import numpy as np
+
+# Dry-run cost model of a DDM run. From the frame count and shape of a video, the lags and the
+# couples per lag, it counts the FFTs and estimates the memory traffic, peak memory and wall
+# time of every way this code can run the ISF, with per-operation times measured by a short
+# calibration on frames of the video's shape, then picks the engine and worker count that
+# fit a memory and time budget:
+#
+#   in-memory    frames decoded into RAM, calculate_isf (keeps every lag's spectrum, gives
+#                heatmaps and sector ISFs)
+#   streaming    frames decoded into RAM, accumulate_isf (every lag is reduced to its radial
+#                profile as soon as it is summed)
+#   out-of-core  frames decoded once to a '.npy' memmap and read from it by accumulate_isf
+#
+#   python ddm_planner.py video.avi --memory 4 --time 600          # dry run
+#   python ddm_planner.py video.avi --memory 4 --run --pixel-size 0.1 --particle-size 1
+
+ENGINES = ('in-memory', 'streaming', 'out-of-core')
+
+# rows of frames median_background copies at a time (its max_bytes)
+MEDIAN_BAND_BYTES = 256e6
+
+
+def count_couples(frame_count: int, idts, maxNCouples: int) -> np.ndarray:
+    """Number of couples DDM_Fourier.timeAccumulated sums for every lag."""
+    counts = []
+    for idt in idts:
+        increment = max([(frame_count - idt) / maxNCouples, 1])
+        initialTimes = np.arange(0, frame_count - idt, increment)
+        counts.append(np.count_nonzero(initialTimes + idt <= frame_count - 1))
+    return np.array(counts, dtype=int)
+
+
+def _best_time(function, repeat: int) -> float:
+    best = np.inf
+    for _ in range(repeat):
+        start = time.perf_counter()
+        function()
+        best = min(best, time.perf_counter() - start)
+    return best
+
+
+def _in_thread(function):
+    """Result of function called in a worker thread, where ddm_kernels uses its serial kernels."""
+    from concurrent.futures import ThreadPoolExecutor
+
+    with ThreadPoolExecutor(max_workers=1) as executor:
+        return executor.submit(function).result()
+
+
+def calibrate(shape, video: str=None, channel=None, n_couples: int=4, n_frames: int=16, repeat: int=3) -> dict:
+    """
+    Microbenchmark of the operations the cost model counts, on random frames of the given
+    shape ([channels x] height x width), through the same code paths as a real run.
+    Times are the best of 'repeat' runs, in seconds per operation. The summing and radial
+    averages are timed in the main thread, as a one-worker run does them (with the parallel
+    Numba kernels), and in a worker thread, as the threads of a multi-worker run do them
+    (with the serial kernels), keyed 'thread_...'.
+
+    Args:
+        shape: frame shape, with the channel axis first for multi-channel runs
+        video: also time the sequential decoding of its first n_frames frames
+        channel: channel argument of ImageStack for the decode timing
+        n_couples: couples summed per timing
+        n_frames: frames decoded for the decode timing
+        repeat: number of timings kept the best of
+    """
+    from DDM_Fourier import DDM_Fourier, RadialAverager
+    from ddm_kernels import have_numba
+    from telemetry import current_rss
+
+    shape = tuple(shape)
+    frames = np.random.default_rng(0).random((n_couples + 1, *shape), dtype=np.float32)
+    ddm = DDM_Fourier.from_frames(frames, pixel_size=1., particle_size=1., fps=1.)
+    ra = RadialAverager(shape[-2:])
+
+    def couples_and_radial(ddm):
+        # the first call compiles the Numba kernels of the calling thread
+        total, n = ddm.timeAccumulated(1, n_couples)
+        couple_seconds = _best_time(lambda: ddm.timeAccumulated(1, n_couples), repeat) / n
+        return couple_seconds, _best_time(lambda: ra(total), repeat)
+
+    times = {}
+    times['couple_seconds'], times['radial_seconds'] = couples_and_radial(ddm)
+    times['thread_couple_seconds'], times['thread_radial_seconds'] = _in_thread(lambda: couples_and_radial(ddm))
+
+    # the same couples read from a memory mapped stack (warm page cache)
+    handle, path = tempfile.mkstemp(suffix='.npy')
+    os.close(handle)
+    try:
+        np.save(path, frames)
+        mapped = DDM_Fourier.from_frames(np.load(path, mmap_mode='r'), pixel_size=1., particle_size=1., fps=1.)
+        times['mapped_couple_seconds'] = couples_and_radial(mapped)[0]
+        times['thread_mapped_couple_seconds'] = _in_thread(lambda: couples_and_radial(mapped))[0]
+    finally:
+        os.remove(path)
+
+    decode_seconds = None
+    if video is not None:
+        from ImageStack import ImageStack
+
+        stack = ImageStack(video, channel=channel)
+        n_frames = min(n_frames, stack.frame_count)
+        start = time.perf_counter()
+        for i in range(n_frames):
+            stack[i]
+        decode_seconds = (time.perf_counter() - start) / n_frames
+        stack.video.release()
+
+    return dict(times, shape=shape, decode_seconds=decode_seconds, baseline_bytes=current_rss(),
+                n_cpus=os.cpu_count() or 1, numba=have_numba())
+
+
+def estimate(frame_count: int, shape, idts, maxNCouples: int, engine: str, n_workers: int, calibration: dict,
+             background: bool=False) -> dict:
+    """
+    Cost of one run: FFT and couple counts, approximate memory traffic (bytes), peak memory
+    (bytes, on top of the interpreter's calibration-time footprint) and wall time (s) by stage.
+    Workers are the decoder processes and the threads summing the lags, assumed to scale
+    linearly up to the cpu count. One worker sums in the main thread at the calibrated
+    main-thread cost, more workers in threads at the calibrated worker-thread cost each.
+
+    Args:
+        frame_count: number of frames of the video
+        shape: frame shape ([channels x] height x width)
+        idts: lags (frames)
+        maxNCouples: maximum number of couples per lag
+        engine: one of ENGINES
+        n_workers: decoder processes and summing threads
+        calibration: per-operation times from calibrate
+        background: the run subtracts the temporal median background
+    """
+    if engine not in ENGINES:
+        raise ValueError(f"Unknown engine '{engine}', expected one of {ENGINES}")
+    pixels = int(np.prod(shape))
+    n_lags = len(idts)
+    couples = int(count_couples(frame_count, idts, maxNCouples).sum())
+    # channels are transformed in one batched FFT per couple
+    n_channels = pixels // int(np.prod(shape[-2:]))
+    speedup = max(1, min(n_workers, calibration['n_cpus']))
+    threads = max(1, min(n_workers, n_lags))
+
+    stack_bytes = frame_count * pixels * 4
+    # the float64 sum and the complex128 transform buffer of every thread
+    thread_bytes = threads * pixels * 24
+    background_bytes = pixels * 4 + min(MEDIAN_BAND_BYTES, stack_bytes) if background else 0
+    if engine == 'in-memory':
+        # calculate_isf keeps the float64 time averaged spectrum of every lag
+        peak = stack_bytes + n_lags * pixels * 8 + thread_bytes + background_bytes
+    elif engine == 'streaming':
+        peak = stack_bytes + thread_bytes + background_bytes
+    else:
+        # the stack stays on disk, each thread holds the two frames of its couple; the mapped
+        # pages read show in the RSS but are clean page cache the OS evicts under pressure
+        peak = thread_bytes + threads * pixels * 8 + background_bytes
+
+    # per couple: two float32 frames read, the complex buffer written by the subtraction, read
+    # and written by the FFT and read by the accumulation, the float64 sum read and written
+    couple_traffic = pixels * (2*4 + 4*16 + 2*8)
+    traffic = stack_bytes + couples * couple_traffic + n_lags * pixels * 8
+    if engine == 'out-of-core':
+        # the stack is written to disk and every couple's frames read back from it
+        traffic += stack_bytes
+
+    decode = frame_count * (calibration['decode_seconds'] or 0) / speedup
+    # joblib runs a single job in the calling thread, several in worker threads
+    prefix = 'thread_' if threads > 1 else ''
+    couple_seconds = calibration[prefix + ('mapped_couple_seconds' if engine == 'out-of-core' else 'couple_seconds')]
+    summing = couples * couple_seconds / min(speedup, threads)
+    radial = n_lags * n_channels * calibration[prefix + 'radial_seconds'] / min(speedup, threads)
+    return {'engine': engine, 'n_workers': n_workers, 'lags': n_lags, 'couples': couples,
+            'ffts': couples * n_channels, 'bytes_moved': traffic, 'peak_memory': peak,
+            'wall_time': decode + summing + radial, 'stages': {'decode': decode, 'couples': summing, 'radial': radial}}
+
+
+def plan(video: str, pointsPerDecade: int=60, maxNCouples: int=1000, idts=None, memory_budget: float=None,
+         time_budget: float=None, max_workers: int=None, channels=None, renormalise: bool=False,
+         background: bool=False, calibration: dict=None) -> dict:
+    """
+    Picks how to run the ISF of a video within a memory and time budget, without running it.
+    The first engine of ENGINES that fits the memory budget is used (in-memory gives the most,
+    out-of-core needs the least), with the fewest workers meeting the time budget, or the most
+    that fit in memory when there is none. If no plan meets the time budget, the fastest that
+    fits is kept and the largest maxNCouples that would meet it is suggested.
+
+    Args:
+        video: path to the video
+        pointsPerDecade: lags per decade when idts is not given
+        maxNCouples: maximum number of couples per lag
+        idts: lags (frames), log spaced by default
+        memory_budget: bytes the run may use (defaults to 70% of physical memory)
+        time_budget: seconds the run may take (None for as fast as memory allows)
+        max_workers: largest worker count considered (defaults to the cpu count)
+        channels: colour channels analysed together (see DDM_Fourier)
+        renormalise: the run corrects illumination flicker
+        background: the run subtracts the temporal median background
+        calibration: result of calibrate to reuse, measured on the video's frames if not given
+    """
+    from ImageStack import ImageStack
+    from DDM_Fourier import log_spaced
+    from ddm_batch import available_memory
+
+    stack = ImageStack(video, channel=list(channels) if channels is not None else None)
+    frame_count, shape = stack.frame_count, stack.shape
+    stack.video.release()
+
+    idts = np.asarray(idts) if idts is not None else log_spaced(frame_count, pointsPerDecade)
+    if memory_budget is None:
+        memory_budget = int(0.7 * available_memory()) or np.inf
+    if calibration is None:
+        print(f"Calibrating on {shape} frames...")
+        calibration = calibrate(shape, video, channel=list(channels) if channels is not None else None)
+    max_workers = max(1, max_workers or calibration['n_cpus'])
+    # the interpreter, modules and the calibration frames are already resident
+    headroom = memory_budget - calibration['baseline_bytes']
+
+    def cost(engine, n_workers, couples=maxNCouples):
+        return estimate(frame_count, shape, idts, couples, engine, n_workers, calibration, background)
+
+    candidates = [cost(engine, n) for engine in ENGINES for n in range(1, max_workers + 1)]
+    fitting = [c for c in candidates if c['peak_memory'] <= headroom]
+    if not fitting:
+        smallest = min(candidates, key=lambda c: c['peak_memory'])
+        raise ValueError(f"No engine fits {memory_budget / 1e9:.2f} GB: the smallest run ({smallest['engine']}) "
+                         f"needs ~{(smallest['peak_memory'] + calibration['baseline_bytes']) / 1e9:.2f} GB")
+
+    engine = next(engine for engine in ENGINES if any(c['engine'] == engine for c in fitting))
+    options = [c for c in fitting if c['engine'] == engine]
+    timely = [c for c in fitting if time_budget is None or c['wall_time'] <= time_budget]
+    suggested = None
+    if time_budget is None:
+        chosen = min(options, key=lambda c: (c['wall_time'], c['n_workers']))
+    elif timely:
+        # the most capable engine meeting the time budget, with as few workers as possible
+        engine = next(engine for engine in ENGINES if any(c['engine'] == engine for c in timely))
+        chosen = min((c for c in timely if c['engine'] == engine), key=lambda c: c['n_workers'])
+    else:
+        chosen = min(fitting, key=lambda c: c['wall_time'])
+        # fewer couples per lag: the largest maxNCouples meeting the time budget, if any
+        low, high = 0, maxNCouples
+        while low < high:
+            middle = (low + high + 1) // 2
+            if cost(chosen['engine'], chosen['n_workers'], middle)['wall_time'] <= time_budget:
+                low = middle
+            else:
+                high = middle - 1
+        suggested = low or None
+
+    return {'video': video, 'engine': chosen['engine'], 'n_workers': chosen['n_workers'], 'idts': idts,
+            'maxNCouples': maxNCouples, 'estimate': chosen, 'candidates': candidates,
+            'memory_budget': memory_budget, 'time_budget': time_budget,
+            'meets_time': time_budget is None or chosen['wall_time'] <= time_budget,
+            'suggested_maxNCouples': suggested, 'frame_count': frame_count, 'shape': shape,
+            'calibration': calibration,
+            'options': {'channels': channels, 'renormalise': renormalise, 'background': background}}
+
+
+def execute(plan: dict, pixel_size: float, particle_size: float, shared_dir: str=None):
+    """
+    Runs a plan and returns its DDM_Fourier with self.isf, self.qs and self.dts set as by calculate_isf.
+
+    Args:
+        plan: result of plan
+        pixel_size: pixel size (μm/pixel)
+        particle_size: nominal particle size (μm)
+        shared_dir: folder to keep the '.npy' stack of an out-of-core run in (as '<video>.npy'),
+            by default a temporary file removed after the run (the DDM_Fourier then has no frames)
+    """
+    from DDM_Fourier import DDM_Fourier, q_values
+    from ImageStack import ImageStack
+
+    options = plan['options']
+    n_workers, idts, maxNCouples = plan['n_workers'], plan['idts'], plan['maxNCouples']
+    if plan['engine'] == 'in-memory':
+        ddm = DDM_Fourier(plan['video'], pixel_size, particle_size, n_decoders=n_workers, **options)
+        ddm.calculate_isf(idts, maxNCouples, n_jobs=n_workers)
+        return ddm
+
+    if plan['engine'] == 'streaming':
+        ddm = DDM_Fourier(plan['video'], pixel_size, particle_size, n_decoders=n_workers, **options)
+        sums, counts = ddm.accumulate_isf(idts, maxNCouples, n_jobs=n_workers)
+    else:
+        channels = options['channels']
+        stack = ImageStack(plan['video'], channel=list(channels) if channels is not None else None)
+        temporary = shared_dir is None
+        if temporary:
+            handle, path = tempfile.mkstemp(suffix='.npy')
+            os.close(handle)
+        else:
+            path = os.path.join(shared_dir, os.path.splitext(os.path.basename(plan['video']))[0] + '.npy')
+        frames = ddm = None
+        try:
+            frames = stack.parallel_load_stack(options['renormalise'], n_workers=n_workers, out=path,
+                                               background=options['background'])
+            ddm = DDM_Fourier.from_frames(frames, pixel_size, particle_size, stack.fps, channels)
+            # keep the video for the lag times from its frame timestamps
+            ddm.stack = stack
+            sums, counts = ddm.accumulate_isf(idts, maxNCouples, n_jobs=n_workers)
+        finally:
+            if temporary:
+                # a temporary stack is not kept: drop the mapping and remove its file
+                del frames
+                if ddm is not None:
+                    ddm.frames = None
+                os.remove(path)
+
+    ddm.isf = sums / counts[:, None]
+    ddm.qs = q_values(plan['shape'], pixel_size)
+    ddm.dts = ddm.lag_times(idts)
+    return ddm
+
+
+def format_plan(plan: dict) -> str:
+    """The fastest run of every engine and the chosen plan, as a table."""
+    lines = [f"{plan['video']}: {plan['frame_count']} frames of {plan['shape']}, {len(plan['idts'])} lags, "
+             f"at most {plan['maxNCouples']} couples per lag",
+             f"{'engine':<12} {'workers':>7} {'FFTs':>9} {'moved (GB)':>11} {'peak (GB)':>10} {'time (s)':>9}"]
+    for engine in ENGINES:
+        best = min((c for c in plan['candidates'] if c['engine'] == engine), key=lambda c: c['wall_time'])
+        lines.append(f"{engine:<12} {best['n_workers']:>7} {best['ffts']:>9} {best['bytes_moved'] / 1e9:>11.2f} "
+                     f"{best['peak_memory'] / 1e9:>10.2f} {best['wall_time']:>9.1f}")
+    chosen = plan['estimate']
+    budget = f"{plan['memory_budget'] / 1e9:.2f} GB" + (f", {plan['time_budget']:g} s" if plan['time_budget'] else '')
+    lines.append(f"Plan within {budget}: {chosen['engine']} with {chosen['n_workers']} worker(s), "
+                 f"~{chosen['peak_memory'] / 1e9:.2f} GB and ~{chosen['wall_time']:.1f} s")
+    if not plan['meets_time']:
+        lines.append("Warning: no run fits the time budget" + (
+            f", maxNCouples={plan['suggested_maxNCouples']} would" if plan['suggested_maxNCouples'] else ''))
+    return '\n'.join(lines)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Estimate the cost of a DDM run and pick how to run it.')
+    parser.add_argument('video')
+    parser.add_argument('--points-per-decade', type=int, default=60)
+    parser.add_argument('--max-couples', type=int, default=30)
+    parser.add_argument('--memory', type=float, default=None, help='memory budget in GB (defaults to 70%% of RAM)')
+    parser.add_argument('--time', type=float, default=None, help='time budget in seconds')
+    parser.add_argument('--workers', type=int, default=None, help='largest worker count considered')
+    parser.add_argument('--renormalise', action='store_true', help='correct illumination flicker')
+    parser.add_argument('--background', action='store_true', help='subtract the temporal median background')
+    parser.add_argument('--run', action='store_true', help='run the plan after printing it')
+    parser.add_argument('--pixel-size', type=float, default=None, help='pixel size in μm (with --run)')
+    parser.add_argument('--particle-size', type=float, default=None, help='nominal particle size in μm (with --run)')
+    args = parser.parse_args()
+    if args.run and (args.pixel_size is None or args.particle_size is None):
+        parser.error('--run needs --pixel-size and --particle-size')
+
+    chosen = plan(args.video, args.points_per_decade, args.max_couples,
+                  memory_budget=args.memory * 1e9 if args.memory else None, time_budget=args.time,
+                  max_workers=args.workers, renormalise=args.renormalise, background=args.background)
+    print(format_plan(chosen))
+
+    if args.run:
+        start = time.perf_counter()
+        ddm = execute(chosen, args.pixel_size, args.particle_size)
+        report = ddm.report()
+        print(f"Ran in {time.perf_counter() - start:.1f} s (estimated {chosen['estimate']['wall_time']:.1f} s), "
+              f"peak RSS {report['memory']['peak_rss'] / 1e9:.2f} GB")
+
+
+if __name__ == '__main__':
+    main()
@@ -1,19 +1,26 @@
 import numpy as np
-import matplotlib.pyplot as plt
-from scipy.signal import butter, filtfilt
-from scipy import stats
 import os
 import re
 import csv
+from itertools import repeat
+from concurrent.futures import ProcessPoolExecutor
+from dls_correlation import autocorrelation, block_autocorrelation
+from dls_prn import load_prn, read_prn_header
+from dls_fit import fit_exponential, fit_cumulant, exponential_model, cumulant_model
+from signal_conditioning import notch_filter
+from results_store import using_store, now
+from plot_queue import default_queue, show_figure
 
 kB = 1.38e-23
 visc = 8.9e-4
 T = 300
+WAVELENGTH = 635e-9  # laser wavelength (m)
 
 class DLS:
-    def __init__(self, dir: str, noise_freq: float=100.):
+    def __init__(self, dir: str, noise_freq: float=100., n_harmonics: int=1):
         self.dir = dir
         self.noise_freq = noise_freq
+        self.n_harmonics = n_harmonics
         self.tau_vals = []
 
         self.relative_q_errors = {
@@ -26,13 +33,16 @@ class DLS:
             '50.0': 0.019
         }
 
-        # set sampling frequency
-        for entry in os.scandir(dir):
-            if entry.is_file():
-                filename = entry.path
-                data = np.loadtxt(filename, delimiter='\t', skiprows=3)
-                self.sample_freq = 1000 / (data[1, 0] - data[0, 0])
-                break
+        # set sampling frequency from the first rows of the first file
+        for filename in self.prn_files():
+            self.sample_freq = read_prn_header(filename)['sample_freq']
+            break
+
+    def prn_files(self):
+        """
+        Paths of the .prn files in the directory (skips the binary cache sidecars)
+        """
+        return [entry.path for entry in os.scandir(self.dir) if entry.is_file() and entry.name.endswith('.prn')]
     
     def extract_degree_from_filename(self, filename: str):
         """
@@ -44,79 +54,246 @@ class DLS:
         else:
             return None
     
-    def AutoCorrelation(self, lin_range: int=30, exp_range: int=500):
+    def load_filtered(self, filename: str):
+        """
+        Loads a .prn file and removes the mains noise from the voltage.
+        Returns (t, voltage_filtered).
+        """
+        data = load_prn(filename)
+        t = data[:, 0]
+        voltage = data[:, 1]
+
+        # remove the mains noise (and its harmonics) with a cached bandstop design
+        voltage_filtered = notch_filter(voltage, self.sample_freq, self.noise_freq, self.n_harmonics)
+
+        return t, voltage_filtered
+
+    def fit_log_acf(self, ac: np.ndarray, lin_range: int=30):
+        """
+        Fits a straight line to the logarithm of the first lin_range points of the autocorrelation.
+        Returns (tau, tau_error, slope, intercept).
         """
+        from scipy import stats
+
+        x = np.arange(lin_range)
+        y = np.log(ac[:lin_range])
+
+        slope, intercept, r_value, p_value, std_err = stats.linregress(x, y)
+        tau = -2 / slope
+
+        # calculate error in tau from std
+        tau_error = abs(2 / slope**2) * std_err
+
+        return tau, tau_error, slope, intercept
+
+    def size_from_tau(self, degree: str, tau: float, tau_error: float):
+        """
+        Converts tau (ms) measured at the given angle to a particle size and its error, both in μm.
+        """
+        relative_q_error = self.relative_q_errors[degree]
+        q = (4 * np.pi * np.sin(np.radians(float(degree)) / 2)) / WAVELENGTH
+
+        # tau is in ms, calculating a in m first, convert to μm after
+        particle_size = (kB * T * tau * 1e-3 * q**2) / (3 * np.pi * visc)
+
+        size_error = np.sqrt((tau_error / tau)**2 + (2 * relative_q_error)**2) * particle_size
+
+        return particle_size * 1e6, size_error * 1e6
+
+    def process_file(self, filename: str, lin_range: int=30, exp_range: int=500, fit_range: int=0) -> dict:
+        """
+        Runs the filter -> autocorrelation -> fit chain for one file and returns the results.
+        Does not plot, so it can run in a worker process.
+
         Args:
+            filename: path to the .prn file
             lin_range: number of points to use for linear plot
             exp_range: number of points to use for exponential plot
+            fit_range: number of points kept for a later nonlinear fit
+        """
+        t, voltage_filtered = self.load_filtered(filename)
+
+        # perform autocorrelation (only the lags used for fitting and plotting)
+        ac = autocorrelation(voltage_filtered, max_lag=max(lin_range, exp_range, fit_range))
+
+        # fit logarithm of autocorrelation for tau
+        tau, tau_error, slope, intercept = self.fit_log_acf(ac, lin_range)
+
+        # extract degree from the filename
+        degree = self.extract_degree_from_filename(filename)
+        particle_size, size_error = self.size_from_tau(degree, tau, tau_error)
+
+        return {
+            'filename': filename,
+            'degree': degree,
+            'tau': tau,
+            'tau_error': tau_error,
+            'particle_size': particle_size,
+            'size_error': size_error,
+            'slope': slope,
+            'intercept': intercept,
+            't': np.array(t[:exp_range]),
+            'ac': ac,
+        }
+
+    def fit_figures(self, result: dict, lin_range: int=30, exp_range: int=500, plot_dir: str=None) -> list:
         """
-        for entry in os.scandir(self.dir):
-            if entry.is_file():
-                filename = entry.path
-                
-                data = np.loadtxt(filename, delimiter='\t', skiprows=3)
-                t = data[:, 0]
-                voltage = data[:, 1]
-
-                # create bandstop filter
-                b, a = butter(2, [self.noise_freq - 1, self.noise_freq + 1], btype='bandstop', fs=self.sample_freq)
-                voltage_filtered = filtfilt(b, a, voltage)
-
-                # perform autocorrelation
-                N = len(voltage_filtered)
-                ac = np.zeros(N-1)
-                m = np.mean(voltage_filtered)
-
-                for j in range(1, N):
-                    ac[j-1] = np.mean((voltage_filtered[0:N-j] - m) * (voltage_filtered[j:N] - m))
-
-                # fit logarithm of autocorrelation for tau
-                x = np.arange(lin_range)
-                y = np.log(ac[:lin_range])
-
-                slope, intercept, r_value, p_value, std_err = stats.linregress(x, y)
-                tau = -2 / slope
-
-                # calculate error in tau from std
-                tau_error = abs(2 / slope**2) * std_err
-
-                degree = self.extract_degree_from_filename(filename)
-                relative_q_error = self.relative_q_errors[degree]
-                q = (4 * np.pi * np.sin(np.radians(float(degree)) / 2)) / (635e-9)
-
-                # tau is in ms, calculating a in m first, convert to μm after
-                particle_size = (kB * T * tau * 1e-3 * q**2) / (3 * np.pi * visc)
-
-                size_error = np.sqrt((tau_error / tau)**2 + (2 * relative_q_error)**2) * particle_size
-
-                # extract degree from the filename
-                degree = self.extract_degree_from_filename(filename)
-                if degree is not None:
-                    self.tau_vals.append((degree, tau, tau_error, particle_size * 1e6, size_error * 1e6))
-
-                # plot results on log scale
-                plt.figure(figsize=(10, 6))
-                plt.semilogy(x, ac[:lin_range], 'ro', label='Exp data:')
-                plt.plot(x, np.exp(slope * x + intercept), linewidth=2, label='Fit - exp(-t/τ)')
-                plt.text(2, 0.5, f"$\\tau = {tau:.3f}$", fontsize=12, color='blue')
-                plt.xlabel(r'Time [ms]', fontsize=14)
-                plt.ylabel(r'$C(t)\ [V^2]$', fontsize=14)
-                plt.legend(loc='best', fontsize=14)
-                plt.title(f'Correlation function with Exponential Fit (Semi-Log scale): {degree}°', fontsize=14)
-                
-                plt.show()
-                
-                # plot results on linear scale
-                plt.figure(figsize=(10, 6))
-                plt.plot(t[:exp_range], ac[:exp_range], 'ro', markersize=3, label='Exp data')
-                plt.plot(t[:exp_range], np.exp(slope * t[:exp_range] + intercept), linewidth=2, label='Fit - exp(-t/τ)')
-                plt.text(0.1, 0.2, f"$\\tau = {tau:.3f}$", fontsize=12, color='blue')
-                plt.xlabel(r'Time [ms]', fontsize=14)
-                plt.ylabel(r'$C(t)\ [V^2]$', fontsize=14)
-                plt.legend(loc='best', fontsize=14)
-                plt.title(f'Correlation function with Exponential Fit (Linear scale): {degree}°', fontsize=14)
-                
-                plt.show()
+        Figure specs (see plot_queue) of the autocorrelation and its exponential fit for one file,
+        on log and linear scales. With plot_dir the specs get PNG paths inside it.
+        """
+        x = np.arange(lin_range)
+        t, ac = result['t'], result['ac']
+        slope, intercept = result['slope'], result['intercept']
+        tau, degree = result['tau'], result['degree']
+
+        # fitted curves, from the log-linear fit unless a nonlinear fit replaced it
+        if 'fit' in result:
+            model = exponential_model if result['fit'] == 'exponential' else cumulant_model
+            log_fit = model(result['fit_params'], x)[0]
+            lin_fit = model(result['fit_params'], np.arange(t[:exp_range].size))[0]
+        else:
+            log_fit = np.exp(slope * x + intercept)
+            lin_fit = np.exp(slope * t[:exp_range] + intercept)
+
+        # results on log scale
+        log_scale = {
+            'figsize': (10, 6),
+            'fontsize': 14,
+            'calls': [
+                ('semilogy', (x, ac[:lin_range], 'ro'), {'label': 'Exp data:'}),
+                ('plot', (x, log_fit), {'linewidth': 2, 'label': 'Fit - exp(-t/τ)'}),
+                ('text', (2, 0.5, f"$\\tau = {tau:.3f}$"), {'fontsize': 12, 'color': 'blue'}),
+            ],
+            'xlabel': r'Time [ms]',
+            'ylabel': r'$C(t)\ [V^2]$',
+            'legend': {'loc': 'best', 'fontsize': 14},
+            'title': f'Correlation function with Exponential Fit (Semi-Log scale): {degree}°',
+        }
+
+        # results on linear scale
+        linear_scale = {
+            'figsize': (10, 6),
+            'fontsize': 14,
+            'calls': [
+                ('plot', (t[:exp_range], ac[:exp_range], 'ro'), {'markersize': 3, 'label': 'Exp data'}),
+                ('plot', (t[:exp_range], lin_fit), {'linewidth': 2, 'label': 'Fit - exp(-t/τ)'}),
+                ('text', (0.1, 0.2, f"$\\tau = {tau:.3f}$"), {'fontsize': 12, 'color': 'blue'}),
+            ],
+            'xlabel': r'Time [ms]',
+            'ylabel': r'$C(t)\ [V^2]$',
+            'legend': {'loc': 'best', 'fontsize': 14},
+            'title': f'Correlation function with Exponential Fit (Linear scale): {degree}°',
+        }
+
+        if plot_dir is not None:
+            log_scale['path'] = os.path.join(plot_dir, f'{degree}deg_acf_semilog.png')
+            linear_scale['path'] = os.path.join(plot_dir, f'{degree}deg_acf_linear.png')
+        return [log_scale, linear_scale]
+
+    def plot_fit(self, result: dict, lin_range: int=30, exp_range: int=500):
+        """
+        Plots the autocorrelation and its exponential fit for one file on log and linear scales.
+        """
+        for spec in self.fit_figures(result, lin_range, exp_range):
+            show_figure(spec)
+
+    def refit(self, results: list, fit: str='exponential', fit_range: int=30, fit_start: int=0):
+        """
+        Replaces the log-linear tau of every result by a nonlinear fit over lags [fit_start, fit_range).
+        All angles are fitted together in one batched solve.
+
+        Args:
+            results: per-file results from process_file
+            fit: 'exponential' for A exp(-2t/τ) + B, 'cumulant' for the second order cumulant fit
+            fit_range: end of the lag window used in the fit
+            fit_start: start of the lag window used in the fit
+        """
+        acfs = np.array([result['ac'][:fit_range] for result in results])
+        if fit == 'exponential':
+            fitted = fit_exponential(acfs, window=(fit_start, fit_range))
+        elif fit == 'cumulant':
+            fitted = fit_cumulant(acfs, window=(fit_start, fit_range))
+        else:
+            raise ValueError(f"Unknown fit '{fit}', expected 'linear', 'exponential' or 'cumulant'.")
+
+        for i, result in enumerate(results):
+            tau, tau_error = fitted['tau'][i], fitted['tau_error'][i]
+            particle_size, size_error = self.size_from_tau(result['degree'], tau, tau_error)
+            result.update(tau=tau, tau_error=tau_error, particle_size=particle_size, size_error=size_error,
+                          fit=fit, fit_params=fitted['params'][i])
+
+    def save_results(self, results: list, store, method: str='dls', sample: str=None):
+        """
+        Appends per-angle results to a results store (a ResultsStore or the path of one),
+        all under one run timestamp. The sample defaults to the name of the directory.
+        """
+        sample = sample or os.path.basename(os.path.normpath(self.dir))
+        run_timestamp = now()
+        with using_store(store) as store:
+            store.append_many([{
+                'sample': sample,
+                'method': method,
+                'run_timestamp': run_timestamp,
+                'angle': float(result['degree']),
+                'tau': result['tau'],
+                'tau_error': result['tau_error'],
+                'diameter': result['particle_size'],
+                'diameter_error': result['size_error'],
+                'source': result['filename'],
+            } for result in results])
+
+    def AutoCorrelation(self, lin_range: int=30, exp_range: int=500, n_jobs: int=1, plot: bool=True,
+                        fit: str='linear', fit_range: int=None, fit_start: int=0, store=None, sample: str=None,
+                        plot_dir: str=None):
+        """
+        Args:
+            lin_range: number of points to use for linear plot
+            exp_range: number of points to use for exponential plot
+            n_jobs: number of worker processes for the per-file computation (-1 for all cores)
+            plot: show the fit plots once every file has been processed
+            fit: 'linear' (fit to log of the first lin_range points), 'exponential' or 'cumulant'
+            fit_range: end of the lag window for the nonlinear fits (defaults to lin_range)
+            fit_start: start of the lag window for the nonlinear fits
+            store: results store (or path to one) to append the results to
+            sample: sample name in the store (defaults to the directory name)
+            plot_dir: render the fit plots to PNGs in this folder in the background instead of
+                showing them (wait for them with plot_queue.wait_figures())
+        """
+        filenames = self.prn_files()
+        fit_range = fit_range or lin_range
+
+        # each file is independent, so the compute phase can run across a process pool
+        if n_jobs == 1 or len(filenames) < 2:
+            results = [self.process_file(filename, lin_range, exp_range, fit_range) for filename in filenames]
+        else:
+            max_workers = None if n_jobs == -1 else n_jobs
+            with ProcessPoolExecutor(max_workers=max_workers) as executor:
+                results = list(executor.map(self.process_file, filenames, repeat(lin_range), repeat(exp_range),
+                                            repeat(fit_range)))
+
+        # gather in order of angle so the output does not depend on scheduling or directory order
+        results.sort(key=lambda result: float(result['degree']))
+
+        # nonlinear fits of all angles in one batch
+        if fit != 'linear' and results:
+            self.refit(results, fit, fit_range, fit_start)
+
+        if store is not None:
+            self.save_results(results, store, 'dls' if fit == 'linear' else f'dls-{fit}', sample)
+
+        for result in results:
+            self.tau_vals.append((result['degree'], result['tau'], result['tau_error'],
+                                  result['particle_size'], result['size_error']))
+
+        # plotting is deferred until all the numerical work is finished
+        if plot and plot_dir is not None:
+            queue = default_queue()
+            for result in results:
+                for spec in self.fit_figures(result, lin_range, exp_range, plot_dir):
+                    queue.submit(spec)
+        elif plot:
+            for result in results:
+                self.plot_fit(result, lin_range, exp_range)
 
         dir_name = os.path.basename(self.dir)
         csv_filename = f"{dir_name}_taus.csv"
@@ -128,6 +305,92 @@ class DLS:
             writer.writerows(self.tau_vals)
         print(f"Tau values and errors have been saved to '{csv_filename}'")
 
+    def process_file_blocks(self, filename: str, n_blocks: int=8, lin_range: int=30, workers: int=-1) -> dict:
+        """
+        Splits one trace into n_blocks blocks, fits tau in every block and in their ensemble
+        average, and estimates the error on tau from the scatter between blocks.
+
+        Args:
+            filename: path to the .prn file
+            n_blocks: number of blocks to split the trace into
+            lin_range: number of points to use for the fit
+            workers: number of threads for the batched block FFT (-1 for all cores)
+        """
+        t, voltage_filtered = self.load_filtered(filename)
+
+        # autocorrelation of every block in one batched FFT
+        block_ac = block_autocorrelation(voltage_filtered, n_blocks, max_lag=lin_range, workers=workers)
+
+        # fit each block, blocks whose ACF goes negative in the fit range cannot be fitted
+        block_taus = np.array([self.fit_log_acf(ac, lin_range)[0] for ac in block_ac if np.all(ac[:lin_range] > 0)])
+
+        # ensemble tau from the mean block autocorrelation
+        tau, fit_error, slope, intercept = self.fit_log_acf(block_ac.mean(axis=0), lin_range)
+
+        # standard error of tau from the spread of the block fits
+        if block_taus.size > 1:
+            tau_error = np.std(block_taus, ddof=1) / np.sqrt(block_taus.size)
+        else:
+            tau_error = np.nan
+
+        degree = self.extract_degree_from_filename(filename)
+        particle_size, size_error = self.size_from_tau(degree, tau, tau_error)
+
+        return {
+            'filename': filename,
+            'degree': degree,
+            'tau': tau,
+            'tau_error': tau_error,
+            'fit_error': fit_error,
+            'block_taus': block_taus,
+            'particle_size': particle_size,
+            'size_error': size_error,
+        }
+
+    def BlockAutoCorrelation(self, n_blocks: int=8, lin_range: int=30, n_jobs: int=1, store=None, sample: str=None):
+        """
+        Fits tau per block and for the ensemble of blocks of every file, and saves the
+        ensemble tau with its block standard error to '<dir>_block_taus.csv'.
+
+        Args:
+            n_blocks: number of blocks to split each trace into
+            lin_range: number of points to use for the fit
+            n_jobs: number of worker processes for the per-file computation (-1 for all cores)
+            store: results store (or path to one) to append the results to
+            sample: sample name in the store (defaults to the directory name)
+        """
+        filenames = self.prn_files()
+
+        if n_jobs == 1 or len(filenames) < 2:
+            results = [self.process_file_blocks(filename, n_blocks, lin_range) for filename in filenames]
+        else:
+            # one FFT thread per worker, the files already keep the cores busy
+            max_workers = None if n_jobs == -1 else n_jobs
+            with ProcessPoolExecutor(max_workers=max_workers) as executor:
+                results = list(executor.map(self.process_file_blocks, filenames, repeat(n_blocks),
+                                            repeat(lin_range), repeat(1)))
+
+        results.sort(key=lambda result: float(result['degree']))
+        self.block_tau_vals = [(result['degree'], result['tau'], result['tau_error'], result['fit_error'],
+                                result['block_taus'].size, result['particle_size'], result['size_error'])
+                               for result in results]
+
+        if store is not None:
+            self.save_results(results, store, 'dls-block', sample)
+
+        dir_name = os.path.basename(self.dir)
+        csv_filename = f"{dir_name}_block_taus.csv"
+
+        # save ensemble tau values and block errors to csv
+        with open(csv_filename, mode='w', newline='') as file:
+            writer = csv.writer(file)
+            writer.writerow([' Degree ° ', ' τ (ms) ', ' Δτ (blocks) ', ' Δτ (fit) ', ' Blocks ', ' a (μm) ', ' Δa '])
+            writer.writerows(self.block_tau_vals)
+        print(f"Block tau values and errors have been saved to '{csv_filename}'")
+
+        return results
+
 # Example usage of the class
-dls = DLS('DLS_files/1.00micro_1000dil')
-dls.AutoCorrelation()  # Computes autocorrelation and saves tau and errors to CSV
+if __name__ == '__main__':
+    dls = DLS('DLS_files/1.00micro_1000dil')
+    dls.AutoCorrelation()  # Computes autocorrelation and saves tau and errors to CSV
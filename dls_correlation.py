@@ -0,0 +1,203 @@
+import numpy as np
+
+
+def autocorrelation(x: np.ndarray, max_lag: int=None, axis: int=-1, workers: int=None) -> np.ndarray:
+    """
+    Autocorrelation function of a signal computed with the FFT (Wiener-Khinchin theorem).
+
+    Matches the direct definition used throughout the DLS scripts,
+        ac[j-1] = mean((x[0:N-j] - m) * (x[j:N] - m))   for j = 1 ... N-1
+    i.e. the lag 0 term is dropped and every lag is normalised by its number of products.
+    The mean-subtracted signal is zero padded to at least N + max_lag samples so the
+    circular correlation equals the linear one. Cost is O(N log N) instead of O(N^2).
+
+    Args:
+        x: signal (several signals can be stacked along the other axes)
+        max_lag: largest lag to return (defaults to N-1, all lags)
+        axis: axis holding the samples
+        workers: number of threads used by scipy.fft (-1 for all cores)
+    """
+    from scipy import fft
+
+    x = np.moveaxis(np.asarray(x, dtype=float), axis, -1)
+    N = x.shape[-1]
+    if max_lag is None or max_lag > N - 1:
+        max_lag = N - 1
+
+    # mean subtract and zero pad to a fast FFT length
+    x = x - x.mean(axis=-1, keepdims=True)
+    n_fft = fft.next_fast_len(N + max_lag, real=True)
+    spectrum = fft.rfft(x, n=n_fft, axis=-1, workers=workers)
+    power = spectrum.real**2 + spectrum.imag**2
+    ac = fft.irfft(power, n=n_fft, axis=-1, workers=workers)[..., 1:max_lag + 1]
+
+    # unbiased normalisation: lag j sums N-j products
+    ac /= np.arange(N - 1, N - max_lag - 1, -1)
+
+    return np.moveaxis(ac, -1, axis)
+
+
+class MultiTauCorrelator:
+    """
+    Streaming multi-tau (log binned) correlator, as used in hardware DLS correlators.
+
+    The first level correlates the raw samples at lags 1 ... 2m-1. Every further level k
+    works on the signal averaged over blocks of 2^k samples and correlates it at
+    lags m ... 2m-1, i.e. lag times m*2^k ... (2m-1)*2^k samples. Only the last 2m-1
+    samples of each level are kept between chunks, so memory is constant whatever
+    the length of the trace. Like the direct ACF, the result is the covariance
+    <(x(t) - <x>)(x(t+τ) - <x>)> with lag 0 excluded.
+    """
+    def __init__(self, m: int=16, n_levels: int=24):
+        """
+        Args:
+            m: number of channels per level (the first level has 2m-1)
+            n_levels: number of levels, the longest lag is (2m-1)*2^(n_levels-1) samples
+        """
+        self.m = m
+        self.n_levels = n_levels
+
+        # lags of each level in units of that level's (averaged) samples
+        self.level_lags = [np.arange(1, 2*m)] + [np.arange(m, 2*m) for _ in range(1, n_levels)]
+        # lags in raw samples of every channel
+        self.lags = np.concatenate([lags * 2**k for k, lags in enumerate(self.level_lags)])
+
+        self.reset()
+
+    def reset(self):
+        """Clear all accumulated correlations."""
+        n_channels = self.lags.size
+        self.sum_xy = np.zeros(n_channels)
+        self.sum_xy2 = np.zeros(n_channels)
+        self.sum_x0 = np.zeros(n_channels)
+        self.sum_x1 = np.zeros(n_channels)
+        self.counts = np.zeros(n_channels)
+        self.n_samples = 0
+        self.offset = None
+        self.tails = [np.zeros(0) for _ in range(self.n_levels)]
+        self.carry = [None] * self.n_levels
+
+    def decay(self, factor: float):
+        """
+        Scales down everything accumulated so far by 'factor' (0 < factor < 1), so older
+        samples count less than new ones, e.g. for a rolling estimate on a live stream.
+        """
+        for accumulator in (self.sum_xy, self.sum_xy2, self.sum_x0, self.sum_x1, self.counts):
+            accumulator *= factor
+
+    def update(self, samples: np.ndarray):
+        """Add a chunk of consecutive samples to the correlation."""
+        samples = np.asarray(samples, dtype=float).ravel()
+        if samples.size == 0:
+            return
+        # a constant offset does not change the covariance but keeps the sums well conditioned
+        if self.offset is None:
+            self.offset = samples.mean()
+        self.n_samples += samples.size
+
+        data = samples - self.offset
+        channel = 0
+        for level in range(self.n_levels):
+            lags = self.level_lags[level]
+            channels = slice(channel, channel + lags.size)
+            channel += lags.size
+            if data.size == 0:
+                continue
+            self._correlate_level(level, data, lags, channels)
+
+            # average neighbouring pairs for the next level, keeping an unpaired sample
+            if self.carry[level] is not None:
+                data = np.concatenate(([self.carry[level]], data))
+            if data.size % 2:
+                self.carry[level] = data[-1]
+                data = data[:-1]
+            else:
+                self.carry[level] = None
+            data = 0.5 * (data[0::2] + data[1::2])
+
+    def _correlate_level(self, level, data, lags, channels):
+        """Accumulate products of the new samples with the ones lags earlier in this level."""
+        tail = self.tails[level]
+        buffer = np.concatenate((tail, data))
+        n_tail = tail.size
+
+        for i, lag in enumerate(lags):
+            # pairs whose later sample is new in this chunk
+            start = max(n_tail, lag)
+            if start >= buffer.size:
+                continue
+            x1 = buffer[start:]
+            x0 = buffer[start - lag:buffer.size - lag]
+            products = x0 * x1
+            c = channels.start + i
+            self.sum_xy[c] += products.sum()
+            self.sum_xy2[c] += np.dot(products, products)
+            self.sum_x0[c] += x0.sum()
+            self.sum_x1[c] += x1.sum()
+            self.counts[c] += products.size
+
+        self.tails[level] = buffer[-(lags[-1]):]
+
+    def result(self):
+        """
+        Returns (lags, acf, variance) for every channel that has data.
+        lags are in raw samples. variance is the variance of the channel's mean product,
+        var(x0*x1)/n, which treats the products as independent and so is a lower bound.
+        """
+        valid = self.counts > 0
+        n = self.counts[valid]
+        mean_xy = self.sum_xy[valid] / n
+        acf = mean_xy - (self.sum_x0[valid] / n) * (self.sum_x1[valid] / n)
+        variance = np.maximum(self.sum_xy2[valid] / n - mean_xy**2, 0) / n
+        return self.lags[valid], acf, variance
+
+
+def correlate_prn(filename: str, m: int=16, n_levels: int=24, chunk_rows: int=1_000_000, dt: float=None):
+    """
+    Multi-tau ACF of the voltage trace in a .prn file, streamed in chunks so the
+    file never has to fit in memory.
+    Returns (lag_times, acf, variance) with lag times in the units of the time column.
+
+    Args:
+        filename: path to the .prn file
+        m: number of channels per level
+        n_levels: number of levels of the correlator
+        chunk_rows: number of rows parsed per chunk
+        dt: sample interval in the units of the time column, read from the first data rows
+            of the file if not given
+    """
+    from dls_prn import iter_prn_chunks, read_prn_header
+
+    if dt is None:
+        dt = read_prn_header(filename)['sample_interval']
+        if dt is None:
+            raise ValueError(f'{filename} has fewer than two data rows to read the sample interval from, pass dt')
+
+    correlator = MultiTauCorrelator(m=m, n_levels=n_levels)
+    for chunk in iter_prn_chunks(filename, chunk_rows=chunk_rows):
+        correlator.update(chunk[:, 1])
+
+    lags, acf, variance = correlator.result()
+    return lags * dt, acf, variance
+
+
+def block_autocorrelation(x: np.ndarray, n_blocks: int, max_lag: int=None, workers: int=-1) -> np.ndarray:
+    """
+    Splits a trace into n_blocks consecutive blocks of equal length and returns the
+    autocorrelation of each one, shape n_blocks x max_lag. Each block is mean subtracted
+    on its own. All blocks go through one batched FFT, spread over 'workers' threads.
+    Samples left over after the last full block are dropped.
+
+    Args:
+        x: 1D signal
+        n_blocks: number of blocks
+        max_lag: largest lag to return for every block
+        workers: number of threads used by scipy.fft (-1 for all cores)
+    """
+    x = np.asarray(x, dtype=float)
+    block_length = x.size // n_blocks
+    if block_length < 2:
+        raise ValueError(f'Trace of {x.size} samples is too short for {n_blocks} blocks.')
+
+    blocks = x[:n_blocks * block_length].reshape(n_blocks, block_length)
+    return autocorrelation(blocks, max_lag=max_lag, axis=-1, workers=workers)
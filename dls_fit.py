@@ -0,0 +1,176 @@
+import numpy as np
+
+# The DLS scripts write the autocorrelation as C(x) ∝ exp(-2x / τ) with x the lag index,
+# so every fit here returns τ = 2 / Γ where Γ is the decay rate per lag.
+
+
+def exponential_model(params: np.ndarray, x: np.ndarray) -> np.ndarray:
+    """
+    C(x) = A exp(-Γx) + B evaluated for every row of params = [A, Γ, B].
+    Returns an array of shape len(params) x len(x).
+    """
+    params = np.atleast_2d(params)
+    A, G, B = params[:, 0:1], params[:, 1:2], params[:, 2:3]
+    return A * np.exp(-G * x) + B
+
+
+def cumulant_model(params: np.ndarray, x: np.ndarray) -> np.ndarray:
+    """
+    C(x) = A exp(-Γx + μ2 x² / 2) evaluated for every row of params = [A, Γ, μ2].
+    Returns an array of shape len(params) x len(x).
+    """
+    params = np.atleast_2d(params)
+    A, G, mu2 = params[:, 0:1], params[:, 1:2], params[:, 2:3]
+    return A * np.exp(-G * x + 0.5 * mu2 * x**2)
+
+
+def _batched_lstsq(X: np.ndarray, y: np.ndarray, w: np.ndarray):
+    """
+    Weighted linear least squares solved for every row at once through the normal equations.
+    X is len(x) x n_params, y and w are n_rows x len(x). Returns (coefficients, covariance, dof).
+    """
+    XtWX = np.einsum('ri,ij,ik->rjk', w, X, X)
+    XtWy = np.einsum('ri,ij,ri->rj', w, X, y)
+    coefficients = np.linalg.solve(XtWX, XtWy[..., None])[..., 0]
+
+    residuals = y - coefficients @ X.T
+    dof = np.maximum((w > 0).sum(axis=1) - X.shape[1], 1)
+    s2 = (w * residuals**2).sum(axis=1) / dof
+    covariance = np.linalg.inv(XtWX) * s2[:, None, None]
+    return coefficients, covariance, dof
+
+
+def fit_cumulant(acfs: np.ndarray, window=(0, 30), order: int=2, x: np.ndarray=None) -> dict:
+    """
+    Cumulant fit of several autocorrelations at once: a polynomial in x fitted to log C(x),
+        log C(x) = log A - Γx + μ2 x² / 2   (order 2, order 1 is the plain log-linear fit)
+    Points where C(x) <= 0 are given zero weight instead of breaking the logarithm.
+
+    Returns a dictionary of arrays with one entry per ACF: tau, tau_error,
+    pdi (μ2 / Γ², the polydispersity index, zero for order 1) and params = [A, Γ, μ2].
+
+    Args:
+        acfs: autocorrelations, shape n_acfs x n_lags (or a single 1D ACF)
+        window: (start, stop) lag indices used in the fit
+        order: 1 for a single exponential, 2 to include the second cumulant
+        x: lag of every ACF point, e.g. multi-tau lag times (defaults to the lag index)
+    """
+    acfs = np.atleast_2d(acfs)
+    x = np.arange(acfs.shape[-1], dtype=float) if x is None else np.asarray(x, dtype=float)
+    x = x[window[0]:window[1]]
+    y = acfs[:, window[0]:window[1]]
+
+    # weight out non-positive points
+    w = (y > 0).astype(float)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        log_y = np.where(w > 0, np.log(np.where(y > 0, y, 1)), 0)
+
+    # ACFs with too few positive points cannot be fitted, solve them unweighted and discard them
+    unfittable = (w > 0).sum(axis=1) <= order
+    w[unfittable] = 1
+
+    X = np.vander(x, order + 1, increasing=True)
+    coefficients, covariance, dof = _batched_lstsq(X, log_y, w)
+    coefficients[unfittable] = np.nan
+
+    G = -coefficients[:, 1]
+    mu2 = 2 * coefficients[:, 2] if order >= 2 else np.zeros_like(G)
+    tau = 2 / G
+    tau_error = 2 / G**2 * np.sqrt(covariance[:, 1, 1])
+
+    return {
+        'tau': tau,
+        'tau_error': tau_error,
+        'pdi': mu2 / G**2,
+        'params': np.column_stack([np.exp(coefficients[:, 0]), G, mu2]),
+    }
+
+
+def fit_exponential(acfs: np.ndarray, window=(0, 30), baseline: bool=True, max_iter: int=100, tol: float=1e-10,
+                    x: np.ndarray=None) -> dict:
+    """
+    Nonlinear least squares fit of C(x) = A exp(-Γx) + B to several autocorrelations at once.
+
+    Every ACF has its own parameters, so the Jacobian is block diagonal. Each Levenberg-Marquardt
+    step is solved for all ACFs together as a stack of 3x3 systems, with a damping factor per ACF,
+    instead of running one optimiser per file. Unlike the fit on log C the data may go through zero.
+
+    Returns a dictionary of arrays with one entry per ACF: tau, tau_error,
+    params = [A, Γ, B] and converged.
+
+    Args:
+        acfs: autocorrelations, shape n_acfs x n_lags (or a single 1D ACF)
+        window: (start, stop) lag indices used in the fit
+        baseline: fit the constant B, otherwise B is fixed at 0
+        max_iter: maximum number of Levenberg-Marquardt iterations
+        tol: relative change in cost at which an ACF is considered converged
+        x: lag of every ACF point, e.g. multi-tau lag times (defaults to the lag index)
+    """
+    acfs = np.atleast_2d(acfs).astype(float)
+    x_all = np.arange(acfs.shape[-1], dtype=float) if x is None else np.asarray(x, dtype=float)
+    x = x_all[window[0]:window[1]]
+    y = acfs[:, window[0]:window[1]]
+    n = y.shape[0]
+
+    # start from the log-linear fit of the positive points
+    start = fit_cumulant(acfs, window, order=1, x=x_all)['params']
+    params = np.column_stack([start[:, 0], start[:, 1], np.zeros(n)])
+
+    # work with x measured from the start of the window, A is the value at its first lag
+    x0 = x[0]
+    x = x - x0
+    params[:, 0] *= np.exp(-params[:, 1] * x0)
+    bad = ~np.isfinite(params).all(axis=1) | (params[:, 1] <= 0)
+    params[bad] = np.column_stack([y[bad, 0], np.full(bad.sum(), 2 / max(x[-1], 1)), np.zeros(bad.sum())])
+
+    def residuals_and_jacobian(p):
+        e = np.exp(-p[:, 1:2] * x)
+        r = p[:, 0:1] * e + p[:, 2:3] - y
+        J = np.stack([e, -p[:, 0:1] * x * e, np.full_like(e, float(baseline))], axis=-1)
+        return r, J
+
+    r, J = residuals_and_jacobian(params)
+    cost = (r**2).sum(axis=1)
+    damping = np.full(n, 1e-3)
+    converged = np.zeros(n, dtype=bool)
+    stalled = np.zeros(n, dtype=bool)
+    eye = np.eye(3)
+
+    for _ in range(max_iter):
+        JtJ = np.einsum('rik,ril->rkl', J, J)
+        Jtr = np.einsum('rik,ri->rk', J, r)
+        if not baseline:
+            JtJ[:, 2, 2] = 1
+
+        # damped normal equations for every ACF in one batched solve
+        A = JtJ + damping[:, None, None] * JtJ * eye
+        step = -np.linalg.solve(A, Jtr[..., None])[..., 0]
+        trial = params + step
+        r_trial, J_trial = residuals_and_jacobian(trial)
+        cost_trial = (r_trial**2).sum(axis=1)
+
+        better = np.isfinite(cost_trial) & (cost_trial < cost) & ~converged & ~stalled
+        converged |= better & ((cost - cost_trial) <= tol * cost)
+        params[better], r[better], J[better] = trial[better], r_trial[better], J_trial[better]
+        cost = np.where(better, cost_trial, cost)
+        damping = np.where(better, damping / 3, damping * 3)
+        stalled |= damping > 1e10
+        if (converged | stalled).all():
+            break
+
+    # parameter covariance from the final Jacobian
+    JtJ = np.einsum('rik,ril->rkl', J, J)
+    if not baseline:
+        JtJ[:, 2, 2] = 1
+    dof = max(x.size - (3 if baseline else 2), 1)
+    covariance = np.linalg.pinv(JtJ) * (cost / dof)[:, None, None]
+
+    # shift A back to the first lag of the window
+    params[:, 0] *= np.exp(params[:, 1] * x0)
+    G = params[:, 1]
+    return {
+        'tau': 2 / G,
+        'tau_error': 2 / G**2 * np.sqrt(covariance[:, 1, 1]),
+        'params': params,
+        'converged': converged,
+    }
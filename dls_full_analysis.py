@@ -1,13 +1,16 @@
 import numpy as np
 import matplotlib.pyplot as plt
 from scipy import stats
-from scipy.signal import butter, filtfilt
 import os
+from concurrent.futures import ProcessPoolExecutor
+from dls_correlation import autocorrelation
+from dls_prn import load_prn
+from signal_conditioning import notch_filter
 
 # Function to compute tau and its standard deviation from a .prn file
 def compute_tau_from_file(filename):
     # Load Data
-    data = np.loadtxt(filename, delimiter='\t', skiprows=3)  # Skips first 3 rows
+    data = load_prn(filename)  # Skips first 3 rows, cached as .npy after the first run
     t = data[:, 0]  # Time
     voltage = data[:, 1]  # Voltage
 
@@ -16,26 +19,15 @@ def compute_tau_from_file(filename):
     f0 = 100  # Frequency to remove (50 Hz)
     Q = 10  # Quality factor: Controls the width of the notch
 
-    # Create the bandstop filter
-    b, a = butter(2, [f0 - 1, f0 + 1], btype='bandstop', fs=fs)
-
-    # Apply the bandstop filter to the voltage signal
-    voltage_filtered = filtfilt(b, a, voltage)
-
-    # Get the number of samples (N)
-    N = len(voltage_filtered)
-
-    # Calculate Autocorrelation function (ACF)
-    ac = np.zeros(N-1)  # Prepare the array for autocorrelation
-    m = np.mean(voltage_filtered)  # Mean of the filtered data
-
-    # Compute the autocorrelation
-    for j in range(1, N):
-        ac[j-1] = np.mean((voltage_filtered[0:N-j] - m) * (voltage_filtered[j:N] - m))
+    # Apply a zero-phase bandstop filter (f0 ± 1 Hz) to the voltage signal
+    voltage_filtered = notch_filter(voltage, fs, f0)
 
     # Exponential decay fitting using a linear fit on log(ACF)
     rangemax = 20  # Limit of data to use for fitting
 
+    # Calculate Autocorrelation function (ACF) for the lags used in the fit
+    ac = autocorrelation(voltage_filtered, max_lag=rangemax)
+
     # Prevent log(0) issues by adding a small value if needed
     ac_log = np.log(ac[:rangemax] + 1e-10)
 
@@ -55,21 +47,27 @@ def compute_tau_from_file(filename):
     return tau, sigma_tau
 
 
-# Function to process all .prn files in a folder and compute the weighted mean of tau
-def process_folder_for_tau(folder_path):
-    taus = []
-    sigma_taus = []
+# Function to list the .prn files of a folder in a fixed order
+def list_prn_files(folder_path):
+    return [os.path.join(folder_path, filename) for filename in sorted(os.listdir(folder_path))
+            if filename.endswith(".prn")]
+
 
-    # Iterate over all files in the folder
-    for filename in os.listdir(folder_path):
-        if filename.endswith(".prn"):
-            file_path = os.path.join(folder_path, filename)
+# Function to compute tau for many files, across a process pool if n_jobs is not 1
+def compute_taus(file_paths, n_jobs=1):
+    if n_jobs == 1 or len(file_paths) < 2:
+        return [compute_tau_from_file(file_path) for file_path in file_paths]
 
-            # Compute tau and standard deviation of tau for the current file
-            tau, sigma_tau = compute_tau_from_file(file_path)
-            # Append tau and its standard deviation
-            taus.append(tau)
-            sigma_taus.append(sigma_tau)
+    # results come back in the order of file_paths whatever order the workers finish in
+    max_workers = None if n_jobs == -1 else n_jobs
+    with ProcessPoolExecutor(max_workers=max_workers) as executor:
+        return list(executor.map(compute_tau_from_file, file_paths))
+
+
+# Function to compute the weighted mean of tau and its error from per-file results
+def weighted_mean_of_taus(results):
+    taus = [tau for tau, sigma_tau in results]
+    sigma_taus = [sigma_tau for tau, sigma_tau in results]
 
     # Calculate weighted mean of tau
     weights = 1 / np.array(sigma_taus) ** 2
@@ -82,22 +80,35 @@ def process_folder_for_tau(folder_path):
     return weighted_mean_tau, error_in_weighted_mean
 
 
+# Function to process all .prn files in a folder and compute the weighted mean of tau
+def process_folder_for_tau(folder_path, n_jobs=1):
+    return weighted_mean_of_taus(compute_taus(list_prn_files(folder_path), n_jobs))
+
+
 # Function to process all folders within a parent folder
-def process_parent_folder(parent_folder_path):
+# With n_jobs != 1 the files of every folder are computed together across one process pool
+def process_parent_folder(parent_folder_path, n_jobs=1):
     taus =[]
     rel_error_taus = []
-    # Iterate over all subdirectories in the parent folder
-    for folder_name in os.listdir(parent_folder_path):
+
+    # Collect the files of all subdirectories (in sorted order, as in q_and_error)
+    folder_files = []
+    for folder_name in sorted(os.listdir(parent_folder_path)):
         folder_path = os.path.join(parent_folder_path, folder_name)
 
         # Ensure that it's a directory (not a file)
         if os.path.isdir(folder_path):
             print(f"Processing folder: {folder_path}")
-
-            # Process the folder and calculate the weighted mean and error for tau
-            weighted_mean_tau, error_in_weighted_mean = process_folder_for_tau(folder_path)
-            taus.append(weighted_mean_tau)
-            rel_error_taus.append(error_in_weighted_mean/weighted_mean_tau)
+            folder_files.append(list_prn_files(folder_path))
+
+    # Compute every file, then split the results back into their folders
+    results = compute_taus([file_path for file_paths in folder_files for file_path in file_paths], n_jobs)
+    start = 0
+    for file_paths in folder_files:
+        weighted_mean_tau, error_in_weighted_mean = weighted_mean_of_taus(results[start:start + len(file_paths)])
+        start += len(file_paths)
+        taus.append(weighted_mean_tau)
+        rel_error_taus.append(error_in_weighted_mean/weighted_mean_tau)
         
     return taus, rel_error_taus
 
@@ -115,7 +126,7 @@ def q_and_error(parent_folder_path):
     q=[]
     error_q=[]
 
-    for folder_name in os.listdir(parent_folder_path):
+    for folder_name in sorted(os.listdir(parent_folder_path)):
         a = float(folder_name)
         print(a)
         del_a = 0.2
@@ -130,22 +141,23 @@ def q_and_error(parent_folder_path):
     return q, rel_error_q
 
 
-def a_and_error(parent_folder_path):
+def a_and_error(parent_folder_path, n_jobs=1):
     
     del_d = []
     q, rel_error_q = q_and_error(parent_folder_path)
-    taus, rel_error_taus = process_parent_folder(parent_folder_path)
+    taus, rel_error_taus = process_parent_folder(parent_folder_path, n_jobs)
     c = 4.82*10**(-22)
     d = c*((np.array(q))**2)*np.array(taus)
     del_d = d*( (np.array(rel_error_q))**2 + (2*np.array(rel_error_taus))**2)**0.5
     return d, del_d
 
-parent_folder_path = 'data-0.75mu-10^3'  
+if __name__ == '__main__':
+    parent_folder_path = 'data-0.75mu-10^3'  
 
-# Print the results for each folder
-#for folder_name, result in results.items():
-#    print(f"Folder: {folder_name}")
-#   print(f"  Weighted mean of tau: {result['weighted_mean_tau']}")
-#   print(f"  Error in the weighted mean of tau: {result['error_in_weighted_mean']}")
+    # Print the results for each folder
+    #for folder_name, result in results.items():
+    #    print(f"Folder: {folder_name}")
+    #   print(f"  Weighted mean of tau: {result['weighted_mean_tau']}")
+    #   print(f"  Error in the weighted mean of tau: {result['error_in_weighted_mean']}")
 
-print( a_and_error(parent_folder_path))
\ No newline at end of file
+    print( a_and_error(parent_folder_path, n_jobs=-1))
\ No newline at end of file
@@ -0,0 +1,113 @@
+import os
+import json
+import numpy as np
+from itertools import islice
+
+# number of header lines at the top of every .prn file
+PRN_HEADER_ROWS = 3
+
+
+def read_prn_header(filename: str, n_rows: int=2, skiprows: int=PRN_HEADER_ROWS) -> dict:
+    """
+    Reads only the header and the first n_rows data rows of a .prn file.
+    The time column is in ms, so the sampling frequency (Hz) is 1000 / (t[1] - t[0]).
+
+    Returns a dictionary with the header lines, the first rows, the sample interval
+    and the sampling frequency.
+    """
+    with open(filename) as file:
+        header = [next(file, '').rstrip('\r\n') for _ in range(skiprows)]
+        rows = np.loadtxt(list(islice(file, n_rows)), delimiter='\t', ndmin=2)
+
+    sample_interval = rows[1, 0] - rows[0, 0] if rows.shape[0] > 1 else None
+    return {
+        'header': header,
+        'rows': rows,
+        'sample_interval': sample_interval,
+        'sample_freq': 1000 / sample_interval if sample_interval else None,
+    }
+
+
+def _cache_paths(filename: str):
+    """Paths of the binary sidecar cache and its metadata for a .prn file."""
+    return filename + '.npy', filename + '.npy.json'
+
+
+def _source_stamp(filename: str, skiprows: int) -> dict:
+    """Identifies the current version of a .prn file for cache invalidation."""
+    stat = os.stat(filename)
+    return {'size': stat.st_size, 'mtime_ns': stat.st_mtime_ns, 'skiprows': skiprows}
+
+
+def _load_cached(filename: str, skiprows: int, mmap: bool=True):
+    """Returns the sidecar array if it was built from this exact version of the file, else None."""
+    cache_file, meta_file = _cache_paths(filename)
+    try:
+        with open(meta_file) as file:
+            if json.load(file) == _source_stamp(filename, skiprows):
+                return np.load(cache_file, mmap_mode='r' if mmap else None)
+    except (OSError, ValueError):
+        pass
+    return None
+
+
+def load_prn(filename: str, cache: bool=True, mmap: bool=True, skiprows: int=PRN_HEADER_ROWS) -> np.ndarray:
+    """
+    Loads the (time, voltage) columns of a .prn file as an N x 2 float array.
+
+    The first load parses the text once with numpy's C tokenizer and stores it as a
+    '<file>.npy' sidecar next to it. Later loads memory map the sidecar, which is
+    nearly instant. The sidecar is rebuilt whenever the size or modification time
+    of the .prn file changes.
+
+    Args:
+        filename: path to the .prn file
+        cache: read and write the binary sidecar cache
+        mmap: memory map the cached array (read only) instead of reading it into memory
+        skiprows: number of header lines
+    """
+    if not cache:
+        return np.loadtxt(filename, delimiter='\t', skiprows=skiprows, dtype=np.float64, ndmin=2)
+
+    cached = _load_cached(filename, skiprows, mmap)
+    if cached is not None:
+        return cached
+
+    cache_file, meta_file = _cache_paths(filename)
+    stamp = _source_stamp(filename, skiprows)
+    data = np.loadtxt(filename, delimiter='\t', skiprows=skiprows, dtype=np.float64, ndmin=2)
+
+    # write the sidecar atomically, a read only data folder just means no cache
+    try:
+        tmp_file = cache_file + '.tmp'
+        with open(tmp_file, 'wb') as file:
+            np.save(file, data)
+        os.replace(tmp_file, cache_file)
+        with open(meta_file, 'w') as file:
+            json.dump(stamp, file)
+    except OSError:
+        pass
+
+    return data
+
+
+def iter_prn_chunks(filename: str, chunk_rows: int=1_000_000, skiprows: int=PRN_HEADER_ROWS):
+    """
+    Yields the (time, voltage) rows of a .prn file as arrays of at most chunk_rows rows,
+    so files larger than memory can be processed piece by piece.
+    A valid binary sidecar is memory mapped and sliced instead of parsing the text.
+    """
+    cached = _load_cached(filename, skiprows)
+    if cached is not None:
+        for start in range(0, cached.shape[0], chunk_rows):
+            yield np.asarray(cached[start:start + chunk_rows])
+        return
+
+    with open(filename) as file:
+        for _ in range(skiprows):
+            next(file, None)
+        while True:
+            lines = list(islice(file, chunk_rows))
+            if not lines:
+                break
+            yield np.loadtxt(lines, delimiter='\t', ndmin=2)
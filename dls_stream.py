@@ -0,0 +1,238 @@
+import sys
+import json
+import time
+import socket
+import argparse
+import numpy as np
+from contextlib import contextmanager
+from dls_correlation import MultiTauCorrelator
+from dls_fit import fit_exponential
+from signal_conditioning import StreamingNotchFilter
+
+
+@contextmanager
+def open_source(source: str):
+    """
+    Opens a text stream of tab separated (time, voltage) records for a with block, which
+    closes it at the end (a file, or the accepted connection and its stream), except stdin.
+
+    Args:
+        source: '-' for stdin, 'tcp://host:port' to listen on a local TCP port and accept
+            one connection from the logger, anything else is a file or FIFO path
+    """
+    if source == '-':
+        yield sys.stdin
+    elif source.startswith('tcp://'):
+        host, port = source[len('tcp://'):].rsplit(':', 1)
+        with socket.create_server((host, int(port))) as server:
+            print(f"Waiting for a connection on {host}:{port}", file=sys.stderr)
+            connection, address = server.accept()
+        with connection, connection.makefile('r', encoding='utf-8', errors='replace') as stream:
+            yield stream
+    else:
+        with open(source) as stream:
+            yield stream
+
+
+def iter_record_chunks(stream, chunk_rows: int=10_000):
+    """
+    Yields (time, voltage) records of a text stream as N x 2 arrays of at most chunk_rows rows.
+    Header lines and partial or malformed records are skipped.
+    """
+    while True:
+        rows = []
+        for line in stream:
+            fields = line.split('\t')
+            if len(fields) < 2:
+                continue
+            try:
+                rows.append((float(fields[0]), float(fields[1])))
+            except ValueError:
+                continue
+            if len(rows) >= chunk_rows:
+                break
+        if not rows:
+            return
+        yield np.array(rows)
+
+
+class DLSStream:
+    """
+    Rolling DLS analysis of a live voltage stream.
+
+    Samples are notch filtered causally and fed to a multi-tau correlator, so memory
+    stays bounded however long the stream runs. Every 'update_every' samples the
+    current ACF is fitted for tau and an update dictionary is produced.
+    """
+    def __init__(self, noise_freq: float=100., n_harmonics: int=1, m: int=16, n_levels: int=16,
+                 fit_lag: int=30, update_every: int=100_000, forget: float=None):
+        """
+        Args:
+            noise_freq: mains frequency to remove (Hz)
+            n_harmonics: number of mains harmonics to remove
+            m: channels per level of the multi-tau correlator
+            n_levels: number of levels of the multi-tau correlator
+            fit_lag: largest lag (in samples) used in the tau fit
+            update_every: number of samples between updates
+            forget: if set, the accumulated correlation is multiplied by this factor after
+                every update so the estimate follows changes in the sample
+        """
+        self.noise_freq = noise_freq
+        self.n_harmonics = n_harmonics
+        self.fit_lag = fit_lag
+        self.update_every = update_every
+        self.forget = forget
+
+        self.correlator = MultiTauCorrelator(m=m, n_levels=n_levels)
+        self.notch = None
+        self.sample_interval = None
+        self.last_time = None
+        self.pending = None
+        self.since_update = 0
+
+    def feed(self, records: np.ndarray):
+        """
+        Adds a chunk of (time, voltage) records. Returns the list of updates produced (possibly empty).
+        """
+        updates = []
+
+        # the sampling frequency comes from the first two timestamps (time is in ms)
+        if self.sample_interval is None:
+            if self.pending is not None:
+                records = np.concatenate((self.pending, records))
+            if records.shape[0] < 2:
+                self.pending = records
+                return updates
+            self.pending = None
+            self.sample_interval = records[1, 0] - records[0, 0]
+            self.notch = StreamingNotchFilter(1000 / self.sample_interval, self.noise_freq, self.n_harmonics)
+
+        t, voltage = records[:, 0], records[:, 1]
+
+        filtered = self.notch(voltage)
+
+        # feed the correlator up to each update point in turn
+        start = 0
+        while start < filtered.size:
+            stop = min(filtered.size, start + self.update_every - self.since_update)
+            self.correlator.update(filtered[start:stop])
+            self.since_update += stop - start
+            self.last_time = t[stop - 1]
+            start = stop
+            if self.since_update >= self.update_every:
+                updates.append(self.update())
+                self.since_update = 0
+                if self.forget is not None:
+                    self.correlator.decay(self.forget)
+        return updates
+
+    def update(self) -> dict:
+        """Fits the current ACF and returns the update record."""
+        lags, acf, variance = self.correlator.result()
+
+        # fit the channels up to fit_lag, tau is in samples and then converted to ms
+        n_fit = int(np.searchsorted(lags, self.fit_lag, side='right'))
+        tau = tau_error = None
+        if n_fit >= 4:
+            with np.errstate(all='ignore'):
+                fitted = fit_exponential(acf, window=(0, n_fit), x=lags)
+            if np.isfinite(fitted['tau'][0]):
+                tau = float(fitted['tau'][0]) * self.sample_interval
+                tau_error = float(fitted['tau_error'][0]) * self.sample_interval
+
+        return {
+            'time': float(self.last_time),
+            'samples': int(self.correlator.n_samples),
+            'tau': tau,
+            'tau_error': tau_error,
+            'lag_times': (lags * self.sample_interval).tolist(),
+            'acf': acf.tolist(),
+            'acf_error': np.sqrt(variance).tolist(),
+        }
+
+
+def run_stream(source: str='-', output=None, chunk_rows: int=10_000, **options):
+    """
+    Reads records from source and writes one JSON line per update to output (stdout by default).
+    Extra keyword arguments are passed to DLSStream.
+    """
+    output = output or sys.stdout
+    stream = DLSStream(**options)
+    with open_source(source) as records:
+        for chunk in iter_record_chunks(records, chunk_rows):
+            for update in stream.feed(chunk):
+                output.write(json.dumps(update) + '\n')
+                output.flush()
+    return stream
+
+
+def replay(filename: str, connect: str=None, rate: float=None, chunk_rows: int=10_000):
+    """
+    Replays the records of an existing .prn file as a stream, for testing.
+
+    Args:
+        filename: .prn file to replay
+        connect: 'host:port' to send the records to a listening stream, otherwise stdout
+        rate: samples per second to pace the replay at (as fast as possible if None)
+        chunk_rows: number of lines written at a time (header lines are sent too, the reader skips them)
+    """
+    if connect is not None:
+        host, port = connect.rsplit(':', 1)
+        connection = socket.create_connection((host, int(port)))
+        output = connection.makefile('w', encoding='utf-8')
+    else:
+        connection, output = None, sys.stdout
+
+    start = time.perf_counter()
+    sent = 0
+    try:
+        with open(filename) as file:
+            chunk = []
+            for line in file:
+                chunk.append(line)
+                if len(chunk) >= chunk_rows:
+                    output.write(''.join(chunk))
+                    sent += len(chunk)
+                    chunk = []
+                    # sleep until the replay is back on schedule
+                    if rate:
+                        delay = sent / rate - (time.perf_counter() - start)
+                        if delay > 0:
+                            time.sleep(delay)
+            output.write(''.join(chunk))
+            output.flush()
+    except BrokenPipeError:
+        pass
+    finally:
+        if connection is not None:
+            output.close()
+            connection.close()
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Real-time DLS analysis of a streamed voltage trace.')
+    commands = parser.add_subparsers(dest='command', required=True)
+
+    listen = commands.add_parser('listen', help='analyse a stream and print JSON updates')
+    listen.add_argument('source', nargs='?', default='-', help="'-' (stdin), a FIFO/file path or tcp://host:port")
+    listen.add_argument('--noise-freq', type=float, default=100.)
+    listen.add_argument('--harmonics', type=int, default=1)
+    listen.add_argument('--fit-lag', type=int, default=30, help='largest lag (samples) used in the fit')
+    listen.add_argument('--update-every', type=int, default=100_000, help='samples between updates')
+    listen.add_argument('--forget', type=float, default=None, help='decay factor applied after each update')
+
+    play = commands.add_parser('replay', help='replay a .prn file as a stream')
+    play.add_argument('filename')
+    play.add_argument('--connect', default=None, help='host:port of a listening stream (default stdout)')
+    play.add_argument('--rate', type=float, default=None, help='samples per second')
+
+    args = parser.parse_args()
+    if args.command == 'listen':
+        run_stream(args.source, noise_freq=args.noise_freq, n_harmonics=args.harmonics, fit_lag=args.fit_lag,
+                   update_every=args.update_every, forget=args.forget)
+    else:
+        replay(args.filename, connect=args.connect, rate=args.rate)
+
+
+if __name__ == '__main__':
+    main()
@@ -1,8 +1,15 @@
+import os
 from DDM_Fourier import DDM_Fourier
 
 filepath = "/Users/domswift/Documents/GitHub/E2_DCF/build_DDM/data/DDM_initial/x10/0.5micron_x5000_150fps_brightest.avi"
 
 pixel_size = 0.229
+
+# without the lab data, run on a synthetic video of 0.75 μm particles instead
+if not os.path.exists(filepath):
+    from synthetic import write_video
+    filepath = write_video('synthetic_0.75micron_150fps.avi', 1000, fps=150., shape=(256, 256),
+                           diameter=0.75, pixel_size=pixel_size)
 example = DDM_Fourier(filepath=filepath, pixel_size=pixel_size, particle_size=0.75, renormalise=True)
 
 print(example.frames[0])
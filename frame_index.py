@@ -0,0 +1,176 @@
+import os
+import numpy as np
+
+# Index of the decodable frames of a video, built in one pass and saved as '<video>.idx.npz'
+# next to it. The container's frame count and fps are only metadata: the index records what
+# can actually be decoded and when each frame was taken.
+
+INDEX_VERSION = 2
+
+# consecutive frames that fail to decode before the rest of the video is taken as unreadable
+MAX_SKIPPED = 16
+
+
+def index_path(filename: str) -> str:
+    return filename + '.idx.npz'
+
+
+def _source_stamp(filename: str) -> np.ndarray:
+    """Identifies the current version of a video for index invalidation."""
+    stat = os.stat(filename)
+    return np.array([INDEX_VERSION, stat.st_size, stat.st_mtime_ns], dtype=np.int64)
+
+
+def detect_dropped(timestamps: np.ndarray, tolerance: float=0.5) -> np.ndarray:
+    """
+    Finds gaps in the frame timestamps longer than the nominal frame interval (the median),
+    i.e. frames the camera dropped. Returns an array of (index of the frame after the gap,
+    number of missing frames) rows.
+
+    Args:
+        timestamps: frame times (s)
+        tolerance: fraction of an interval by which a gap must exceed it to count as a drop
+    """
+    if timestamps.size < 3:
+        return np.zeros((0, 2), dtype=np.int64)
+    intervals = np.diff(timestamps)
+    nominal = np.median(intervals)
+    if nominal <= 0:
+        return np.zeros((0, 2), dtype=np.int64)
+    missing = np.rint(intervals / nominal).astype(np.int64) - 1
+    gaps = np.flatnonzero((intervals > (1 + tolerance) * nominal) & (missing > 0))
+    return np.column_stack([gaps + 1, missing[gaps]]).astype(np.int64)
+
+
+class FrameIndex:
+    """
+    Positions and timestamps of every decodable frame of a video.
+
+    Attributes:
+        positions: decoder frame position of each frame (the value to seek to), which skips
+            the positions of frames that failed to decode
+        timestamps: presentation time of each frame (s)
+        dropped: (frame index, number of missing frames) for every gap in the timestamps
+        undecodable: container positions of the frames that failed to decode, including the
+            tail of the video when it could not be read to the container's frame count
+        container_frame_count: frame count the container claims
+        container_fps: frame rate the container claims
+    """
+    def __init__(self, positions, timestamps, container_frame_count: int=0, container_fps: float=0.,
+                 undecodable=()):
+        self.positions = np.asarray(positions, dtype=np.int64)
+        self.timestamps = np.asarray(timestamps, dtype=float)
+        self.undecodable = np.asarray(undecodable, dtype=np.int64)
+        self.container_frame_count = int(container_frame_count)
+        self.container_fps = float(container_fps)
+        self.dropped = detect_dropped(self.timestamps)
+
+    def __len__(self):
+        return self.positions.size
+
+    @property
+    def fps(self) -> float:
+        """
+        Frame rate from the median frame interval. The container's value is kept when it agrees
+        to 0.1% (it is exact where the timestamps are rounded) or when there are no timestamps.
+        """
+        if self.timestamps.size > 1:
+            interval = np.median(np.diff(self.timestamps))
+            if interval > 0:
+                fps = 1 / interval
+                if self.container_fps > 0 and abs(fps - self.container_fps) < 1e-3 * self.container_fps:
+                    return self.container_fps
+                return fps
+        return self.container_fps
+
+    def lag_times(self, lags) -> np.ndarray:
+        """
+        Mean real time (s) between frames 'lag' frames apart, for every lag. Equal to lag / fps
+        when the timing is perfect, and correct on average when frames were dropped.
+        """
+        lags = np.atleast_1d(np.asarray(lags, dtype=np.int64))
+        times = np.full(lags.shape, np.nan)
+        # mean of t[i + lag] - t[i] over all i, from cumulative sums
+        cumulative = np.concatenate([[0.], np.cumsum(self.timestamps)])
+        n = self.timestamps.size
+        valid = (lags >= 0) & (lags < n)
+        count = n - lags[valid]
+        times[valid] = (cumulative[n] - cumulative[lags[valid]] - cumulative[count]) / count
+        return times
+
+    @classmethod
+    def build(cls, filename: str):
+        """
+        Grabs every frame of the video once (without converting it) and records its position and
+        time. A frame that fails to decode is skipped by seeking past it, up to MAX_SKIPPED in a
+        row, and every position short of the container's frame count is recorded as undecodable.
+        """
+        from ImageStack import _cv2
+        cv2 = _cv2()
+
+        video = cv2.VideoCapture(filename)
+        if not video.isOpened():
+            raise ValueError(f'Failed to open {filename}')
+        container_frame_count = int(video.get(cv2.CAP_PROP_FRAME_COUNT))
+        container_fps = video.get(cv2.CAP_PROP_FPS)
+
+        positions, timestamps, undecodable = [], [], []
+        position = skipped = 0
+        while True:
+            if video.grab():
+                positions.append(position)
+                timestamps.append(video.get(cv2.CAP_PROP_POS_MSEC) / 1000)
+                skipped = 0
+            elif position >= container_frame_count - 1 or skipped == MAX_SKIPPED:
+                break
+            else:
+                # a failed frame before the container's end: resume decoding after it
+                undecodable.append(position)
+                skipped += 1
+                video.set(cv2.CAP_PROP_POS_FRAMES, position + 1)
+            position += 1
+        video.release()
+        # the skipped frames a failed run of them ended on, and the tail never reached
+        undecodable = sorted(set(undecodable) | set(range(position, container_frame_count)))
+        return cls(positions, timestamps, container_frame_count, container_fps, undecodable)
+
+    def save(self, path: str, stamp: np.ndarray=None):
+        """Saves the index to an '.npz' file, with the stamp of the video it was built from if given."""
+        extra = {} if stamp is None else {'stamp': stamp}
+        np.savez(path, positions=self.positions, timestamps=self.timestamps, undecodable=self.undecodable,
+                 container=np.array([self.container_frame_count, self.container_fps]), **extra)
+
+    @classmethod
+    def load(cls, path: str):
+        with np.load(path) as data:
+            container = data['container']
+            return cls(data['positions'], data['timestamps'], int(container[0]), float(container[1]),
+                       data['undecodable'])
+
+    @classmethod
+    def for_video(cls, filename: str, cache: bool=True):
+        """
+        Returns the index of a video, from '<video>.idx.npz' if it was built from this exact
+        version of the file (same size and modification time), otherwise built and saved.
+        """
+        path = index_path(filename)
+        stamp = _source_stamp(filename)
+        if cache:
+            try:
+                with np.load(path) as data:
+                    valid = np.array_equal(data['stamp'], stamp)
+                if valid:
+                    return cls.load(path)
+            except (OSError, KeyError, ValueError):
+                pass
+
+        index = cls.build(filename)
+        if cache:
+            # write to a temporary file first so a concurrent reader never sees half an index
+            temporary = f'{path}.{os.getpid()}.tmp.npz'
+            try:
+                index.save(temporary, stamp)
+                os.replace(temporary, path)
+            except OSError:
+                pass
+        return index
@@ -0,0 +1,165 @@
+import os
+import numpy as np
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
+
+# A figure spec is a plain (picklable) dictionary describing one single-axes figure:
+#   path:      PNG file to write (required when rendering off-thread)
+#   figsize:   figure size in inches, dpi: resolution of the PNG
+#   calls:     list of (Axes method, args, kwargs) applied in order, e.g. ('semilogy', (x, y, 'ro'), {})
+#              an 'imshow' call may use norm='log' for a LogNorm
+#   title, xlabel, ylabel: text of the labels, fontsize: their font size
+#   legend:    keyword arguments of ax.legend (None for no legend)
+#   colorbar:  keyword arguments of fig.colorbar for the last image (None for no colorbar)
+#   grid:      draw a grid
+# The numerical code only builds specs, so drawing never runs inside a compute loop.
+
+
+def decimate_image(image: np.ndarray, max_shape=(1000, 1000)) -> np.ndarray:
+    """
+    Block-averages a 2D image down to at most max_shape pixels, so a large heatmap
+    is not drawn at a resolution no screen (or PNG) can show.
+    The last block of an axis may be smaller if the size is not a multiple of the factor.
+
+    Args:
+        image: 2D array
+        max_shape: largest (rows, columns) kept
+    """
+    image = np.asarray(image, dtype=float)
+    for axis, max_size in enumerate(max_shape):
+        size = image.shape[axis]
+        factor = int(np.ceil(size / max_size))
+        if factor <= 1:
+            continue
+        starts = np.arange(0, size, factor)
+        counts = np.diff(np.append(starts, size))
+        shape = [1, 1]
+        shape[axis] = -1
+        image = np.add.reduceat(image, starts, axis=axis) / counts.reshape(shape)
+    return image
+
+
+def figure_pixels(spec: dict) -> tuple:
+    """(rows, columns) of pixels of the rendered figure, the resolution worth keeping in an image."""
+    width, height = spec.get('figsize', (6.4, 4.8))
+    dpi = spec.get('dpi', 100)
+    return int(height * dpi), int(width * dpi)
+
+
+def draw_figure(spec: dict, fig):
+    """Draws a figure spec on an empty matplotlib figure."""
+    from matplotlib.colors import LogNorm
+
+    ax = fig.add_subplot()
+    fontsize = spec.get('fontsize')
+    image = None
+    for method, args, kwargs in spec.get('calls', []):
+        if kwargs.get('norm') == 'log':
+            kwargs = dict(kwargs, norm=LogNorm())
+        artist = getattr(ax, method)(*args, **kwargs)
+        if method == 'imshow':
+            image = artist
+
+    if spec.get('title'):
+        ax.set_title(spec['title'], fontsize=fontsize)
+    if spec.get('xlabel'):
+        ax.set_xlabel(spec['xlabel'], fontsize=fontsize)
+    if spec.get('ylabel'):
+        ax.set_ylabel(spec['ylabel'], fontsize=fontsize)
+    if spec.get('legend') is not None:
+        ax.legend(**spec['legend'])
+    if spec.get('colorbar') is not None and image is not None:
+        fig.colorbar(image, ax=ax, **spec['colorbar'])
+    if spec.get('grid'):
+        ax.grid(True)
+    return fig
+
+
+def render_figure(spec: dict) -> str:
+    """
+    Renders a figure spec to its PNG path with the Agg canvas and returns the path.
+    Does not touch pyplot, so it is safe to call from a worker thread or process.
+    """
+    from matplotlib.figure import Figure
+    from matplotlib.backends.backend_agg import FigureCanvasAgg
+
+    fig = Figure(figsize=spec.get('figsize', (6.4, 4.8)))
+    FigureCanvasAgg(fig)
+    draw_figure(spec, fig)
+
+    directory = os.path.dirname(spec['path'])
+    if directory:
+        os.makedirs(directory, exist_ok=True)
+    fig.savefig(spec['path'], dpi=spec.get('dpi', 100))
+    return spec['path']
+
+
+def show_figure(spec: dict):
+    """Draws a figure spec with pyplot and shows it interactively (saving it first if it has a path)."""
+    import matplotlib.pyplot as plt
+
+    fig = plt.figure(figsize=spec.get('figsize', (6.4, 4.8)))
+    draw_figure(spec, fig)
+    if spec.get('path'):
+        fig.savefig(spec['path'], dpi=spec.get('dpi', 100))
+    plt.show()
+
+
+class PlotQueue:
+    """
+    Renders queued figure specs to PNG files in the background.
+
+    submit() returns straight away with a future, the figures are drawn by a worker
+    thread (or by worker processes if processes=True, for many heavy figures) while
+    the caller carries on with the numerical work. close() waits for every figure.
+    """
+    def __init__(self, max_workers: int=1, processes: bool=False):
+        """
+        Args:
+            max_workers: number of rendering workers
+            processes: render in worker processes instead of a thread
+        """
+        executor = ProcessPoolExecutor if processes else ThreadPoolExecutor
+        self.executor = executor(max_workers=max_workers)
+        self.futures = []
+
+    def submit(self, spec: dict):
+        """Queues a figure spec for rendering, returns a future of its PNG path."""
+        if not spec.get('path'):
+            raise ValueError('A queued figure spec needs a path to write to.')
+        future = self.executor.submit(render_figure, spec)
+        self.futures.append(future)
+        return future
+
+    def wait(self) -> list:
+        """Waits for every queued figure and returns the paths written (raises the first rendering error)."""
+        paths = [future.result() for future in self.futures]
+        self.futures = []
+        return paths
+
+    def close(self) -> list:
+        try:
+            return self.wait()
+        finally:
+            self.executor.shutdown(wait=True)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+
+_default_queue = None
+
+
+def default_queue() -> PlotQueue:
+    """Shared background queue used by the analysis classes when a plot_dir is given."""
+    global _default_queue
+    if _default_queue is None:
+        _default_queue = PlotQueue()
+    return _default_queue
+
+
+def wait_figures() -> list:
+    """Waits for every figure submitted to the shared queue and returns their paths."""
+    return default_queue().wait() if _default_queue is not None else []
@@ -0,0 +1,100 @@
+import numpy as np
+from contextlib import nullcontext
+
+# Illumination flicker correction and background subtraction of a float32 frame stack
+# (frames x height x width, or frames x channels x height x width, in memory or memory
+# mapped). Everything works in place on blocks of frames or rows, so the stack is never
+# copied and never decoded again. Statistics are per frame, and per channel if there are any.
+
+
+def blocks(n: int, size: int):
+    """Yields slices covering range(n) in steps of size (at least 1)."""
+    if size < 1:
+        raise ValueError(f'Block size must be at least 1, got {size}')
+    for start in range(0, n, size):
+        yield slice(start, min(start + size, n))
+
+
+def frame_statistics(frames: np.ndarray, block_frames: int=64) -> dict:
+    """
+    Mean and standard deviation of every frame (and channel), in one pass over the stack
+    block by block. The arrays have the shape of the stack without the image axes.
+
+    Args:
+        frames: stack of frames (frames [x channels] x height x width)
+        block_frames: number of frames read at a time
+    """
+    mean = np.empty(frames.shape[:-2])
+    std = np.empty(frames.shape[:-2])
+    for block in blocks(frames.shape[0], block_frames):
+        pixels = frames[block].reshape(*mean[block].shape, -1)
+        mean[block] = pixels.mean(axis=-1, dtype=np.float64)
+        std[block] = pixels.std(axis=-1, dtype=np.float64)
+    return {'mean': mean, 'std': std}
+
+
+def normalise_frames(frames: np.ndarray, means: np.ndarray=None, reference: float=1., block_frames: int=64) -> np.ndarray:
+    """
+    Divides every frame (and channel) by its mean intensity in place, removing illumination flicker.
+
+    Args:
+        frames: float stack of frames, modified in place
+        means: mean of every frame and channel (computed with frame_statistics if not given)
+        reference: intensity the frames are scaled to (1 keeps the old renormalise behaviour,
+            the mean of means keeps the original intensity scale)
+        block_frames: number of frames processed at a time
+    """
+    if means is None:
+        means = frame_statistics(frames, block_frames)['mean']
+    for block in blocks(frames.shape[0], block_frames):
+        frames[block] /= means[block][..., None, None]
+        if reference != 1:
+            frames[block] *= reference
+    return frames
+
+
+def median_background(frames: np.ndarray, max_bytes: float=256e6) -> np.ndarray:
+    """
+    Temporal median of every pixel, computed over bands of rows so at most max_bytes of the
+    stack are copied at a time (or one row, if a row of every frame is larger than that).
+
+    Args:
+        frames: stack of frames (frames [x channels] x height x width)
+        max_bytes: memory allowed for the copy of a band of rows
+    """
+    height = frames.shape[-2]
+    row_bytes = frames.nbytes // height
+    background = np.empty(frames.shape[1:], dtype=frames.dtype)
+    for rows in blocks(height, max(1, int(max_bytes // row_bytes))):
+        background[..., rows, :] = np.median(frames[..., rows, :], axis=0)
+    return background
+
+
+def subtract_background(frames: np.ndarray, background: np.ndarray, block_frames: int=64) -> np.ndarray:
+    """Subtracts a static background from every frame in place."""
+    for block in blocks(frames.shape[0], block_frames):
+        frames[block] -= background
+    return frames
+
+
+def preprocess(frames: np.ndarray, renormalise: bool=False, background: bool=False, means: np.ndarray=None,
+               block_frames: int=64, telemetry=None) -> np.ndarray:
+    """
+    Flicker correction then temporal-median background subtraction of a float32 stack, in place.
+
+    Args:
+        frames: float stack of frames, modified in place
+        renormalise: divide every frame by its mean intensity
+        background: subtract the temporal median of every pixel
+        means: mean of every frame if already known (e.g. collected while decoding)
+        block_frames: number of frames processed at a time
+        telemetry: optional Telemetry timing the renormalise and background stages
+    """
+    stage = telemetry.stage if telemetry is not None else (lambda name: nullcontext())
+    if renormalise:
+        with stage('renormalise'):
+            normalise_frames(frames, means, block_frames=block_frames)
+    if background:
+        with stage('background'):
+            subtract_background(frames, median_background(frames), block_frames)
+    return frames
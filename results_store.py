@@ -0,0 +1,229 @@
+import os
+import csv
+import json
+import sqlite3
+import datetime
+import numpy as np
+from contextlib import contextmanager
+
+DEFAULT_STORE = 'results.sqlite'
+
+# columns of the results table that can be set directly, everything else goes into 'extra'
+COLUMNS = ['sample', 'method', 'angle', 'q_min', 'q_max', 'run_timestamp',
+           'tau', 'tau_error', 'diameter', 'diameter_error', 'alpha', 'D', 'source']
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS results (
+    id INTEGER PRIMARY KEY,
+    sample TEXT NOT NULL,
+    method TEXT NOT NULL,
+    angle REAL,
+    q_min REAL,
+    q_max REAL,
+    run_timestamp TEXT NOT NULL,
+    tau REAL,
+    tau_error REAL,
+    diameter REAL,
+    diameter_error REAL,
+    alpha REAL,
+    D REAL,
+    source TEXT,
+    extra TEXT
+);
+CREATE INDEX IF NOT EXISTS results_sample ON results (sample, method, angle, run_timestamp);
+CREATE INDEX IF NOT EXISTS results_method ON results (method, run_timestamp);
+"""
+
+
+def now() -> str:
+    """Current time as an ISO timestamp (to the second), the format of run_timestamp."""
+    return datetime.datetime.now().isoformat(timespec='seconds')
+
+
+class ResultsStore:
+    """
+    Local SQLite store of DLS and DDM results, one row per fitted quantity, indexed by
+    sample, method, angle (DLS) or q range (DDM) and run timestamp.
+
+    Runs append to it instead of writing one CSV per folder, and plots query it, so
+    results of many runs can be aggregated without re-running any analysis.
+    """
+    def __init__(self, path: str=DEFAULT_STORE):
+        self.path = path
+        self.connection = sqlite3.connect(path)
+        self.connection.row_factory = sqlite3.Row
+        self.connection.executescript(SCHEMA)
+
+    def close(self):
+        self.connection.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def append(self, sample: str, method: str, run_timestamp: str=None, **fields) -> int:
+        """
+        Adds one result and returns its id. Keyword arguments which are not columns
+        (see COLUMNS) are kept as JSON in the 'extra' column.
+        """
+        return self.append_many([dict(fields, sample=sample, method=method, run_timestamp=run_timestamp)])[0]
+
+    def append_many(self, rows: list) -> list:
+        """Adds several results (dictionaries) in one transaction and returns their ids."""
+        timestamp = now()
+        ids = []
+        with self.connection:
+            for row in rows:
+                row = dict(row)
+                row['run_timestamp'] = row.get('run_timestamp') or timestamp
+                values = [_to_sql(row.pop(column, None)) for column in COLUMNS]
+                extra = json.dumps({key: _to_sql(value) for key, value in row.items()}) if row else None
+                cursor = self.connection.execute(
+                    f"INSERT INTO results ({', '.join(COLUMNS)}, extra) VALUES ({', '.join('?' * (len(COLUMNS) + 1))})",
+                    values + [extra])
+                ids.append(cursor.lastrowid)
+        return ids
+
+    def _where(self, sample=None, method=None, angle=None, sample_like=None, since=None, until=None, latest=False):
+        """Builds the WHERE clause and parameters shared by query and aggregate."""
+        clauses, params = [], []
+        for column, value in (('sample', sample), ('method', method), ('angle', angle)):
+            if value is not None:
+                clauses.append(f'{column} = ?')
+                params.append(value)
+        if sample_like is not None:
+            clauses.append('sample LIKE ?')
+            params.append(sample_like)
+        if since is not None:
+            clauses.append('run_timestamp >= ?')
+            params.append(since)
+        if until is not None:
+            clauses.append('run_timestamp <= ?')
+            params.append(until)
+        if latest:
+            # only the most recent run of each sample and method
+            clauses.append('run_timestamp = (SELECT MAX(r.run_timestamp) FROM results r '
+                           'WHERE r.sample = results.sample AND r.method = results.method)')
+        return (' WHERE ' + ' AND '.join(clauses)) if clauses else '', params
+
+    def query(self, sample: str=None, method: str=None, angle: float=None, sample_like: str=None,
+              since: str=None, until: str=None, latest: bool=False, order_by: str='angle') -> list:
+        """
+        Returns the matching results as a list of dictionaries ('extra' is decoded).
+
+        Args:
+            sample: exact sample name
+            method: e.g. 'dls', 'dls-block', 'ddm'
+            angle: DLS scattering angle in degrees
+            sample_like: SQL LIKE pattern on the sample name, e.g. '0.50micro%'
+            since: only runs at or after this ISO timestamp
+            until: only runs at or before this ISO timestamp
+            latest: only the most recent run of each sample and method
+            order_by: column to sort by
+        """
+        if order_by not in COLUMNS + ['id']:
+            raise ValueError(f"Cannot order by '{order_by}'")
+        where, params = self._where(sample, method, angle, sample_like, since, until, latest)
+        rows = self.connection.execute(f'SELECT * FROM results{where} ORDER BY {order_by}, id', params).fetchall()
+
+        results = []
+        for row in rows:
+            result = dict(row)
+            result.update(json.loads(result.pop('extra') or '{}'))
+            results.append(result)
+        return results
+
+    def column(self, name: str, **filters) -> np.ndarray:
+        """Returns one column of the matching results as a numpy array (same filters as query)."""
+        return np.array([result[name] for result in self.query(**filters)], dtype=float)
+
+    def aggregate(self, value: str='diameter', error: str='diameter_error', by=('sample', 'method', 'angle'),
+                  **filters) -> list:
+        """
+        Aggregates a value across runs inside SQLite, grouped by the given columns.
+        Returns per group the count, mean, standard deviation, and the inverse variance
+        weighted mean and its error (rows with a positive error only).
+
+        Args:
+            value: column to aggregate
+            error: column holding the error of value
+            by: columns to group by
+            filters: same filters as query
+        """
+        for column in (value, error, *by):
+            if column not in COLUMNS:
+                raise ValueError(f"Unknown column '{column}'")
+        where, params = self._where(**filters)
+        group = ', '.join(by)
+        rows = self.connection.execute(
+            f"SELECT {group}, COUNT({value}) AS n, AVG({value}) AS mean, "
+            f"AVG({value} * {value}) AS mean_square, "
+            f"SUM(CASE WHEN {error} > 0 THEN {value} / ({error} * {error}) END) AS weighted_sum, "
+            f"SUM(CASE WHEN {error} > 0 THEN 1 / ({error} * {error}) END) AS weight "
+            f"FROM results{where} GROUP BY {group} ORDER BY {group}", params).fetchall()
+
+        groups = []
+        for row in rows:
+            row = dict(row)
+            n, mean, mean_square = row.pop('n'), row.pop('mean'), row.pop('mean_square')
+            weighted_sum, weight = row.pop('weighted_sum'), row.pop('weight')
+            variance = (mean_square - mean**2) * n / (n - 1) if n and n > 1 else None
+            row.update(
+                n=n,
+                mean=mean,
+                std=float(np.sqrt(max(variance, 0))) if variance is not None else None,
+                weighted_mean=weighted_sum / weight if weight else None,
+                weighted_error=float(1 / np.sqrt(weight)) if weight else None,
+            )
+            groups.append(row)
+        return groups
+
+
+def _to_sql(value):
+    """Converts numpy scalars and arrays to values sqlite and json can store."""
+    if isinstance(value, np.ndarray):
+        return value.tolist()
+    if isinstance(value, np.generic):
+        return value.item()
+    return value
+
+
+def open_store(store) -> ResultsStore:
+    """Accepts either a ResultsStore or a path to one."""
+    return store if isinstance(store, ResultsStore) else ResultsStore(store)
+
+
+@contextmanager
+def using_store(store):
+    """open_store for a with block: a store opened from a path is closed at the end, a ResultsStore is left open."""
+    if isinstance(store, ResultsStore):
+        yield store
+    else:
+        with ResultsStore(store) as opened:
+            yield opened
+
+
+def import_taus_csv(filename: str, store, sample: str=None, method: str='dls', run_timestamp: str=None) -> int:
+    """
+    Imports a '<dir>_taus.csv' file written by DLS.AutoCorrelation into the store.
+    The sample defaults to the name in the file name, the timestamp to the file's modification time.
+    Empty cells (e.g. the taus of results kept only as diameters) are stored as NULL.
+    Returns the number of rows imported.
+    """
+    sample = sample or os.path.basename(filename).replace('_taus.csv', '')
+    run_timestamp = run_timestamp or datetime.datetime.fromtimestamp(os.path.getmtime(filename)).isoformat(timespec='seconds')
+
+    rows = []
+    with open(filename, newline='') as file:
+        reader = csv.reader(file)
+        next(reader, None)
+        for row in reader:
+            degree, tau, tau_error, diameter, diameter_error = [float(cell) if cell.strip() else None for cell in row]
+            rows.append({'sample': sample, 'method': method, 'run_timestamp': run_timestamp, 'angle': degree,
+                         'tau': tau, 'tau_error': tau_error, 'diameter': diameter,
+                         'diameter_error': diameter_error, 'source': filename})
+    with using_store(store) as store:
+        store.append_many(rows)
+    return len(rows)
@@ -0,0 +1,103 @@
+import numpy as np
+from functools import lru_cache
+
+
+@lru_cache(maxsize=64)
+def bandstop_sos(fs: float, bands: tuple, order: int=2) -> np.ndarray:
+    """
+    Butterworth band-stop filter in second-order sections, one stage per (low, high) band.
+    Designs are cached per (fs, bands, order) so repeated files at the same sampling
+    rate reuse them. The returned array is shared between calls and must not be modified.
+    Without bands it has no sections, and filtering with it leaves the signal unchanged.
+
+    Args:
+        fs: sampling frequency (Hz)
+        bands: tuple of (low, high) stop bands in Hz
+        order: Butterworth order of each band
+    """
+    from scipy.signal import butter
+
+    if not bands:
+        return np.zeros((0, 6))
+    return np.vstack([butter(order, [low, high], btype='bandstop', fs=fs, output='sos') for low, high in bands])
+
+
+def mains_bands(fs: float, noise_freq: float, n_harmonics: int=1, width: float=2.) -> tuple:
+    """
+    Stop bands of width 'width' (Hz) centred on noise_freq and its first n_harmonics multiples,
+    skipping any harmonic too close to the Nyquist frequency to be filtered.
+    """
+    nyquist = fs / 2
+    return tuple((k * noise_freq - width / 2, k * noise_freq + width / 2)
+                 for k in range(1, n_harmonics + 1) if k * noise_freq + width / 2 < nyquist)
+
+
+def bandstop_filter(x: np.ndarray, fs: float, bands, order: int=2, axis: int=-1) -> np.ndarray:
+    """
+    Zero-phase band-stop filtering of x along 'axis' in one sosfiltfilt call, so a whole
+    2D array (a batch of traces or an ISF with one column per q) is filtered at once.
+
+    Args:
+        x: signal(s) to filter
+        fs: sampling frequency (Hz)
+        bands: (low, high) band or sequence of bands to remove, in Hz (none returns a copy of x)
+        order: Butterworth order of each band
+        axis: axis holding the samples
+    """
+    from scipy.signal import sosfiltfilt
+
+    bands = np.reshape(np.asarray(bands, dtype=float), (-1, 2))
+    sos = bandstop_sos(float(fs), tuple((float(low), float(high)) for low, high in bands), order)
+    if sos.size == 0:
+        return np.array(x, dtype=float)
+    return sosfiltfilt(sos, x, axis=axis)
+
+
+def notch_filter(x: np.ndarray, fs: float, noise_freq: float=100., n_harmonics: int=1, width: float=2.,
+                 order: int=2, axis: int=-1) -> np.ndarray:
+    """
+    Removes mains noise at noise_freq (and optionally its harmonics) from x along 'axis'.
+    With the defaults this is the butter(2, [f0 - 1, f0 + 1], 'bandstop') filter used by the DLS scripts.
+
+    Args:
+        x: signal(s) to filter
+        fs: sampling frequency (Hz)
+        noise_freq: fundamental frequency of the noise (Hz)
+        n_harmonics: number of harmonics to remove, including the fundamental
+        width: width of each stop band (Hz)
+        order: Butterworth order of each band
+        axis: axis holding the samples
+    """
+    return bandstop_filter(x, fs, mains_bands(fs, noise_freq, n_harmonics, width), order=order, axis=axis)
+
+
+class StreamingNotchFilter:
+    """
+    Causal version of notch_filter for data arriving in chunks. The filter state is carried
+    from one chunk to the next, so the output does not depend on how the signal is split.
+    Zero-phase filtering needs the whole signal, so this applies the filter forwards only.
+    """
+    def __init__(self, fs: float, noise_freq: float=100., n_harmonics: int=1, width: float=2., order: int=2):
+        """
+        Args:
+            fs: sampling frequency (Hz)
+            noise_freq: fundamental frequency of the noise (Hz)
+            n_harmonics: number of harmonics to remove, including the fundamental
+            width: width of each stop band (Hz)
+            order: Butterworth order of each band
+        """
+        self.sos = bandstop_sos(float(fs), mains_bands(fs, noise_freq, n_harmonics, width), order)
+        self.zi = None
+
+    def __call__(self, chunk: np.ndarray) -> np.ndarray:
+        """Filters the next chunk of the signal."""
+        from scipy.signal import sosfilt, sosfilt_zi
+
+        chunk = np.asarray(chunk, dtype=float)
+        if chunk.size == 0 or self.sos.size == 0:
+            return chunk
+        # start from the steady state of the first sample to avoid a switch-on transient
+        if self.zi is None:
+            self.zi = sosfilt_zi(self.sos) * chunk[0]
+        filtered, self.zi = sosfilt(self.sos, chunk, zi=self.zi)
+        return filtered
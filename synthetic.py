@@ -0,0 +1,207 @@
+import os
+import numpy as np
+from DDM_Fourier import kB, T, mu
+import dls_automator
+
+# Synthetic inputs with known physics, for benchmarks and accuracy checks without lab data.
+# Everything is deterministic for a given seed, and the output does not depend on chunk sizes.
+# The physical constants are those of the analysis each input is made for (DDM_Fourier for
+# videos, dls_automator for DLS traces), so a round trip gives back the input exactly.
+
+
+def diffusion_coefficient(diameter: float) -> float:
+    """Stokes-Einstein diffusion coefficient (μm²/s) of a sphere of the given diameter (μm), as in fit_diffusion."""
+    return kB * T / (3 * np.pi * mu * diameter * 1e-6) * 1e12
+
+
+def tau_for_diameter(diameter: float, angle: float, wavelength: float=dls_automator.WAVELENGTH) -> float:
+    """
+    DLS decay time (ms) of particles of the given diameter (μm) at a scattering angle (degrees),
+    the inverse of DLS.size_from_tau.
+    """
+    q = (4 * np.pi * np.sin(np.radians(angle) / 2)) / wavelength
+    return diameter * 1e-6 * 3 * np.pi * dls_automator.visc / (dls_automator.kB * dls_automator.T * q**2) * 1e3
+
+
+def brownian_trajectories(n_frames: int, n_particles: int, shape, step: float, drift=(0., 0.), seed: int=0,
+                          chunk_frames: int=64):
+    """
+    Yields particle positions (pixels) in chunks of shape n x n_particles x 2 (row, column),
+    for independent random walks with periodic boundaries.
+
+    Args:
+        n_frames: total number of frames
+        n_particles: number of particles
+        shape: (height, width) of the frames
+        step: standard deviation (pixels) of the displacement per frame along each axis
+        drift: (row, column) displacement (pixels) added every frame
+        seed: seed of the random generator
+        chunk_frames: number of frames per chunk
+    """
+    rng = np.random.default_rng(seed)
+    size = np.array(shape, dtype=float)
+    position = rng.uniform(0, 1, (n_particles, 2)) * size
+    drift = np.asarray(drift, dtype=float)
+
+    for start in range(0, n_frames, chunk_frames):
+        n = min(chunk_frames, n_frames - start)
+        steps = rng.normal(0, step, (n, n_particles, 2)) + drift
+        positions = position + np.cumsum(steps, axis=0)
+        position = positions[-1]
+        yield positions % size
+
+
+def render_frames(positions: np.ndarray, shape, sigma: float, amplitude: float=1., background: float=0.) -> np.ndarray:
+    """
+    Renders Gaussian spots at the given positions (frames x particles x 2) as a float32 stack.
+
+    A 2D Gaussian is separable, so each frame is the product of a (height x particles) and a
+    (particles x width) matrix of 1D profiles: one batched matrix multiply per chunk
+    instead of a loop over particles. Distances wrap around the edges.
+    """
+    height, width = shape
+    positions = positions.astype(np.float32)
+    rows = np.arange(height, dtype=np.float32)
+    columns = np.arange(width, dtype=np.float32)
+
+    # wrapped distance of every pixel row / column to every particle
+    dy = rows[None, :, None] - positions[:, None, :, 0]
+    dx = columns[None, None, :] - positions[:, :, None, 1]
+    dy = np.minimum(np.abs(dy), height - np.abs(dy))
+    dx = np.minimum(np.abs(dx), width - np.abs(dx))
+    profile_y = np.exp(dy**2 * np.float32(-0.5 / sigma**2))
+    profile_x = np.exp(dx**2 * np.float32(-0.5 / sigma**2))
+
+    frames = np.matmul(profile_y, profile_x)
+    if amplitude != 1:
+        frames *= amplitude
+    if background:
+        frames += background
+    return frames
+
+
+def brownian_stack(n_frames: int, shape=(256, 256), diameter: float=1., pixel_size: float=0.1, fps: float=30.,
+                   n_particles: int=200, drift=(0., 0.), sigma: float=None, amplitude: float=100.,
+                   background: float=20., noise: float=0., seed: int=0, chunk_frames: int=64):
+    """
+    Yields float32 chunks of a video of Brownian particles with a known diameter.
+
+    Args:
+        n_frames: total number of frames
+        shape: (height, width) of the frames in pixels
+        diameter: particle diameter (μm), sets the diffusion coefficient
+        pixel_size: pixel size (μm/pixel)
+        fps: frame rate (frames/s)
+        n_particles: number of particles in the field of view
+        drift: (row, column) drift velocity in μm/s
+        sigma: spot width in pixels (defaults to the particle radius, at least one pixel)
+        amplitude: peak intensity of a spot
+        background: constant background intensity
+        noise: standard deviation of additive Gaussian camera noise
+        seed: seed of the random generator
+        chunk_frames: number of frames rendered at a time (bounds the memory used)
+    """
+    step = np.sqrt(2 * diffusion_coefficient(diameter) / fps) / pixel_size
+    drift = np.asarray(drift, dtype=float) / fps / pixel_size
+    sigma = sigma or max(diameter / 2 / pixel_size, 1.)
+
+    # camera noise has its own generator so the trajectories do not depend on it
+    noise_rng = np.random.default_rng([seed, 1])
+    for positions in brownian_trajectories(n_frames, n_particles, shape, step, drift, seed, chunk_frames):
+        frames = render_frames(positions, shape, sigma, amplitude, background)
+        if noise:
+            frames += noise_rng.normal(0, noise, frames.shape).astype(np.float32)
+        yield frames
+
+
+def write_video(path: str, n_frames: int, fps: float=30., codec: str='FFV1', **options) -> str:
+    """
+    Writes a synthetic Brownian video to an 8-bit greyscale AVI, rendered chunk by chunk.
+    FFV1 is lossless, so the frames read back are exactly the rendered ones clipped to 0-255.
+    Extra keyword arguments are passed to brownian_stack. Returns the path.
+    """
+    from ImageStack import _cv2
+    cv2 = _cv2()
+
+    shape = options.get('shape', (256, 256))
+    writer = cv2.VideoWriter(path, cv2.VideoWriter_fourcc(*codec), fps, (shape[1], shape[0]), isColor=False)
+    if not writer.isOpened():
+        raise ValueError(f"Could not open a '{codec}' video writer for {path}")
+    try:
+        for frames in brownian_stack(n_frames, fps=fps, **options):
+            for frame in np.clip(np.rint(frames), 0, 255).astype(np.uint8):
+                writer.write(frame)
+    finally:
+        writer.release()
+    return path
+
+
+def write_memmap(path: str, n_frames: int, dtype=np.float32, **options) -> np.memmap:
+    """
+    Writes a synthetic Brownian stack to a '.npy' file (frames x height x width) without holding
+    it in memory, and returns it memory mapped. Extra keyword arguments are passed to brownian_stack.
+    """
+    shape = options.get('shape', (256, 256))
+    stack = np.lib.format.open_memmap(path, mode='w+', dtype=dtype, shape=(n_frames, *shape))
+    start = 0
+    for frames in brownian_stack(n_frames, **options):
+        stack[start:start + len(frames)] = frames
+        start += len(frames)
+    stack.flush()
+    return stack
+
+
+def dls_trace(n_samples: int, tau: float, fs: float=1000., noise_freq: float=100., noise_amplitude: float=0.5,
+              n_harmonics: int=1, offset: float=1., seed: int=0):
+    """
+    Synthetic DLS voltage trace whose autocorrelation decays as exp(-2t / tau), plus mains pickup.
+    The fluctuation is an AR(1) process with unit variance. Returns (t in ms, voltage).
+
+    Args:
+        n_samples: number of samples
+        tau: decay time (ms)
+        fs: sampling frequency (Hz)
+        noise_freq: mains frequency (Hz)
+        noise_amplitude: amplitude of the mains pickup (V), shared by its harmonics
+        n_harmonics: number of mains harmonics, including the fundamental
+        offset: mean voltage (V)
+        seed: seed of the random generator
+    """
+    from scipy.signal import lfilter
+
+    rng = np.random.default_rng(seed)
+    t = np.arange(n_samples) * 1000 / fs
+    a = np.exp(-2 * (1000 / fs) / tau)
+
+    # start from the stationary distribution so there is no transient
+    innovations = rng.normal(size=n_samples)
+    innovations[0] /= np.sqrt(1 - a**2)
+    x = lfilter([np.sqrt(1 - a**2)], [1, -a], innovations)
+
+    mains = sum(np.sin(2 * np.pi * k * noise_freq * t * 1e-3) for k in range(1, n_harmonics + 1))
+    return t, offset + x + noise_amplitude * mains
+
+
+def write_prn(path: str, t: np.ndarray, voltage: np.ndarray, header=('Synthetic DLS trace', 'time (ms)\tvoltage (V)', '')):
+    """Writes a (time, voltage) trace as a tab separated .prn file with the usual three header rows."""
+    with open(path, 'w') as file:
+        file.write('\n'.join(header) + '\n')
+        np.savetxt(file, np.column_stack([t, voltage]), fmt='%.6f', delimiter='\t')
+    return path
+
+
+def write_dls_folder(folder: str, diameter: float, angles=(30.0, 45.0), n_samples: int=1_000_000,
+                     fs: float=1000., seed: int=0, **options) -> list:
+    """
+    Writes one '<angle>deg.prn' trace per angle for particles of a known diameter (μm), in the
+    layout DLS expects. The DLS fits take the lag index as the time in ms, so at the default
+    fs of 1 kHz DLS.AutoCorrelation recovers the diameter. Extra keyword arguments go to dls_trace.
+    Returns the paths written.
+    """
+    os.makedirs(folder, exist_ok=True)
+    paths = []
+    for i, angle in enumerate(angles):
+        tau = tau_for_diameter(diameter, angle)
+        t, voltage = dls_trace(n_samples, tau, fs=fs, seed=seed + i, **options)
+        paths.append(write_prn(os.path.join(folder, f'{angle:.1f}deg.prn'), t, voltage))
+    return paths
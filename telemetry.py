@@ -0,0 +1,158 @@
+import os
+import sys
+import json
+import time
+import resource
+import threading
+from contextlib import contextmanager
+
+
+def current_rss() -> int:
+    """Current resident set size of this process in bytes (the peak so far where that is all the OS gives)."""
+    try:
+        with open('/proc/self/statm') as file:
+            return int(file.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+    except (OSError, ValueError, IndexError):
+        return peak_rss()
+
+
+def peak_rss() -> int:
+    """Peak resident set size of this process in bytes, as reported by the OS."""
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return rss if sys.platform == 'darwin' else rss * 1024
+
+
+class MemorySampler:
+    """Samples the RSS of the process from a background thread and keeps the peak and the samples."""
+    def __init__(self, interval: float=0.05):
+        self.interval = interval
+        self.samples = []
+        self.peak = 0
+        self._stop = threading.Event()
+        self._thread = None
+
+    def _run(self):
+        while not self._stop.is_set():
+            self.sample()
+            self._stop.wait(self.interval)
+
+    def sample(self):
+        rss = current_rss()
+        self.samples.append((time.perf_counter(), rss))
+        self.peak = max(self.peak, rss)
+
+    def start(self):
+        if self._thread is None:
+            self._stop.clear()
+            self._thread = threading.Thread(target=self._run, daemon=True)
+            self._thread.start()
+
+    def stop(self):
+        if self._thread is not None:
+            self._stop.set()
+            self._thread.join()
+            self._thread = None
+            self.sample()
+
+
+class Telemetry:
+    """
+    Stage timers, counters and peak memory of a run.
+
+    Stages are timed with 'with telemetry.stage(name):'. A stage run from several worker
+    threads adds up the time spent in every thread, so it can exceed the wall time.
+    Work inside 'with telemetry.track():' is sampled for memory and, if enabled, profiled.
+    """
+    def __init__(self, memory_interval: float=0.05, profile=False):
+        """
+        Args:
+            memory_interval: seconds between memory samples
+            profile: enable cProfile inside track(); a path also saves the stats there.
+                cProfile only sees the thread that calls track(), so profile with n_jobs=1.
+        """
+        self.stages = {}
+        self.counters = {}
+        self.memory = MemorySampler(memory_interval)
+        self.profile = profile
+        self.profiler = None
+        self.created = time.perf_counter()
+        self._lock = threading.Lock()
+        self._depth = 0
+
+    @contextmanager
+    def stage(self, name: str):
+        """Times the enclosed block as one call of the named stage."""
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            elapsed = time.perf_counter() - start
+            with self._lock:
+                stage = self.stages.setdefault(name, {'time': 0., 'calls': 0})
+                stage['time'] += elapsed
+                stage['calls'] += 1
+
+    def timed(self, name: str, function):
+        """Wraps a function so every call of it is timed as the named stage."""
+        def wrapper(*args, **kwargs):
+            with self.stage(name):
+                return function(*args, **kwargs)
+        return wrapper
+
+    def count(self, name: str, n: int=1):
+        """Adds n to the named counter."""
+        with self._lock:
+            self.counters[name] = self.counters.get(name, 0) + n
+
+    @contextmanager
+    def track(self):
+        """Samples memory (and profiles if enabled) for the enclosed block, can be nested."""
+        self._depth += 1
+        if self._depth == 1:
+            self.memory.start()
+            if self.profile:
+                import cProfile
+                self.profiler = self.profiler or cProfile.Profile()
+                self.profiler.enable()
+        try:
+            yield self
+        finally:
+            self._depth -= 1
+            if self._depth == 0:
+                if self.profiler is not None:
+                    self.profiler.disable()
+                    if isinstance(self.profile, str):
+                        self.profiler.dump_stats(self.profile)
+                self.memory.stop()
+
+    def profile_stats(self, sort: str='cumulative', limit: int=25) -> str:
+        """The top functions of the cProfile run as text (empty if profiling was not enabled)."""
+        if self.profiler is None:
+            return ''
+        import io
+        import pstats
+        stream = io.StringIO()
+        pstats.Stats(self.profiler, stream=stream).sort_stats(sort).print_stats(limit)
+        return stream.getvalue()
+
+    def report(self) -> dict:
+        """Structured report of the stages, counters and memory so far."""
+        with self._lock:
+            stages = {name: dict(stage, mean=stage['time'] / stage['calls']) for name, stage in self.stages.items()}
+            counters = dict(self.counters)
+        return {
+            'elapsed': time.perf_counter() - self.created,
+            'stages': stages,
+            'counters': counters,
+            'memory': {
+                'peak_sampled': self.memory.peak,
+                'peak_rss': peak_rss(),
+                'n_samples': len(self.memory.samples),
+            },
+        }
+
+    def save(self, path: str):
+        """Writes the report to a JSON file."""
+        with open(path, 'w') as file:
+            json.dump(self.report(), file, indent=2)
+        return path
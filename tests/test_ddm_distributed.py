@@ -0,0 +1,47 @@
+import os
+import sys
+import numpy as np
+import pytest
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+from ddm_distributed import tiles, tile_shape, run_local
+
+
+@pytest.fixture(scope='module')
+def video(tmp_path_factory):
+    """A short synthetic video whose 50x45 frames a 3x3 grid does not divide."""
+    from synthetic import write_video
+
+    path = str(tmp_path_factory.mktemp('distributed') / 'uneven.avi')
+    return write_video(path, 40, shape=(50, 45), n_particles=20, seed=1)
+
+
+def test_tiles_share_one_shape():
+    bounds = tiles((50, 45), (3, 3))
+    assert len(bounds) == 9
+    assert {(r1 - r0, c1 - c0) for r0, r1, c0, c1 in bounds} == {tile_shape((50, 45), (3, 3))} == {(16, 15)}
+    assert max(r1 for r0, r1, c0, c1 in bounds) == 48 and max(c1 for r0, r1, c0, c1 in bounds) == 45
+
+
+def test_tile_grid_larger_than_frame():
+    with pytest.raises(ValueError):
+        tiles((4, 4), (3, 3))
+
+
+def test_uneven_tile_grid(video):
+    from DDM_Fourier import DDM_Fourier
+
+    idts = np.array([1, 2, 5, 10])
+    job = run_local([video], pixel_size=0.1, particle_size=1., n_workers=1, idts=idts, maxNCouples=10,
+                    lag_shards=2, tile_grid=(3, 3), timeout=120)
+    assert job.tile_isf.shape == (9, idts.size, job.isf.shape[-1])
+    assert np.allclose(np.diff(job.qs), 2*np.pi / (16 * 0.1))
+
+    # every tile is the ISF of its crop of the frames
+    ddm = DDM_Fourier(video, pixel_size=0.1, particle_size=1.)
+    for (r0, r1, c0, c1), isf in zip(job.tiles, job.tile_isf):
+        crop = DDM_Fourier.from_frames(ddm.frames[:, r0:r1, c0:c1], 0.1, 1., ddm.fps)
+        sums, counts = crop.accumulate_isf(idts, 10, n_jobs=1)
+        assert np.allclose(isf, sums / counts[:, None], equal_nan=True)
@@ -0,0 +1,31 @@
+import os
+import sys
+import warnings
+import numpy as np
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+from ddm_ensemble import merge_accumulators
+
+
+def test_merge_weights_by_couples():
+    a = {'sums': np.array([[2., 4.], [6., 6.]]), 'counts': np.array([2, 3]), 'dts': np.array([0.1, 0.2])}
+    b = {'sums': np.array([[1., 1.], [0., 3.]]), 'counts': np.array([1, 1]), 'dts': np.array([0.1, 0.4])}
+    merged = merge_accumulators([a, b])
+    assert np.allclose(merged['isf'], [[1., 5 / 3], [1.5, 2.25]])
+    assert np.array_equal(merged['counts'], [3, 4])
+    assert np.allclose(merged['dts'], [0.1, 0.25])
+    assert merged['kept'].all()
+
+
+def test_merge_drops_lags_without_couples():
+    # the last lag is too long for both videos, the middle one for the second video only
+    a = {'sums': np.array([[2.], [3.], [0.]]), 'counts': np.array([2, 1, 0]), 'dts': np.array([0.1, 0.5, np.nan])}
+    b = {'sums': np.array([[4.], [0.], [0.]]), 'counts': np.array([2, 0, 0]), 'dts': np.array([0.1, np.nan, np.nan])}
+    with warnings.catch_warnings():
+        warnings.simplefilter('error')
+        merged = merge_accumulators([a, b])
+    assert np.array_equal(merged['kept'], [True, True, False])
+    assert np.allclose(merged['isf'], [[1.5], [3.]])
+    assert np.allclose(merged['dts'], [0.1, 0.5])
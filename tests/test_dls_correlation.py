@@ -0,0 +1,77 @@
+import os
+import sys
+import numpy as np
+import pytest
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+from dls_correlation import autocorrelation, MultiTauCorrelator
+
+
+def direct_autocorrelation(v):
+    """The O(N²) loop the DLS scripts used before the FFT version."""
+    N = len(v)
+    ac = np.zeros(N-1)
+    m = np.mean(v)
+    for j in range(1, N):
+        ac[j-1] = np.mean((v[0:N-j] - m) * (v[j:N] - m))
+    return ac
+
+
+def test_fft_matches_direct_loop():
+    v = np.random.default_rng(0).normal(size=1001).cumsum()
+    expected = direct_autocorrelation(v)
+    assert np.allclose(autocorrelation(v), expected, rtol=1e-10, atol=1e-10 * np.abs(expected).max())
+    assert np.allclose(autocorrelation(v, max_lag=50), expected[:50], rtol=1e-10)
+
+
+def test_fft_along_axis():
+    signals = np.random.default_rng(1).normal(size=(3, 200))
+    ac = autocorrelation(signals.T, max_lag=20, axis=0)
+    assert ac.shape == (20, 3)
+    for i, v in enumerate(signals):
+        assert np.allclose(ac[:, i], direct_autocorrelation(v)[:20])
+
+
+@pytest.fixture(scope='module')
+def trace():
+    # an AR(1) process, correlated over ~20 samples
+    rng = np.random.default_rng(2)
+    noise = rng.normal(size=20000)
+    x = np.empty_like(noise)
+    x[0] = noise[0]
+    for i in range(1, x.size):
+        x[i] = 0.95 * x[i-1] + noise[i]
+    return x + 5
+
+
+def correlate(x, chunk_sizes):
+    correlator = MultiTauCorrelator(m=8, n_levels=10)
+    start = 0
+    for size in chunk_sizes:
+        correlator.update(x[start:start + size])
+        start += size
+    correlator.update(x[start:])
+    return correlator.result()
+
+
+def test_multi_tau_chunk_invariance(trace):
+    # only the covariance is exact: the variance of the products depends on the offset taken
+    # from the first chunk
+    lags, acf, variance = correlate(trace, [])
+    for chunk_sizes in ([1, 2, 3, 4097], [999] * 20, [7] * 500):
+        chunked_lags, chunked_acf, _ = correlate(trace, chunk_sizes)
+        assert np.array_equal(chunked_lags, lags)
+        assert np.allclose(chunked_acf, acf, rtol=1e-9, atol=1e-12)
+
+
+def test_multi_tau_level_zero(trace):
+    lags, acf, variance = correlate(trace, [1000] * 10)
+    level_zero = lags < 2 * 8
+    assert np.array_equal(lags[level_zero], np.arange(1, 16))
+    # the covariance of the pairs at every lag...
+    expected = [np.mean(trace[:-j] * trace[j:]) - trace[:-j].mean() * trace[j:].mean() for j in range(1, 16)]
+    assert np.allclose(acf[level_zero], expected, rtol=1e-9)
+    # ...which is the direct ACF up to the difference of the pair and global means
+    assert np.allclose(acf[level_zero], autocorrelation(trace, max_lag=15), rtol=1e-2)
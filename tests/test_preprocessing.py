@@ -0,0 +1,22 @@
+import os
+import sys
+import numpy as np
+import pytest
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+from preprocessing import blocks, median_background
+
+
+def test_blocks_cover_range():
+    assert list(blocks(10, 4)) == [slice(0, 4), slice(4, 8), slice(8, 10)]
+    with pytest.raises(ValueError):
+        list(blocks(10, 0))
+
+
+@pytest.mark.parametrize('max_bytes', [1000, 8 * 16 * 4 * 50 * 3, 256e6])
+def test_banded_median(max_bytes):
+    # 1000 bytes is less than one row of the 50 frames (3200 bytes)
+    frames = np.random.default_rng(0).random((50, 8, 16), dtype=np.float32)
+    assert np.array_equal(median_background(frames, max_bytes=max_bytes), np.median(frames, axis=0))
@@ -0,0 +1,52 @@
+import os
+import sys
+import numpy as np
+import pytest
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+from DDM_Fourier import DDM_Fourier, RadialAverager
+
+
+@pytest.fixture(scope='module')
+def video(tmp_path_factory):
+    from synthetic import write_video
+
+    path = str(tmp_path_factory.mktemp('time_resolved') / 'brownian.avi')
+    return write_video(path, 30, shape=(24, 20), n_particles=10, seed=3)
+
+
+@pytest.fixture
+def ddm(video):
+    return DDM_Fourier(video, pixel_size=0.1, particle_size=1.)
+
+
+def window_from_scratch(frames, start, window, idts, couple_step):
+    """ISF of one window from its own frames, every couple (t, t + lag) with t on the couple grid."""
+    ra = RadialAverager(frames.shape[-2:])
+    isf = []
+    for idt in idts:
+        spectra = [np.abs(np.fft.fft2(frames[t + idt].astype(float) - frames[t]))**2
+                   for t in range(start, start + window - idt) if t % couple_step == 0]
+        isf.append(ra(np.mean(spectra, axis=0)))
+    return np.array(isf)
+
+
+@pytest.mark.parametrize('window, stride, couple_step', [(10, 3, 1), (12, 5, 2), (30, 1, 1)])
+def test_sliding_windows_match_scratch(ddm, window, stride, couple_step):
+    frames = ddm.frames
+    idts = [1, 2, 4, 7, 40]
+    isf_windows = ddm.time_resolved_isf(idts, window, stride, couple_step)
+
+    assert list(ddm.window_idts) == [1, 2, 4, 7]
+    assert list(ddm.window_starts) == list(range(0, frames.shape[0] - window + 1, stride))
+    for start, isf in zip(ddm.window_starts, isf_windows):
+        expected = window_from_scratch(frames, start, window, ddm.window_idts, couple_step)
+        assert np.allclose(isf, expected, rtol=1e-9)
+
+
+def test_full_window_matches_calculate_isf(ddm):
+    idts = [1, 3, 9]
+    isf_windows = ddm.time_resolved_isf(idts, window=ddm.frames.shape[0], stride=1)
+    assert np.allclose(isf_windows[0], ddm.calculate_isf(idts, maxNCouples=1000, n_jobs=1), rtol=1e-9)